@@ -0,0 +1,147 @@
+import itertools
+import threading
+from collections import Counter
+from db import execute_db_query
+
+class _DayState:
+    __slots__ = ('holders', 'user_tables', 'version')
+
+    def __init__(self, total_tables, version):
+        # holders[table_id] is (user_id, username) of the booking, or None if the table is free. Index 0 is unused
+        self.holders = [None] * (total_tables + 1)
+        # user_id -> table_id booked by that user on this day
+        self.user_tables = {}
+        # Changes whenever a table on this day is booked or freed
+        self.version = version
+
+    def book(self, table_id, user_id, username):
+        if table_id >= len(self.holders):
+            self.holders.extend([None] * (table_id + 1 - len(self.holders)))
+        self.holders[table_id] = (user_id, username)
+        self.user_tables[user_id] = table_id
+
+    def cancel(self, table_id, user_id):
+        if table_id < len(self.holders) and self.holders[table_id] and self.holders[table_id][0] == user_id:
+            self.holders[table_id] = None
+        if self.user_tables.get(user_id) == table_id:
+            del self.user_tables[user_id]
+
+class AvailabilityIndex:
+    """In-memory view of which tables of one office are taken on each bookable day, keyed by ISO booking_day.
+
+    Days are loaded from the database on first access (or by warm()) and then kept current by the booking and
+    cancel paths calling mark_booked()/mark_cancelled(). The database stays the source of truth: a free table in
+    memory is only a hint that a booking may succeed, and if the insert is rejected, call reload() for that day.
+    A conflict in memory can be out of date as well, since another process or worker may have cancelled the
+    booking, so the confirmed_* lookups re-read the day from the database before reporting one.
+
+    Days are loaded outside the lock, so a cold day doesn't hold up readers of the others. A load that overlaps a
+    mark_booked()/mark_cancelled() is repeated, so an older snapshot never replaces a newer change.
+
+    Every change to a day gives it a new version(), so views rendered from a day can be cached until it changes."""
+
+    def __init__(self, database_path, total_tables, office_id):
+        self.database_path = database_path
+        self.total_tables = total_tables
+        self.office_id = office_id
+        self._days = {}
+        self._lock = threading.Lock()
+        self._versions = itertools.count(1)
+        # mark_booked()/mark_cancelled() calls per day, cached or not, so a load can tell whether one overlapped it
+        self._marks = Counter()
+
+    def _load(self, booking_day):
+        state = _DayState(self.total_tables, next(self._versions))
+        rows = execute_db_query(self.database_path, "SELECT table_id, user_id, holder FROM booking_holders WHERE office_id = ? AND booking_day = ?",
+                                (self.office_id, booking_day), fetch_all=True)
+        for table_id, user_id, username in rows:
+            state.book(table_id, str(user_id), username)
+        return state
+
+    def _fetch(self, booking_day, replace):
+        """Load booking_day without holding the lock and store it, over a cached state if replace. Returns the
+        cached state."""
+        while True:
+            with self._lock:
+                if not replace and booking_day in self._days:
+                    return self._days[booking_day]
+                marks = self._marks[booking_day]
+            state = self._load(booking_day)
+            with self._lock:
+                if self._marks[booking_day] == marks:
+                    if replace or booking_day not in self._days:
+                        self._days[booking_day] = state
+                    return self._days[booking_day]
+
+    def _day(self, booking_day):
+        with self._lock:
+            state = self._days.get(booking_day)
+        return state if state is not None else self._fetch(booking_day, replace=False)
+
+    def warm(self, booking_days):
+        """Load the given days and drop every cached day that is no longer in the list."""
+        for booking_day in booking_days:
+            self._fetch(booking_day, replace=False)
+        with self._lock:
+            self._days = {day: state for day, state in self._days.items() if day in booking_days}
+            self._marks = Counter({day: marks for day, marks in self._marks.items() if day in booking_days})
+
+    def reload(self, booking_day):
+        self._fetch(booking_day, replace=True)
+
+    def version(self, booking_day):
+        return self._day(booking_day).version
+
+    def booked_tables(self, booking_day):
+        """Return a list of booleans indexed by table_id (index 0 unused) for tables 1..total_tables."""
+        state = self._day(booking_day)
+        with self._lock:
+            holders = state.holders
+            return [holders[i] is not None if i < len(holders) else False for i in range(self.total_tables + 1)]
+
+    def table_holder(self, booking_day, table_id):
+        """Return the username holding table_id on booking_day, or None if it is free."""
+        state = self._day(booking_day)
+        with self._lock:
+            holder = state.holders[table_id] if table_id < len(state.holders) else None
+            return holder[1] if holder else None
+
+    def user_table(self, booking_day, user_id):
+        """Return the table_id booked by user_id on booking_day, or None."""
+        state = self._day(booking_day)
+        with self._lock:
+            return state.user_tables.get(str(user_id))
+
+    def _confirmed(self, booking_day, lookup):
+        # Free in memory is answered as is; anything else is looked up again after re-reading the day
+        result = lookup(booking_day)
+        if result is None:
+            return None
+        self.reload(booking_day)
+        return lookup(booking_day)
+
+    def confirmed_table_holder(self, booking_day, table_id):
+        """table_holder(), re-read from the database if memory says the table is taken."""
+        return self._confirmed(booking_day, lambda day: self.table_holder(day, table_id))
+
+    def confirmed_user_table(self, booking_day, user_id):
+        """user_table(), re-read from the database if memory says the user has a booking."""
+        return self._confirmed(booking_day, lambda day: self.user_table(day, user_id))
+
+    def confirmed_fully_booked(self, booking_day):
+        """Whether every table is taken on booking_day, re-read from the database if memory says so."""
+        return self._confirmed(booking_day, lambda day: True if all(self.booked_tables(day)[1:]) else None) is not None
+
+    def mark_booked(self, booking_day, table_id, user_id, username):
+        with self._lock:
+            self._marks[booking_day] += 1
+            if booking_day in self._days:
+                self._days[booking_day].book(table_id, str(user_id), username)
+                self._days[booking_day].version = next(self._versions)
+
+    def mark_cancelled(self, booking_day, table_id, user_id):
+        with self._lock:
+            self._marks[booking_day] += 1
+            if booking_day in self._days:
+                self._days[booking_day].cancel(table_id, str(user_id))
+                self._days[booking_day].version = next(self._versions)
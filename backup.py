@@ -0,0 +1,200 @@
+import gzip
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from db import BUSY_TIMEOUT_SECONDS
+from metrics import render_series
+
+logger = logging.getLogger(__name__)
+
+# Pages copied per backup step, and the pause between steps that lets the bot's own queries in
+PAGES_PER_STEP = 256
+STEP_PAUSE = 0.005
+# A write from another connection restarts an online backup from the first page; after this many restarts the
+# rest is copied in one step, under a single read transaction
+MAX_RESTARTS = 3
+KEEP_SNAPSHOTS = 7
+# Snapshots are '<database>-<YYYYmmdd-HHMMSS>.db.gz'; one run writes a file per database with the same stamp
+STAMP_FORMAT = '%Y%m%d-%H%M%S'
+SNAPSHOT_NAME = re.compile(r'^(?P<database>[a-z]+)-(?P<stamp>\d{8}-\d{6})\.db\.gz$')
+
+# Per database of a run: pages copied, backup steps, time the steps held the source's read lock in total and at
+# most at once, restarts after concurrent writes, and the compressed snapshot's size in bytes
+SnapshotReport = namedtuple('SnapshotReport', ['database', 'pages', 'steps', 'lock_seconds', 'longest_step', 'restarts', 'size'])
+BackupReport = namedtuple('BackupReport', ['stamp', 'seconds', 'snapshots'])
+
+class BackupError(Exception):
+    pass
+
+class Backups:
+    """Online backups of the bot's SQLite databases into rotating gzip snapshots.
+
+    A backup copies each database with SQLite's backup API, PAGES_PER_STEP pages at a time with a short pause in
+    between, so the bot keeps reading and writing throughout: under WAL a step only holds a read lock, and it is
+    short either way. The copy is checked with PRAGMA integrity_check before it is compressed into the snapshot
+    directory, where the newest `keep` runs are kept. A restore checks the snapshot the same way, saves the current
+    state as a snapshot first, and then copies the snapshot back over the live database, again with the backup
+    API so open connections see the restored data."""
+
+    def __init__(self, databases, directory, keep=KEEP_SNAPSHOTS, pages=PAGES_PER_STEP, pause=STEP_PAUSE):
+        # Database name (as used in snapshot names) -> path
+        self.databases = databases
+        self.directory = directory
+        self.keep = keep
+        self.pages = pages
+        self.pause = pause
+        self._lock = threading.Lock()
+        self.last_report = None
+        self.last_success = None
+
+    def snapshots(self):
+        """Stamps of the complete runs in the snapshot directory, newest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        runs = {}
+        for file_name in os.listdir(self.directory):
+            match = SNAPSHOT_NAME.match(file_name)
+            if match and match['database'] in self.databases:
+                runs.setdefault(match['stamp'], set()).add(match['database'])
+        return sorted((stamp for stamp, databases in runs.items() if databases == set(self.databases)), reverse=True)
+
+    def _snapshot_path(self, database, stamp):
+        return os.path.join(self.directory, f'{database}-{stamp}.db.gz')
+
+    def run(self):
+        """Back up every database now and drop the oldest runs beyond keep. Returns the BackupReport."""
+        with self._lock:
+            return self._run()
+
+    def _run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Stamps have one-second resolution; a run in the same second as another (e.g. a restore's safety backup)
+        # takes the next free one rather than overwriting it
+        taken = set(self.snapshots())
+        moment = datetime.now()
+        while moment.strftime(STAMP_FORMAT) in taken:
+            moment += timedelta(seconds=1)
+        stamp = moment.strftime(STAMP_FORMAT)
+        started = time.perf_counter()
+        reports = []
+        for database, path in self.databases.items():
+            with tempfile.TemporaryDirectory(dir=self.directory) as work:
+                copy_path = os.path.join(work, f'{database}.db')
+                report = self._copy(path, copy_path, database)
+                _verify(copy_path, database)
+                snapshot_path = self._snapshot_path(database, stamp)
+                with open(copy_path, 'rb') as source, gzip.open(snapshot_path + '.part', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.replace(snapshot_path + '.part', snapshot_path)
+                reports.append(report._replace(size=os.path.getsize(snapshot_path)))
+
+        for old_stamp in self.snapshots()[self.keep:]:
+            for database in self.databases:
+                os.remove(self._snapshot_path(database, old_stamp))
+        report = BackupReport(stamp, time.perf_counter() - started, reports)
+        self.last_report, self.last_success = report, time.time()
+        logger.info(f"Backup {stamp} finished in {report.seconds:.2f} s: " +
+                    ", ".join(f"{r.database} {r.pages} pages in {r.steps} steps, {r.lock_seconds * 1000:.1f} ms locked "
+                              f"(longest step {r.longest_step * 1000:.1f} ms), {r.restarts} restarts" for r in reports))
+        return report
+
+    def _copy(self, source_path, target_path, database):
+        source = sqlite3.connect(source_path, timeout=BUSY_TIMEOUT_SECONDS)
+        target = sqlite3.connect(target_path)
+        # Step timing: a step runs from the end of one progress callback to the start of the next
+        state = {'steps': 0, 'lock': 0.0, 'longest': 0.0, 'restarts': 0, 'remaining': None, 'pages': 0, 'resumed': None}
+
+        def progress(status, remaining, total):
+            step = time.perf_counter() - state['resumed']
+            state['steps'] += 1
+            state['lock'] += step
+            state['longest'] = max(state['longest'], step)
+            state['pages'] = total
+            if state['remaining'] is not None and remaining > state['remaining']:
+                # Another connection wrote to the database and the backup started over
+                state['restarts'] += 1
+            state['remaining'] = remaining
+            if remaining and state['restarts'] >= MAX_RESTARTS:
+                raise _Restarted()
+            if remaining:
+                time.sleep(self.pause)
+            state['resumed'] = time.perf_counter()
+
+        try:
+            try:
+                state['resumed'] = time.perf_counter()
+                source.backup(target, pages=self.pages, progress=progress)
+            except _Restarted:
+                logger.warning(f"Backup of {database} restarted {state['restarts']} times by concurrent writes, "
+                               f"copying the rest in one step")
+                started = time.perf_counter()
+                source.backup(target)
+                step = time.perf_counter() - started
+                state['steps'] += 1
+                state['lock'] += step
+                state['longest'] = max(state['longest'], step)
+        finally:
+            source.close()
+            target.close()
+        return SnapshotReport(database, state['pages'], state['steps'], state['lock'], state['longest'], state['restarts'], None)
+
+    def restore(self, stamp):
+        """Replace every database with its snapshot from the run stamp, after verifying them all and backing up the
+        current state. Returns the stamp of that safety backup."""
+        with self._lock:
+            if stamp not in self.snapshots():
+                raise BackupError(f"No complete backup {stamp}")
+            with tempfile.TemporaryDirectory(dir=self.directory) as work:
+                copies = {}
+                for database in self.databases:
+                    copy_path = copies[database] = os.path.join(work, f'{database}.db')
+                    try:
+                        with gzip.open(self._snapshot_path(database, stamp), 'rb') as source, open(copy_path, 'wb') as target:
+                            shutil.copyfileobj(source, target)
+                    except (OSError, EOFError) as e:
+                        raise BackupError(f"The {database} snapshot can't be decompressed: {e}")
+                    _verify(copy_path, database)
+                safety = self._run()
+                for database, path in self.databases.items():
+                    snapshot = sqlite3.connect(copies[database])
+                    live = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS)
+                    try:
+                        snapshot.backup(live)
+                    finally:
+                        snapshot.close()
+                        live.close()
+                    _verify(path, database)
+            logger.warning(f"Restored backup {stamp}; the previous state was saved as backup {safety.stamp}")
+            return safety.stamp
+
+    def render(self):
+        """Last backup's duration and time in the Prometheus text exposition format."""
+        report = self.last_report
+        series = (
+            ('deskbooker_backup_last_duration_seconds', 'gauge', 'Wall time of the last successful backup.', report.seconds if report else 0),
+            ('deskbooker_backup_last_lock_seconds', 'gauge', 'Time the last backup held read locks on the databases.',
+             sum(snapshot.lock_seconds for snapshot in report.snapshots) if report else 0),
+            ('deskbooker_backup_last_success_timestamp_seconds', 'gauge', 'Unix time of the last successful backup.', self.last_success or 0),
+        )
+        return render_series(series)
+
+class _Restarted(Exception):
+    pass
+
+def _verify(path, database):
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchall()
+    except sqlite3.DatabaseError as e:
+        raise BackupError(f"The {database} copy is not a usable database: {e}")
+    finally:
+        conn.close()
+    if result != [('ok',)]:
+        raise BackupError(f"The {database} copy failed the integrity check: {result[0][0]}")
@@ -0,0 +1,103 @@
+"""Offline stand-in for the Telegram Bot API, plus factories for synthetic updates.
+
+FakeRequest replaces the HTTP layer of telegram.Bot: every API method returns a well-formed response without any
+network access, after an optional simulated round-trip delay. Calls are counted per API method.
+"""
+import itertools
+import threading
+import time
+from collections import Counter
+from telegram import Bot, Update
+from telegram.error import BadRequest
+from telegram.utils.request import Request
+
+BOT_ID = 123456
+BOT_TOKEN = f'{BOT_ID}:offline-benchmark-token'
+# Telegram rejects longer message texts, so the fake does too
+MAX_MESSAGE_LENGTH = 4096
+
+class FakeRequest(Request):
+    def __init__(self, latency=0.0):
+        # Deliberately skips Request.__init__: no connection pool is needed
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1000)
+        # Contents served for getFile/download, by file_id
+        self.files = {}
+
+    @property
+    def con_pool_size(self):
+        return 1
+
+    def stop(self):
+        pass
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        with self._lock:
+            self.calls[method] += 1
+        if method == 'getMe':
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Desk Booker', 'username': 'desk_booker_bot'}
+        if self.latency:
+            time.sleep(self.latency)
+        if len(data.get('text', '')) > MAX_MESSAGE_LENGTH:
+            raise BadRequest('Message is too long')
+        if method == 'getFile':
+            return {'file_id': data['file_id'], 'file_unique_id': data['file_id'], 'file_path': f"documents/{data['file_id']}"}
+        if method in ('answerCallbackQuery', 'setWebhook', 'deleteWebhook', 'deleteMessage'):
+            return True
+        chat_id = data.get('chat_id', 1)
+        if method == 'sendPhoto':
+            # A photo already on Telegram's servers keeps its file_id; an upload gets a new one
+            message_id = next(self._message_ids)
+            file_id = data['photo'] if isinstance(data['photo'], str) else f'photo-{message_id}'
+            return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                    'photo': [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 720}]}
+        return {'message_id': data.get('message_id') or next(self._message_ids), 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}, 'text': data.get('text', '')}
+
+    def retrieve(self, url, timeout=None):
+        return self.files.get(url.rsplit('/', 1)[-1], b'')
+
+def make_bot(latency=0.0):
+    """Return a telegram.Bot wired to a FakeRequest."""
+    return Bot(BOT_TOKEN, request=FakeRequest(latency))
+
+_update_ids = itertools.count(1)
+
+def _user(user_id):
+    return {'id': int(user_id), 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'}
+
+def command_update(bot, user_id, command, args=()):
+    """A private-chat message carrying /command with optional arguments."""
+    text = '/' + ' '.join((command,) + tuple(str(arg) for arg in args))
+    update_id = next(_update_ids)
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': int(user_id), 'type': 'private'},
+                    'from': _user(user_id), 'text': text,
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command) + 1}]},
+    }, bot)
+
+def callback_update(bot, user_id, data):
+    """An inline keyboard tap with the given callback_data."""
+    update_id = next(_update_ids)
+    return Update.de_json({
+        'update_id': update_id,
+        'callback_query': {'id': str(update_id), 'chat_instance': str(user_id), 'data': data, 'from': _user(user_id),
+                           'message': {'message_id': update_id, 'date': int(time.time()),
+                                       'chat': {'id': int(user_id), 'type': 'private'}, 'text': ''}},
+    }, bot)
+
+def document_update(bot, user_id, caption, file_name, file_id):
+    """A message with an attached document, such as a file sent with a /command caption."""
+    update_id = next(_update_ids)
+    command_length = len(caption.split()[0]) if caption.startswith('/') else 0
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': int(user_id), 'type': 'private'},
+                    'from': _user(user_id), 'caption': caption,
+                    'caption_entities': [{'type': 'bot_command', 'offset': 0, 'length': command_length}] if command_length else [],
+                    'document': {'file_id': file_id, 'file_unique_id': file_id, 'file_name': file_name}},
+    }, bot)
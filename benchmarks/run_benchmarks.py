@@ -0,0 +1,288 @@
+"""Offline latency and throughput benchmarks for the bot's hot paths.
+
+Usage:
+    python benchmarks/run_benchmarks.py --users 200 --tables 40 --history-years 2 --concurrency 16
+
+A throwaway config and databases are created in a temporary directory, seeded with --history-years of bookings,
+and the real handlers are driven through a Dispatcher by synthetic updates. Telegram is replaced by the offline
+FakeRequest (optionally with --api-latency per call), so nothing touches the network. For each step the script
+reports p50/p95/p99 latency, and for each scenario the throughput, handler errors and Telegram API calls made.
+"""
+import argparse
+import logging
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_telegram import make_bot, command_update, callback_update, document_update
+from seed import FIRST_USER_ID, seed_users, seed_bookings
+
+ADMIN_USER_ID = 1
+
+CONFIG_TEMPLATE = """BOT_TOKEN = 'unused'
+ADMIN_USER_ID = '{admin_user_id}'
+ADMIN_USERNAME = 'admin'
+BOOKINGS_DB_PATH = {bookings_db_path!r}
+USERS_DB_PATH = {users_db_path!r}
+TOTAL_TABLES = {tables}
+LOG_TIMEZONE = 'UTC'
+"""
+# Appended for --single-database: users and bookings in one file, with foreign keys
+SINGLE_DATABASE_TEMPLATE = """DATABASE_PATH = {database_path!r}
+"""
+
+def load_bot(workdir, tables, single_database=False):
+    """Write a config for workdir and import main against it."""
+    data_dir = os.path.join(workdir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    with open(os.path.join(workdir, 'config.py'), 'w') as f:
+        f.write(CONFIG_TEMPLATE.format(admin_user_id=ADMIN_USER_ID, tables=tables,
+                                       bookings_db_path=os.path.join(data_dir, 'bookings.db'),
+                                       users_db_path=os.path.join(data_dir, 'users.db')))
+        if single_database:
+            f.write(SINGLE_DATABASE_TEMPLATE.format(database_path=os.path.join(data_dir, 'desk.db')))
+    sys.path.insert(0, workdir)
+    sys.path.insert(1, REPO_ROOT)
+    import main
+    return main
+
+class Recorder(logging.Handler):
+    """Collects latencies per step and counts failures: errors raised to the dispatcher as well as the
+    errors handlers catch and log themselves."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.latencies = defaultdict(list)
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            self.errors += 1
+
+    def record(self, label, seconds):
+        with self._lock:
+            self.latencies[label].append(seconds)
+
+    def error(self, update, context):
+        with self._lock:
+            self.errors += 1
+
+def capture_promises(dispatcher):
+    """Make dispatcher.run_async also record the Promise of every handler it queues, per calling thread, so a
+    benchmark can wait for handlers registered with run_async to finish. Returns the thread-local record."""
+    pending = threading.local()
+    queue_handler = dispatcher.run_async
+
+    def run_async(func, *args, update=None, **kwargs):
+        promise = queue_handler(func, *args, update=update, **kwargs)
+        pending.promises.append(promise)
+        return promise
+
+    dispatcher.run_async = run_async
+    return pending
+
+def run_jobs(dispatcher, jobs, concurrency, recorder, pending):
+    """Process every job with concurrency users tapping at once. A job is a list of (label, update) pairs handled in
+    order, like one user tapping through a flow, each step waiting for the previous one's handler to finish.
+
+    Updates reach the dispatcher one at a time, as from the Updater's single dispatcher thread: without run_async
+    the handlers therefore run one after another, and with it they run on the dispatcher's worker pool. Latency is
+    measured until the handler has finished either way. Returns the wall time."""
+    dispatch_lock = threading.Lock()
+
+    def run(job):
+        for label, update in job:
+            started = time.perf_counter()
+            pending.promises = []
+            with dispatch_lock:
+                dispatcher.process_update(update)
+            for promise in pending.promises:
+                promise.done.wait()
+            recorder.record(label, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, jobs))
+    return time.perf_counter() - started
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def users(count):
+    return [FIRST_USER_ID + i for i in range(count)]
+
+def scenario_book_command(main, dispatcher, args):
+    bot = dispatcher.bot
+    return [[('/book', command_update(bot, user_id, 'book'))] for user_id in users(args.users)]
+
+def scenario_booking_flow(main, dispatcher, args):
+    bot = dispatcher.bot
+    # Each user opens the table picker for a date and taps a table; several users compete for the same tables
+    days = [main.to_iso_date(date) for date in main.generate_dates()]
+    office_id = main.default_office.key
+    jobs = []
+    for i, user_id in enumerate(users(args.users)):
+        day = days[i % len(days)]
+        table_id = i % args.tables + 1
+        jobs.append([('date -> book_time', callback_update(bot, user_id, main.callbacks.encode(main.callbacks.DATE, office_id, day))),
+                     ('table -> process_booking', callback_update(bot, user_id, main.callbacks.encode(main.callbacks.TABLE, office_id, day, table_id)))])
+    return jobs
+
+def scenario_view_bookings(main, dispatcher, args):
+    bot = dispatcher.bot
+    jobs = []
+    for user_id in users(args.users):
+        jobs.append([('/my_bookings', command_update(bot, user_id, 'my_bookings'))])
+        jobs.append([('/all_bookings', command_update(bot, user_id, 'all_bookings'))])
+    return jobs
+
+def scenario_history(main, dispatcher, args):
+    bot = dispatcher.bot
+    return [[('/history', command_update(bot, ADMIN_USER_ID, 'history'))] for _ in range(args.repeat)]
+
+def scenario_stats(main, dispatcher, args):
+    bot = dispatcher.bot
+    return [[('/stats 12', command_update(bot, ADMIN_USER_ID, 'stats', ('12',)))] for _ in range(args.repeat)]
+
+def scenario_cancel(main, dispatcher, args):
+    bot = dispatcher.bot
+    today = time.strftime('%Y-%m-%d')
+    rows = main.execute_db_query(main.bookings_db_path, "SELECT id, user_id FROM bookings WHERE booking_day >= ? LIMIT ?",
+                                 (today, args.users), fetch_all=True)
+    return [[('cancel -> cancel_booking', callback_update(bot, user_id, f'cancel_{booking_id}'))] for booking_id, user_id in rows]
+
+def scenario_stress(main, dispatcher, args):
+    bot = dispatcher.bot
+    # Everyone taps the same free table on the same (far future) day at once: exactly one booking may land
+    day = main.generate_dates()[-1]
+    table_id = args.tables
+    office = main.default_office
+    booked = main.execute_db_query(main.bookings_db_path, "SELECT id FROM bookings WHERE office_id = ? AND booking_day = ? AND table_id = ?",
+                                   (office.key, main.to_iso_date(day), table_id), fetch_all=True)
+    for (booking_id,) in booked:
+        main.execute_db_query(main.bookings_db_path, "DELETE FROM bookings WHERE id = ?", (booking_id,))
+    office.availability.reload(main.to_iso_date(day))
+    jobs = []
+    data = main.callbacks.encode(main.callbacks.TABLE, office.key, main.to_iso_date(day), table_id)
+    for user_id in users(args.users):
+        jobs.append([('concurrent process_booking', callback_update(bot, user_id, data))])
+    return jobs
+
+def check_stress(main, args):
+    day = main.to_iso_date(main.generate_dates()[-1])
+    count = main.execute_db_query(main.bookings_db_path, "SELECT COUNT(*) FROM bookings WHERE office_id = ? AND booking_day = ? AND table_id = ?",
+                                  (main.default_office.key, day, args.tables), fetch_one=True)[0]
+    return f"bookings for the contested table: {count} (expected 1)", count == 1
+
+def scenario_import_users(main, dispatcher, args):
+    # One admin upload of --import-size users, half of them new
+    bot = dispatcher.bot
+    first = FIRST_USER_ID + args.users // 2
+    lines = ['user_id,username,is_admin,is_blacklisted'] + [f'{user_id},user{user_id},0,0' for user_id in range(first, first + args.import_size)]
+    bot.request.files['users-import'] = '\n'.join(lines).encode('utf-8')
+    return [[('/import_users', document_update(bot, ADMIN_USER_ID, '/import_users', 'users.csv', 'users-import'))]]
+
+SCENARIOS = {
+    'book_command': (scenario_book_command, None),
+    'booking_flow': (scenario_booking_flow, None),
+    'view_bookings': (scenario_view_bookings, None),
+    'history': (scenario_history, None),
+    'stats': (scenario_stats, None),
+    'cancel': (scenario_cancel, None),
+    'stress': (scenario_stress, check_stress),
+    'import_users': (scenario_import_users, None),
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the Desk Booker handlers.")
+    parser.add_argument('--users', type=int, default=200, help="registered users taking part in each scenario")
+    parser.add_argument('--tables', type=int, default=40, help="TOTAL_TABLES for the run")
+    parser.add_argument('--history-years', type=float, default=1, help="years of booking history to seed")
+    parser.add_argument('--concurrency', type=int, default=16, help="updates processed in parallel")
+    parser.add_argument('--api-latency', type=float, default=0, help="simulated Telegram round trip in milliseconds")
+    parser.add_argument('--import-size', type=int, default=5000, help="users in the /import_users file")
+    parser.add_argument('--repeat', type=int, default=20, help="runs of the admin /history and /stats commands")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="comma-separated subset of: " + ', '.join(SCENARIOS))
+    parser.add_argument('--keep', action='store_true', help="keep the temporary directory with the databases")
+    parser.add_argument('--single-database', action='store_true', help="run with DATABASE_PATH: users and bookings in one database")
+    parser.add_argument('--run-async', action=argparse.BooleanOptionalAction, default=True,
+                        help="register the handlers with run_async, as the bot does; --no-run-async runs them one at a time "
+                             "on the dispatcher thread, as before the worker pool was introduced")
+    parser.add_argument('--workers', type=int, default=32, help="size of the dispatcher's worker pool for --run-async (WORKERS)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='deskbooker-bench-')
+    dispatcher = None
+    try:
+        bot_module = load_bot(workdir, args.tables, args.single_database)
+        bot_module.initialize_databases()
+        seed_users(bot_module.users_db_path, args.users)
+        seeded = seed_bookings(bot_module.bookings_db_path, args.users, args.tables, args.history_years, office_id=bot_module.default_office.key)
+        bot_module.rebuild_stats(bot_module.bookings_db_path, bot_module.default_office.key)
+        bot_module.user_cache.load()
+        bot_module.default_office.availability.warm([bot_module.to_iso_date(date) for date in bot_module.generate_dates()])
+        print(f"Seeded {args.users} users, {args.tables} tables, {seeded} bookings ({args.history_years} years) in {workdir}")
+
+        from telegram.ext import Dispatcher
+        bot = make_bot(args.api_latency / 1000)
+        dispatcher = Dispatcher(bot, queue.Queue(), workers=args.workers if args.run_async else 1)
+        bot_module.register_handlers(dispatcher, run_async=args.run_async)
+        pending = capture_promises(dispatcher)
+        # start() brings up the worker pool; its own loop just idles on the empty update queue
+        ready = threading.Event()
+        threading.Thread(target=dispatcher.start, kwargs={'ready': ready}, daemon=True).start()
+        ready.wait()
+        print(f"Handlers run {f'on {args.workers} workers' if args.run_async else 'one at a time'}, "
+              f"{args.concurrency} users tapping at once")
+
+        failed = []
+        for name in args.scenarios.split(','):
+            build, check = SCENARIOS[name]
+            recorder = Recorder()
+            # Handler errors are counted instead of printed
+            logging.getLogger().handlers = [recorder]
+            dispatcher.error_handlers.clear()
+            dispatcher.add_error_handler(recorder.error)
+            calls_before = sum(bot.request.calls.values())
+            jobs = build(bot_module, dispatcher, args)
+            elapsed = run_jobs(dispatcher, jobs, args.concurrency, recorder, pending)
+            processed = sum(len(job) for job in jobs)
+
+            print(f"\n== {name}: {processed} updates in {elapsed:.2f}s, {processed / elapsed:.1f} updates/s, "
+                  f"{recorder.errors} errors, {sum(bot.request.calls.values()) - calls_before} API calls")
+            for label, values in recorder.latencies.items():
+                values.sort()
+                print(f"  {label:<28} n={len(values):<6} p50={percentile(values, 0.50) * 1000:8.2f} ms  "
+                      f"p95={percentile(values, 0.95) * 1000:8.2f} ms  p99={percentile(values, 0.99) * 1000:8.2f} ms")
+            if check:
+                # Checks return (report, passed); a failed one fails the whole run
+                report, passed = check(bot_module, args)
+                print("  " + report + ("" if passed else "  FAILED"))
+                if not passed:
+                    failed.append(name)
+        if failed:
+            print(f"\nFailed checks: {', '.join(failed)}")
+            return 1
+        return 0
+    finally:
+        if dispatcher is not None:
+            # Joins the worker pool
+            dispatcher.stop()
+        if args.keep:
+            print(f"\nDatabases kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Populate a users and a bookings database with synthetic data.
+
+Usage:
+    python benchmarks/seed.py --bookings-db data/bookings.db --users-db data/users.db --users 200 --tables 40 --years 3
+
+Every working day in the past --years years (and the next week) gets bookings for roughly --occupancy of the
+tables, each by a different user, in the same format the bot writes them. The schema must already exist: start
+the bot once against the databases, or let benchmarks/run_benchmarks.py create and seed them. Seeded bookings
+bypass the bot, so run /rebuild_stats afterwards for /stats to include them.
+"""
+import argparse
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+FIRST_USER_ID = 10000
+BATCH_SIZE = 10000
+
+def user_ids(users):
+    return [str(FIRST_USER_ID + i) for i in range(users)]
+
+def seed_users(users_db_path, users):
+    with sqlite3.connect(users_db_path) as conn:
+        conn.executemany("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
+                         ((user_id, f'user{user_id}') for user_id in user_ids(users)))
+
+def _booking_rows(users, tables, years, occupancy, rng):
+    ids = user_ids(users)
+    today = datetime.now()
+    day = today - timedelta(days=365 * years)
+    last_day = today + timedelta(days=7)
+    per_day = min(users, max(1, int(tables * occupancy)))
+    while day <= last_day:
+        if day.weekday() < 5:
+            booking_date = day.strftime('%d.%m.%Y (%a)')
+            booking_day = day.strftime('%Y-%m-%d')
+            for user_id, table_id in zip(rng.sample(ids, per_day), rng.sample(range(1, tables + 1), per_day)):
+                yield (user_id, f'@user{user_id}', booking_date, table_id, booking_day)
+        day += timedelta(days=1)
+
+def seed_bookings(bookings_db_path, users, tables, years, occupancy=0.7, seed=1, office_id='main'):
+    """Insert the synthetic booking history of one office and return the number of rows written."""
+    rng = random.Random(seed)
+    written = 0
+    with sqlite3.connect(bookings_db_path) as conn:
+        batch = []
+        for row in _booking_rows(users, tables, years, occupancy, rng):
+            batch.append(row + (office_id,))
+            if len(batch) >= BATCH_SIZE:
+                written += _insert(conn, batch)
+                batch = []
+        written += _insert(conn, batch)
+    return written
+
+def _insert(conn, rows):
+    cursor = conn.executemany("""
+        INSERT OR IGNORE INTO bookings (user_id, username, booking_date, table_id, booking_day, office_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.commit()
+    return cursor.rowcount
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed the Desk Booker databases with synthetic users and bookings.")
+    parser.add_argument('--bookings-db', required=True)
+    parser.add_argument('--users-db', required=True)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--tables', type=int, default=40)
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--occupancy', type=float, default=0.7)
+    parser.add_argument('--office', default='main', help="office key the bookings belong to")
+    args = parser.parse_args()
+    seed_users(args.users_db, args.users)
+    written = seed_bookings(args.bookings_db, args.users, args.tables, args.years, args.occupancy, office_id=args.office)
+    print(f"Seeded {args.users} users and {written} bookings")
+
+if __name__ == '__main__':
+    main()
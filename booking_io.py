@@ -0,0 +1,75 @@
+import csv
+import heapq
+import io
+from datetime import date, datetime, timedelta, timezone
+from db import get_connection
+
+EXPORT_COLUMNS = ('id', 'office_id', 'booking_day', 'table_id', 'user_id', 'username', 'series_id', 'archived')
+# iCalendar content lines are folded at 75 octets
+ICS_LINE_LENGTH = 75
+
+def _booking_rows(database_path, where, parameters, order_by):
+    """Rows of bookings and bookings_archive matching where, merged in order_by order. Each table is read through
+    its own cursor in index order and the two are merged lazily, so memory use doesn't grow with the result."""
+    conn = get_connection(database_path)
+    columns = ', '.join(EXPORT_COLUMNS[:-1])
+    cursors = [conn.execute(f"SELECT {columns}, {archived} FROM {table} WHERE {where} ORDER BY {', '.join(order_by)}", parameters)
+               for table, archived in (('bookings_archive', 1), ('bookings', 0))]
+    positions = [EXPORT_COLUMNS.index(column) for column in order_by]
+    return heapq.merge(*cursors, key=lambda row: tuple(row[i] for i in positions))
+
+def export_bookings(database_path, out, office_id, first_day, last_day):
+    """Write office_id's bookings from first_day to last_day (ISO dates, inclusive), archived ones included, to the
+    binary file object out as CSV ordered by day and table. Returns how many were written."""
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(EXPORT_COLUMNS)
+    count = 0
+    for row in _booking_rows(database_path, "office_id = ? AND booking_day BETWEEN ? AND ?", (office_id, first_day, last_day),
+                             ('booking_day', 'table_id')):
+        writer.writerow(row)
+        count += 1
+    text.flush()
+    # Hand the binary file back to the caller instead of closing it with the wrapper
+    text.detach()
+    return count
+
+def _ics_text(value):
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _ics_line(line):
+    # Fold long lines: continuation lines start with a space, and multi-byte characters are never split
+    encoded = line.encode('utf-8')
+    if len(encoded) <= ICS_LINE_LENGTH:
+        return line + '\r\n'
+    parts, current, limit = [], '', ICS_LINE_LENGTH
+    for char in line:
+        if len((current + char).encode('utf-8')) > limit:
+            parts.append(current)
+            current, limit = '', ICS_LINE_LENGTH - 1
+        current += char
+    parts.append(current)
+    return '\r\n '.join(parts) + '\r\n'
+
+def export_calendar(database_path, out, user_id, describe):
+    """Write user_id's bookings, archived ones included, to the binary file object out as an iCalendar feed of
+    all-day events. describe(office_id, table_id) gives each event's summary, e.g.
+    'Table 3 at HQ'. Returns how many events were written."""
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='')
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    for line in ('BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Desk Booker Bot//Bookings//EN', 'CALSCALE:GREGORIAN',
+                 'METHOD:PUBLISH', 'X-WR-CALNAME:Desk bookings'):
+        text.write(_ics_line(line))
+    count = 0
+    for booking_id, office_id, booking_day, table_id, *_ in _booking_rows(
+            database_path, "user_id = ? AND booking_day IS NOT NULL", (str(user_id),), ('booking_day',)):
+        day = date.fromisoformat(booking_day)
+        for line in ('BEGIN:VEVENT', f'UID:booking-{booking_id}@desk-booker', f'DTSTAMP:{stamp}',
+                     f"DTSTART;VALUE=DATE:{day.strftime('%Y%m%d')}", f"DTEND;VALUE=DATE:{(day + timedelta(days=1)).strftime('%Y%m%d')}",
+                     f'SUMMARY:{_ics_text(describe(office_id, table_id))}', 'TRANSP:TRANSPARENT', 'END:VEVENT'):
+            text.write(_ics_line(line))
+        count += 1
+    text.write(_ics_line('END:VCALENDAR'))
+    text.flush()
+    text.detach()
+    return count
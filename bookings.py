@@ -0,0 +1,192 @@
+from collections import namedtuple
+from enum import Enum
+from db import execute_db_query, transaction
+from stats import count_bookings
+
+class BookingOutcome(Enum):
+    BOOKED = 'booked'
+    TABLE_TAKEN = 'table_taken'
+    USER_ALREADY_BOOKED = 'user_already_booked'
+
+# booking_id is set for BOOKED; holder is the username holding the table for TABLE_TAKEN;
+# table_id is the requested table, or the user's existing table for USER_ALREADY_BOOKED
+BookingResult = namedtuple('BookingResult', ['outcome', 'booking_id', 'table_id', 'holder'])
+
+def create_holders_view(database_path, join_users):
+    """(Re)create booking_holders: the bookings table plus a holder column, the name each booking is shown under.
+    With join_users, for a database that holds the users table as well, that is the user's current username,
+    falling back to the name stored with the booking; otherwise it is the stored name. Listings read the view, so
+    they don't depend on the layout, and SQLite flattens it into the query, using the indexes of bookings."""
+    execute_db_query(database_path, "DROP VIEW IF EXISTS booking_holders")
+    if join_users:
+        execute_db_query(database_path, """
+            CREATE VIEW booking_holders AS
+            SELECT bookings.*, COALESCE('@' || NULLIF(users.username, ''), bookings.username) AS holder
+            FROM bookings LEFT JOIN users ON users.user_id = bookings.user_id
+        """)
+    else:
+        execute_db_query(database_path, "CREATE VIEW booking_holders AS SELECT bookings.*, username AS holder FROM bookings")
+
+def book_table(database_path, office_id, user_id, username, booking_date, booking_day, table_id):
+    """Atomically book table_id in office_id on booking_day for user_id.
+
+    The (office_id, booking_day, table_id) and (user_id, booking_day) unique indexes decide the race: the INSERT
+    either lands or is dropped by ON CONFLICT, and only on a conflict do we read back who holds what.
+    Every function here that adds or removes bookings updates the summaries in stats within the same transaction."""
+    with transaction(database_path) as conn:
+        cursor = conn.execute("""
+            INSERT INTO bookings (office_id, user_id, username, booking_date, table_id, booking_day)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT DO NOTHING
+        """, (office_id, str(user_id), username, booking_date, table_id, booking_day))
+        if cursor.rowcount == 1:
+            count_bookings(conn, [(office_id, user_id, booking_day, table_id)], 1)
+            return BookingResult(BookingOutcome.BOOKED, cursor.lastrowid, table_id, username)
+
+        own_booking = conn.execute(
+            "SELECT table_id FROM bookings WHERE user_id = ? AND booking_day = ?", (str(user_id), booking_day)).fetchone()
+        if own_booking:
+            return BookingResult(BookingOutcome.USER_ALREADY_BOOKED, None, own_booking[0], username)
+
+        holder = conn.execute(
+            "SELECT holder FROM booking_holders WHERE office_id = ? AND booking_day = ? AND table_id = ?", (office_id, booking_day, table_id)).fetchone()
+        return BookingResult(BookingOutcome.TABLE_TAKEN, None, table_id, holder[0] if holder else None)
+
+# The row removed by delete_booking, so callers can update anything derived from it
+CancelledBooking = namedtuple('CancelledBooking', ['booking_id', 'user_id', 'booking_day', 'table_id', 'office_id'])
+
+def delete_booking(database_path, booking_id, user_id=None):
+    """Delete a booking by id, restricted to user_id's own bookings when given.
+    Returns the CancelledBooking, or None if nothing matched."""
+    with transaction(database_path) as conn:
+        query = "SELECT id, user_id, booking_day, table_id, office_id FROM bookings WHERE id = ?"
+        parameters = (booking_id,)
+        if user_id is not None:
+            query += " AND user_id = ?"
+            parameters += (str(user_id),)
+        row = conn.execute(query, parameters).fetchone()
+        if row is None:
+            return None
+        conn.execute("DELETE FROM bookings WHERE id = ?", (row[0],))
+        cancelled = CancelledBooking(*row)
+        count_bookings(conn, [(cancelled.office_id, cancelled.user_id, cancelled.booking_day, cancelled.table_id)], -1)
+        return cancelled
+
+# booked and conflicts are lists of booking_date display strings; conflicts pair each date with the reason
+SeriesResult = namedtuple('SeriesResult', ['series_id', 'booked', 'conflicts'])
+
+def book_series(database_path, office_id, user_id, username, table_id, weekdays, dates):
+    """Book table_id in office_id for user_id on every (booking_date, booking_day) in dates as one recurring series.
+
+    All target days are checked for conflicts in a single query and the free ones are inserted in one batch,
+    inside one write transaction. Days where the table is taken or the user already has a booking are skipped
+    and reported in the result instead of failing the series."""
+    user_id = str(user_id)
+    days = [booking_day for _, booking_day in dates]
+    placeholders = ', '.join('?' * len(days))
+    with transaction(database_path) as conn:
+        taken = {}
+        for booking_day, taken_table, taken_user, taken_username in conn.execute(f"""
+                SELECT booking_day, table_id, user_id, holder FROM booking_holders
+                WHERE office_id = ? AND booking_day IN ({placeholders}) AND table_id = ?
+                UNION ALL
+                SELECT booking_day, table_id, user_id, holder FROM booking_holders
+                WHERE user_id = ? AND booking_day IN ({placeholders})
+            """, [office_id] + days + [table_id, user_id] + days):
+            if taken_user == user_id:
+                taken[booking_day] = f"you already booked Table {taken_table}"
+            else:
+                taken.setdefault(booking_day, f"Table {table_id} is booked by {taken_username}")
+
+        free = [(booking_date, booking_day) for booking_date, booking_day in dates if booking_day not in taken]
+        conflicts = [(booking_date, taken[booking_day]) for booking_date, booking_day in dates if booking_day in taken]
+        if not free:
+            return SeriesResult(None, [], conflicts)
+
+        series_id = conn.execute("""
+            INSERT INTO booking_series (office_id, user_id, username, table_id, weekdays, first_day, last_day)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (office_id, user_id, username, table_id, weekdays, free[0][1], free[-1][1])).lastrowid
+        conn.executemany("""
+            INSERT INTO bookings (office_id, user_id, username, booking_date, table_id, booking_day, series_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [(office_id, user_id, username, booking_date, table_id, booking_day, series_id) for booking_date, booking_day in free])
+        count_bookings(conn, [(office_id, user_id, booking_day, table_id) for _, booking_day in free], 1)
+        return SeriesResult(series_id, [booking_date for booking_date, _ in free], conflicts)
+
+def delete_series(database_path, series_id, user_id, from_day):
+    """Cancel a user's series: delete its bookings on or after from_day and the series itself.
+    Returns the CancelledBooking list, or None if the series doesn't belong to user_id."""
+    with transaction(database_path) as conn:
+        if not conn.execute("SELECT 1 FROM booking_series WHERE id = ? AND user_id = ?", (series_id, str(user_id))).fetchone():
+            return None
+        rows = conn.execute("SELECT id, user_id, booking_day, table_id, office_id FROM bookings WHERE series_id = ? AND booking_day >= ?",
+                            (series_id, from_day)).fetchall()
+        conn.execute("DELETE FROM bookings WHERE series_id = ? AND booking_day >= ?", (series_id, from_day))
+        # Past bookings stay in the history but no longer belong to a live series
+        conn.execute("UPDATE bookings SET series_id = NULL WHERE series_id = ?", (series_id,))
+        conn.execute("DELETE FROM booking_series WHERE id = ?", (series_id,))
+        cancelled = [CancelledBooking(*row) for row in rows]
+        count_bookings(conn, [(booking.office_id, booking.user_id, booking.booking_day, booking.table_id) for booking in cancelled], -1)
+        return cancelled
+
+def join_waitlist(database_path, office_id, user_id, username, booking_date, booking_day):
+    """Queue user_id for the next table freed in office_id on booking_day and return their position in the queue.
+    A user waits in one office per day; joining again keeps the existing entry."""
+    execute_db_query(database_path, """
+        INSERT INTO waitlist (office_id, user_id, username, booking_date, booking_day) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, booking_day) DO NOTHING
+    """, (office_id, str(user_id), username, booking_date, booking_day))
+    return execute_db_query(database_path, """
+        SELECT COUNT(*) FROM waitlist AS w
+        JOIN waitlist AS own ON own.user_id = ? AND own.booking_day = ?
+        WHERE w.office_id = own.office_id AND w.booking_day = own.booking_day AND w.id <= own.id
+    """, (str(user_id), booking_day), fetch_one=True)[0]
+
+def waitlist_candidates(database_path, office_id, booking_day, limit):
+    """The first `limit` users waiting for a table in office_id on booking_day, as
+    (waitlist_id, user_id, username, booking_date) in queue order."""
+    return execute_db_query(database_path, """
+        SELECT id, user_id, username, booking_date FROM waitlist WHERE office_id = ? AND booking_day = ? ORDER BY id LIMIT ?
+    """, (office_id, booking_day, limit), fetch_all=True)
+
+def remove_from_waitlist(database_path, waitlist_id):
+    execute_db_query(database_path, "DELETE FROM waitlist WHERE id = ?", (waitlist_id,))
+
+# Columns copied into bookings_archive, which has the same layout as bookings
+ARCHIVE_COLUMNS = ('id', 'office_id', 'user_id', 'username', 'booking_date', 'table_id', 'booking_day', 'series_id')
+
+def archive_bookings(database_path, office_id, before_day, limit):
+    """Move at most `limit` of office_id's bookings dated before before_day into bookings_archive.
+    Archived bookings stay counted in the summaries. Returns how many were moved."""
+    columns = ', '.join(ARCHIVE_COLUMNS)
+    with transaction(database_path) as conn:
+        ids = [row[0] for row in conn.execute("SELECT id FROM bookings WHERE office_id = ? AND booking_day < ? ORDER BY booking_day LIMIT ?",
+                                              (office_id, before_day, limit))]
+        if not ids:
+            return 0
+        placeholders = ', '.join('?' * len(ids))
+        conn.execute(f"INSERT OR REPLACE INTO bookings_archive ({columns}) SELECT {columns} FROM bookings WHERE id IN ({placeholders})", ids)
+        conn.execute(f"DELETE FROM bookings WHERE id IN ({placeholders})", ids)
+        return len(ids)
+
+def delete_user(database_path, user_id, today):
+    """Remove user_id from a database that holds both users and bookings, in one transaction. Bookings reference
+    the user, so they go first: upcoming ones (from today) are cancelled and past ones moved to bookings_archive,
+    which keeps them in the history and the summaries under their stored name. Series and waitlist entries are
+    removed with the user by their ON DELETE CASCADE. Returns the CancelledBooking list, or None if there is no
+    such user."""
+    user_id = str(user_id)
+    columns = ', '.join(ARCHIVE_COLUMNS)
+    with transaction(database_path) as conn:
+        if not conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone():
+            return None
+        rows = conn.execute("SELECT id, user_id, booking_day, table_id, office_id FROM bookings WHERE user_id = ? AND booking_day >= ?",
+                            (user_id, today)).fetchall()
+        conn.execute("DELETE FROM bookings WHERE user_id = ? AND booking_day >= ?", (user_id, today))
+        conn.execute(f"INSERT OR REPLACE INTO bookings_archive ({columns}) SELECT {columns} FROM bookings WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM bookings WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        cancelled = [CancelledBooking(*row) for row in rows]
+        count_bookings(conn, [(booking.office_id, booking.user_id, booking.booking_day, booking.table_id) for booking in cancelled], -1)
+        return cancelled
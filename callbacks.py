@@ -0,0 +1,45 @@
+from collections import namedtuple
+from datetime import date
+
+# callback_data of the booking flow buttons carries everything the tap needs, so nothing about a user's progress is
+# kept between updates: '<version><action>:<office key>:<date ordinal>[:<table or page>]', e.g. '1t:main:740000:12'.
+# The version changes whenever the layout does; buttons of another version are answered as expired
+VERSION = '1'
+DATE = 'd'
+TABLE = 't'
+PAGE = 'p'
+PLAN = 'm'
+WAITLIST = 'w'
+PATTERN = f'^{VERSION}[{DATE}{TABLE}{PAGE}{PLAN}{WAITLIST}]:'
+# Actions whose payload ends in a table or page number; the others never carry one
+NUMBERED = (TABLE, PAGE, PLAN)
+# Booking flow buttons from before callback_data was versioned
+LEGACY_PATTERN = '^(date_|table_|tpage_|plan_|waitlist_)'
+# Telegram rejects callback_data longer than this
+MAX_CALLBACK_DATA = 64
+
+# day is a datetime.date; number is the table id for TABLE, the picker page for PAGE and PLAN, and None otherwise
+BookingCallback = namedtuple('BookingCallback', ['action', 'office_id', 'day', 'number'])
+
+def encode(action, office_id, day, number=None):
+    """callback_data for a booking flow button; day is a datetime.date or an ISO date string."""
+    if isinstance(day, str):
+        day = date.fromisoformat(day)
+    data = f'{VERSION}{action}:{office_id}:{day.toordinal()}' + (f':{number}' if number is not None else '')
+    if len(data.encode('utf-8')) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data {data!r} exceeds {MAX_CALLBACK_DATA} bytes")
+    return data
+
+def decode(data):
+    """The BookingCallback in data, or None if it isn't a well-formed booking flow payload of this version."""
+    parts = data.split(':')
+    if len(parts) not in (3, 4) or len(parts[0]) != 2 or parts[0][0] != VERSION:
+        return None
+    if parts[0][1] not in (DATE, WAITLIST) + NUMBERED or (len(parts) == 4) != (parts[0][1] in NUMBERED):
+        return None
+    try:
+        day = date.fromordinal(int(parts[2]))
+        number = int(parts[3]) if len(parts) == 4 else None
+    except (ValueError, OverflowError):
+        return None
+    return BookingCallback(parts[0][1], parts[1], day, number)
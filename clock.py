@@ -0,0 +1,23 @@
+from datetime import datetime
+import pytz
+
+class Clock:
+    """The bot's notion of now and today, in the configured TIMEZONE.
+
+    Which days are bookable, what counts as past, when reminders go out and which waitlist entries have expired
+    all follow from "today", so handlers, keyboards and background jobs read it from one Clock instead of mixing
+    the server's local time with the configured zone."""
+
+    def __init__(self, timezone):
+        self.timezone = pytz.timezone(timezone)
+
+    def now(self):
+        return datetime.now(self.timezone)
+
+    def today(self):
+        """Today's date in TIMEZONE."""
+        return self.now().date()
+
+    def today_iso(self):
+        """Today as an ISO booking_day, YYYY-MM-DD."""
+        return self.today().isoformat()
@@ -0,0 +1,120 @@
+import sqlite3
+import threading
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Connection tuning. WAL lets readers run alongside the single writer, NORMAL sync is safe under WAL,
+# and a bigger page cache/mmap window keeps the hot part of the bookings table in memory
+BUSY_TIMEOUT_SECONDS = 10
+STATEMENT_CACHE_SIZE = 256
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=67108864",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+
+# One long-lived connection per (thread, database). The dispatcher runs a fixed pool of worker threads,
+# so this is effectively a bounded pool without any locking on the hot path. Only the owning thread uses a
+# connection; they are opened with check_same_thread=False just so close_all_connections can close them on shutdown
+_local = threading.local()
+_all_connections = []
+_all_connections_lock = threading.Lock()
+
+# Callables invoked with the elapsed seconds of every query, or of every transaction block as a whole
+_query_observers = []
+
+def add_query_observer(callback):
+    """Register callback(seconds) to be told how long each database round trip took."""
+    _query_observers.append(callback)
+
+def _observe(started):
+    if _query_observers:
+        elapsed = time.perf_counter() - started
+        for callback in _query_observers:
+            callback(elapsed)
+
+def _connect(connections, database_path):
+    conn = sqlite3.connect(database_path, timeout=BUSY_TIMEOUT_SECONDS, cached_statements=STATEMENT_CACHE_SIZE,
+                           check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    with _all_connections_lock:
+        _all_connections.append((connections, database_path, conn))
+    return conn
+
+def get_connection(database_path):
+    """Return this thread's connection to database_path, opening it on first use."""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(database_path)
+    if conn is None:
+        conn = connections[database_path] = _connect(connections, database_path)
+    return conn
+
+def _in_explicit_transaction(database_path):
+    return database_path in getattr(_local, 'transactions', ())
+
+@contextmanager
+def transaction(database_path):
+    """Run several statements as one write transaction. The write lock is taken up front (BEGIN IMMEDIATE),
+    so a read-check-write sequence inside the block cannot interleave with another writer."""
+    conn = get_connection(database_path)
+    if _in_explicit_transaction(database_path):
+        # Nested use joins the outer transaction
+        yield conn
+        return
+    if not hasattr(_local, 'transactions'):
+        _local.transactions = set()
+    started = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE")
+    _local.transactions.add(database_path)
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        _local.transactions.discard(database_path)
+        _observe(started)
+
+def execute_db_query(database_path, query, parameters=(), fetch_one=False, fetch_all=False):
+    conn = get_connection(database_path)
+    started = time.perf_counter()
+    try:
+        cursor = conn.execute(query, parameters)
+        if fetch_one:
+            result = cursor.fetchone()
+        elif fetch_all:
+            result = cursor.fetchall()
+        else:
+            result = None
+        # sqlite3 only opens a transaction for writes, so plain SELECTs skip the commit entirely
+        if conn.in_transaction and not _in_explicit_transaction(database_path):
+            conn.commit()
+        return result
+    except sqlite3.Error as e:
+        logger.error(f"Database error: {e}")
+        if conn.in_transaction and not _in_explicit_transaction(database_path):
+            conn.rollback()
+        raise
+    finally:
+        # Queries inside a transaction block are timed as part of the block
+        if not _in_explicit_transaction(database_path):
+            _observe(started)
+
+def close_all_connections():
+    """Close every connection opened by any thread. Call once on shutdown, after the threads using them stopped."""
+    with _all_connections_lock:
+        for connections, database_path, conn in _all_connections:
+            # A thread that queries again afterwards opens a fresh connection
+            connections.pop(database_path, None)
+            conn.close()
+        _all_connections.clear()
@@ -0,0 +1,126 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from telegram.error import BadRequest
+from db import execute_db_query
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:  # Pillow is optional: without it the plain floor plan is sent, without availability marks
+    Image = ImageDraw = None
+
+logger = logging.getLogger(__name__)
+
+# image is a path relative to the repository (e.g. assets/images/r103.png); positions maps table_id to the (x, y)
+# pixel where the table is drawn on it, and may be empty
+FloorPlan = namedtuple('FloorPlan', ['image', 'positions'])
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Rendered overlays kept by file_id; one per distinct set of booked tables on a plan
+MAX_OVERLAYS = 256
+FREE_COLOR = (46, 160, 67, 200)
+BOOKED_COLOR = (215, 58, 73, 200)
+
+class FloorPlanImages:
+    """Sends floor plans as photos, uploading each image to Telegram only once.
+
+    A plain plan is uploaded the first time it is requested and the file_id Telegram returns is stored in the
+    telegram_files table, keyed by the image path and a digest of its contents, so later requests and restarts
+    send the file_id instead of the file. Plans with table positions get an overlay marking every table free or
+    booked; each rendered overlay is cached by file_id for its set of booked tables, so it is drawn and uploaded
+    again only after a booking or cancellation changes that set."""
+
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self._file_ids = {}
+        self._digests = {}
+        self._bases = {}
+        self._overlays = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _path(image):
+        return image if os.path.isabs(image) else os.path.join(BASE_DIR, image)
+
+    def _asset_key(self, image):
+        digest = self._digests.get(image)
+        if digest is None:
+            with open(self._path(image), 'rb') as f:
+                digest = self._digests[image] = hashlib.sha1(f.read()).hexdigest()
+        return f'asset:{image}:{digest}'
+
+    def _stored_file_id(self, key):
+        file_id = self._file_ids.get(key)
+        if file_id is None:
+            row = execute_db_query(self.database_path, "SELECT file_id FROM telegram_files WHERE key = ?", (key,), fetch_one=True)
+            if row:
+                file_id = self._file_ids[key] = row[0]
+        return file_id
+
+    def _store_file_id(self, key, file_id):
+        self._file_ids[key] = file_id
+        execute_db_query(self.database_path, """
+            INSERT INTO telegram_files (key, file_id) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET file_id = excluded.file_id
+        """, (key, file_id))
+
+    def _forget_file_id(self, key):
+        self._file_ids.pop(key, None)
+        execute_db_query(self.database_path, "DELETE FROM telegram_files WHERE key = ?", (key,))
+
+    def send_plan(self, bot, chat_id, plan, caption):
+        """Send the plain floor plan."""
+        key = self._asset_key(plan.image)
+        file_id = self._stored_file_id(key)
+        if file_id is not None:
+            try:
+                return bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+            except BadRequest as e:
+                # file_ids belong to the bot that uploaded them; after a token change the file is uploaded again
+                logger.warning(f"Stored file_id for {plan.image} was rejected, uploading it again: {e}")
+                self._forget_file_id(key)
+        with open(self._path(plan.image), 'rb') as f:
+            message = bot.send_photo(chat_id=chat_id, photo=f, caption=caption)
+        self._store_file_id(key, message.photo[-1].file_id)
+        logger.info(f"Uploaded floor plan {plan.image}")
+        return message
+
+    def send_availability(self, bot, chat_id, plan, booked_tables, caption):
+        """Send the floor plan with each positioned table marked free or booked. booked_tables is indexed by
+        table_id, as returned by AvailabilityIndex.booked_tables. Falls back to the plain plan without Pillow."""
+        if not plan.positions or Image is None:
+            return self.send_plan(bot, chat_id, plan, caption)
+        key = (self._asset_key(plan.image), tuple(sorted(table_id for table_id in plan.positions if booked_tables[table_id])))
+        with self._lock:
+            file_id = self._overlays.get(key)
+            if file_id is not None:
+                self._overlays.move_to_end(key)
+        if file_id is not None:
+            return bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+
+        message = bot.send_photo(chat_id=chat_id, photo=self._render(plan, booked_tables), caption=caption)
+        with self._lock:
+            self._overlays[key] = message.photo[-1].file_id
+            while len(self._overlays) > MAX_OVERLAYS:
+                self._overlays.popitem(last=False)
+        return message
+
+    def _render(self, plan, booked_tables):
+        base = self._bases.get(plan.image)
+        if base is None:
+            base = self._bases[plan.image] = Image.open(self._path(plan.image)).convert('RGBA')
+        overlay = Image.new('RGBA', base.size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(overlay)
+        radius = max(base.size) // 50
+        for table_id, (x, y) in plan.positions.items():
+            color = BOOKED_COLOR if booked_tables[table_id] else FREE_COLOR
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color, outline=(255, 255, 255, 255), width=2)
+            draw.text((x, y), str(table_id), fill=(255, 255, 255, 255), anchor='mm')
+        output = io.BytesIO()
+        Image.alpha_composite(base, overlay).convert('RGB').save(output, format='PNG')
+        output.seek(0)
+        output.name = 'floor-plan.png'
+        return output
@@ -0,0 +1,155 @@
+import logging
+from datetime import time, timedelta
+from bookings import BookingOutcome, book_table, waitlist_candidates, remove_from_waitlist, archive_bookings
+from db import execute_db_query
+
+logger = logging.getLogger(__name__)
+
+# Reminders queued per batch, so a day's bookings are read a slice at a time rather than all at once
+REMINDER_BATCH_SIZE = 20
+REMINDER_BATCH_INTERVAL = 1.0
+# Waiters tried per promotion run; waiters who meanwhile booked elsewhere are skipped and dropped
+WAITLIST_BATCH_SIZE = 10
+# Bookings moved to bookings_archive per cleanup run
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_INTERVAL = 3600
+
+class BackgroundJobs:
+    """Reminders, waitlist promotion and cleanup of old bookings, scheduled on the Updater's JobQueue.
+
+    Every run does a bounded amount of work and leaves the rest to its next run: reminders go out in batches of
+    REMINDER_BATCH_SIZE, a freed table is offered to at most WAITLIST_BATCH_SIZE waiters per run, and cleanup moves
+    at most ARCHIVE_BATCH_SIZE bookings per transaction. Interactive handlers therefore never wait long on the
+    database write lock held by a job."""
+
+    def __init__(self, database_path, offices, outbox, bookable_days, clock, reminder_time=None, archive_after_days=365,
+                 backups=None, backup_time=None, users=None):
+        self.database_path = database_path
+        # Office by key; each run works through one office at a time
+        self.offices = offices
+        # Notifications go through the outbound queue, which keeps them within Telegram's flood limits
+        self.outbox = outbox
+        # Callable returning the ISO days the booking pickers currently offer
+        self.bookable_days = bookable_days
+        # Today and the schedules' time zone come from the same Clock as the handlers'
+        self.clock = clock
+        self.timezone = clock.timezone
+        self.reminder_time = reminder_time
+        self.archive_after_days = archive_after_days
+        # Backups taken daily at backup_time (HH:MM), if both are set
+        self.backups = backups
+        self.backup_time = backup_time
+        # UserCache consulted before a waiter gets a table, since they may have been removed or blacklisted since
+        # they joined; with two databases no foreign key removes their waitlist entries
+        self.users = users
+
+    def schedule(self, job_queue):
+        if self.reminder_time:
+            hour, minute = (int(part) for part in self.reminder_time.split(':'))
+            job_queue.run_daily(self.start_reminders, time(hour, minute, tzinfo=self.timezone), days=(0, 1, 2, 3, 4),
+                                name='reminders')
+        # Drop days that have passed from the availability index and load the one that became bookable
+        job_queue.run_daily(self.roll_over, time(0, 1, tzinfo=self.timezone), name='roll-over')
+        job_queue.run_repeating(self.clean_up, ARCHIVE_INTERVAL, first=60, name='clean-up')
+        if self.backups and self.backup_time:
+            hour, minute = (int(part) for part in self.backup_time.split(':'))
+            job_queue.run_daily(self.back_up, time(hour, minute, tzinfo=self.timezone), name='backup')
+
+    def _today(self):
+        return self.clock.today_iso()
+
+    # Reminders
+    def start_reminders(self, context):
+        for office in self.offices.values():
+            context.job_queue.run_repeating(self.send_reminder_batch, REMINDER_BATCH_INTERVAL, first=0,
+                                            context={'office': office, 'day': self._today(), 'after_table': 0, 'sent': 0},
+                                            name=f'reminder-batch-{office.key}')
+
+    def send_reminder_batch(self, context):
+        state = context.job.context
+        office = state['office']
+        try:
+            bookings = execute_db_query(self.database_path, """
+                SELECT table_id, user_id, booking_date FROM bookings
+                WHERE office_id = ? AND booking_day = ? AND table_id > ? ORDER BY table_id LIMIT ?
+            """, (office.key, state['day'], state['after_table'], REMINDER_BATCH_SIZE), fetch_all=True)
+        except Exception as e:
+            logger.error(f"Error loading reminders for {office.key} on {state['day']}: {e}")
+            context.job.schedule_removal()
+            return
+
+        where = f" at {office.name}" if len(self.offices) > 1 else ""
+        for table_id, user_id, booking_date in bookings:
+            self.outbox.send_message(user_id, f"Reminder: you have Table {table_id}{where} today ({booking_date}).")
+            state['after_table'] = table_id
+        state['sent'] += len(bookings)
+
+        if len(bookings) < REMINDER_BATCH_SIZE:
+            context.job.schedule_removal()
+            logger.info(f"Queued {state['sent']} booking reminders for {office.key} on {state['day']}")
+
+    # Waitlist
+    def queue_promotion(self, job_queue, office_id, booking_day, table_id):
+        """Offer a table freed in office_id on booking_day to the waitlist, outside the handler that freed it."""
+        if job_queue is not None and office_id in self.offices:
+            job_queue.run_once(self.promote_waitlist, 0, context=(self.offices[office_id], booking_day, table_id), name='waitlist')
+
+    def promote_waitlist(self, context):
+        office, booking_day, table_id = context.job.context
+        if booking_day < self._today():
+            return
+        try:
+            waiters = waitlist_candidates(self.database_path, office.key, booking_day, WAITLIST_BATCH_SIZE)
+            for waitlist_id, user_id, username, booking_date in waiters:
+                if self.users is not None:
+                    user = self.users.get(user_id)
+                    if user is None or user.is_blacklisted:
+                        remove_from_waitlist(self.database_path, waitlist_id)
+                        logger.info(f"Dropped user {user_id} from the waitlist of {office.key} on {booking_day}: no longer allowed to book")
+                        continue
+                result = book_table(self.database_path, office.key, user_id, username, booking_date, booking_day, table_id)
+                if result.outcome is BookingOutcome.TABLE_TAKEN:
+                    # Someone booked the table before the waitlist got to it; the waiters keep their place
+                    office.availability.reload(booking_day)
+                    return
+                remove_from_waitlist(self.database_path, waitlist_id)
+                if result.outcome is BookingOutcome.BOOKED:
+                    office.availability.mark_booked(booking_day, table_id, user_id, username)
+                    logger.info(f"Assigned freed Table {table_id} in {office.key} on {booking_day} to waiting user {user_id}")
+                    self.outbox.send_message(user_id, f"Table {table_id} was freed for {booking_date} and is now booked for you. "
+                                                      f"Use /cancel if you no longer need it.")
+                    return
+            if len(waiters) == WAITLIST_BATCH_SIZE:
+                # Every waiter in this batch had booked another table meanwhile or was dropped; try the next batch on a later run
+                self.queue_promotion(context.job_queue, office.key, booking_day, table_id)
+        except Exception as e:
+            logger.error(f"Error promoting the waitlist for Table {table_id} in {office.key} on {booking_day}: {e}")
+
+    # Housekeeping
+    def roll_over(self, context):
+        try:
+            days = self.bookable_days()
+            for office in self.offices.values():
+                office.availability.warm(days)
+        except Exception as e:
+            logger.error(f"Error refreshing the availability index: {e}")
+
+    def back_up(self, context):
+        try:
+            self.backups.run()
+        except Exception as e:
+            logger.error(f"Scheduled backup failed: {e}")
+
+    def clean_up(self, context):
+        today = self._today()
+        try:
+            execute_db_query(self.database_path, "DELETE FROM waitlist WHERE id IN (SELECT id FROM waitlist WHERE booking_day < ? LIMIT ?)",
+                             (today, ARCHIVE_BATCH_SIZE))
+            if self.archive_after_days:
+                cutoff = (self.clock.today() - timedelta(days=self.archive_after_days)).isoformat()
+                for office in self.offices.values():
+                    archived = archive_bookings(self.database_path, office.key, cutoff, ARCHIVE_BATCH_SIZE)
+                    if archived:
+                        logger.info(f"Archived {archived} bookings of {office.key} from before {cutoff}")
+        except Exception as e:
+            logger.error(f"Error cleaning up old bookings: {e}")
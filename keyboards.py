@@ -0,0 +1,118 @@
+from datetime import date, timedelta
+from functools import lru_cache
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import callbacks
+
+# Telegram accepts at most 100 buttons per inline keyboard and 8 per row, so large grids are split into pages. Besides its tables a
+# page can carry Prev/Next, Floor plan and Join waitlist buttons, which bounds the page size
+MAX_KEYBOARD_BUTTONS = 100
+MAX_ROW_BUTTONS = 8
+GRID_EXTRA_BUTTONS = 4
+MAX_GRID_PAGE_SIZE = MAX_KEYBOARD_BUTTONS - GRID_EXTRA_BUTTONS
+GRID_COLUMNS = 3
+GRID_PAGE_SIZE = 60
+BOOKABLE_DAYS = 5
+# How booking dates are shown and stored in bookings.booking_date
+DATE_FORMAT = '%d.%m.%Y (%a)'
+
+def display_date(day):
+    """day in display form, such as '16.10.2026 (Fri)'."""
+    return day.strftime(DATE_FORMAT)
+
+@lru_cache(maxsize=4)
+def bookable_days(today):
+    """The next BOOKABLE_DAYS working days from today on, as dates."""
+    days = []
+    current_date = today
+    while len(days) < BOOKABLE_DAYS:
+        if current_date.weekday() < 5:  # 0-4 corresponds to Monday-Friday
+            days.append(current_date)
+        current_date += timedelta(days=1)
+    return tuple(days)
+
+@lru_cache(maxsize=4)
+def bookable_dates(today):
+    """The next BOOKABLE_DAYS working days from today on, in display form."""
+    return tuple(display_date(day) for day in bookable_days(today))
+
+class KeyboardCache:
+    """Date and table pickers, built once and reused until what they show changes.
+
+    The date picker is rebuilt when the calendar day changes. A table grid page is kept with the availability
+    version of its day and rebuilt only after a booking or cancellation on that day. Grids are laid out in
+    `columns` buttons per row; every floor starts a new page and floors with more than `page_size` tables are
+    split over several, with Prev/Next buttons between pages. Every button carries the office, the day and the
+    table or page in its callback_data, see callbacks. today is a callable returning today's date, see clock."""
+
+    def __init__(self, availability, floors, columns=GRID_COLUMNS, page_size=GRID_PAGE_SIZE, today=date.today):
+        if not 1 <= columns <= MAX_ROW_BUTTONS:
+            raise ValueError(f"TABLE_GRID_COLUMNS must be between 1 and {MAX_ROW_BUTTONS}: Telegram allows "
+                             f"{MAX_ROW_BUTTONS} buttons per keyboard row")
+        if not 1 <= page_size <= MAX_GRID_PAGE_SIZE:
+            raise ValueError(f"TABLE_GRID_PAGE_SIZE must be between 1 and {MAX_GRID_PAGE_SIZE}: Telegram allows "
+                             f"{MAX_KEYBOARD_BUTTONS} buttons per message, {GRID_EXTRA_BUTTONS} of them for navigation")
+        self.availability = availability
+        self.today = today
+        self.office_id = availability.office_id
+        self.columns = columns
+        self.page_size = page_size
+        # (floor, first table, last table) per page
+        self._pages = [(floor, first, min(first + page_size - 1, floor.last_table))
+                       for floor in floors for first in range(floor.first_table, floor.last_table + 1, page_size)]
+        self.pages = len(self._pages)
+        self._today = None
+        self._date_picker = None
+        # (booking_day, page) -> (availability version, markup)
+        self._grids = {}
+
+    def _roll_over(self):
+        today = self.today()
+        if today != self._today:
+            self._date_picker = InlineKeyboardMarkup(
+                [[InlineKeyboardButton(display_date(day), callback_data=callbacks.encode(callbacks.DATE, self.office_id, day))]
+                 for day in bookable_days(today)])
+            # Grids of days that have passed are never shown again
+            first_day = today.strftime('%Y-%m-%d')
+            self._grids = {key: grid for key, grid in self._grids.items() if key[0] >= first_day}
+            self._today = today
+
+    def date_picker(self):
+        self._roll_over()
+        return self._date_picker
+
+    def floor(self, page):
+        """The Floor shown on page; its name is None for an office without named floors."""
+        return self._pages[min(max(page, 0), self.pages - 1)][0]
+
+    def table_grid(self, booking_day, page=0):
+        """The picker for one page of tables on booking_day, marking the booked ones."""
+        self._roll_over()
+        page = min(max(page, 0), self.pages - 1)
+        # Read the version before the tables, so a change in between is picked up on the next call
+        version = self.availability.version(booking_day)
+        cached = self._grids.get((booking_day, page))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        booked_tables = self.availability.booked_tables(booking_day)
+        floor, first, last = self._pages[page]
+        buttons = [InlineKeyboardButton(("🚫 " if booked_tables[i] else "✅ ") + f"Table {i}",
+                                        callback_data=callbacks.encode(callbacks.TABLE, self.office_id, booking_day, i))
+                   for i in range(first, last + 1)]
+        keyboard = [buttons[i:i + self.columns] for i in range(0, len(buttons), self.columns)]
+        if self.pages > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton("« Prev", callback_data=callbacks.encode(callbacks.PAGE, self.office_id, booking_day, page - 1)))
+            if page < self.pages - 1:
+                navigation.append(InlineKeyboardButton("Next »", callback_data=callbacks.encode(callbacks.PAGE, self.office_id, booking_day, page + 1)))
+            keyboard.append(navigation)
+        if floor.plan:
+            keyboard.append([InlineKeyboardButton("🗺 Floor plan", callback_data=callbacks.encode(callbacks.PLAN, self.office_id, booking_day, page))])
+        # When every table is taken, offer to wait for one to be freed instead
+        if all(booked_tables[1:]):
+            keyboard.append([InlineKeyboardButton("Join waitlist", callback_data=callbacks.encode(callbacks.WAITLIST, self.office_id, booking_day))])
+
+        markup = InlineKeyboardMarkup(keyboard)
+        self._grids[(booking_day, page)] = (version, markup)
+        return markup
@@ -0,0 +1,103 @@
+import atexit
+import json
+import logging
+import queue
+import threading
+from datetime import datetime, timezone as fixed_timezone
+from logging.handlers import QueueHandler, QueueListener
+import pytz
+
+# UTC offsets only change on DST transitions, which fall on quarter hours, so one lookup per window is enough
+OFFSET_WINDOW_SECONDS = 900
+# Extra fields carried into the JSON output, from the update being handled or from `extra=` on the log call
+FIELDS = ('user_id', 'command', 'duration_ms')
+
+_update = threading.local()
+
+def bind_update(user_id, command):
+    """Attach user_id and command to every record logged on this thread until unbind_update()."""
+    _update.fields = {'user_id': user_id, 'command': command}
+
+def unbind_update():
+    _update.fields = None
+
+class UpdateContextFilter(logging.Filter):
+    """Copies the fields bound to the current thread onto each record. Runs on the logging thread, before the
+    record is queued, since the binding is per thread."""
+
+    def filter(self, record):
+        fields = getattr(_update, 'fields', None)
+        if fields:
+            for name, value in fields.items():
+                if not hasattr(record, name):
+                    setattr(record, name, value)
+        return True
+
+class TimeZoneFormatter(logging.Formatter):
+    """Timestamps records in ISO 8601 in the LOG_TIMEZONE. The zone's UTC offset is looked up once per
+    OFFSET_WINDOW_SECONDS and reused as a fixed offset, instead of a pytz conversion per record."""
+
+    def __init__(self, fmt=None, datefmt=None, style='%', tz='UTC'):
+        super().__init__(fmt, datefmt, style)
+        self.tz = pytz.timezone(tz)
+        # (window number, fixed-offset tzinfo)
+        self._offset = (None, None)
+
+    def converter(self, timestamp):
+        window = int(timestamp // OFFSET_WINDOW_SECONDS)
+        cached_window, tzinfo = self._offset
+        if window != cached_window:
+            offset = datetime.fromtimestamp(window * OFFSET_WINDOW_SECONDS, self.tz).utcoffset()
+            tzinfo = fixed_timezone(offset)
+            self._offset = (window, tzinfo)
+        return datetime.fromtimestamp(timestamp, tzinfo)
+
+    def formatTime(self, record, datefmt=None):
+        dt = self.converter(record.created)
+        if datefmt:
+            return dt.strftime(datefmt)
+        return dt.isoformat()
+
+class JsonFormatter(TimeZoneFormatter):
+    """One JSON object per line: time, level, logger and message, plus any of FIELDS set on the record."""
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        for name in FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _LocalQueueHandler(QueueHandler):
+    # The listener runs in this process, so records are queued as they are: message arguments, the timestamp and
+    # any exception are formatted on the listener thread instead of the thread that logged them
+    def prepare(self, record):
+        return record
+
+def configure_logging(tz, json_output=False, queued=True, level=logging.INFO):
+    """Log every module through the root logger to stderr.
+
+    With queued, the root logger only puts records on a queue and a QueueListener thread formats and writes them,
+    so handlers never wait on the stream. The listener is flushed and stopped at exit. Returns the listener, or
+    None when writing directly."""
+    formatter = JsonFormatter(tz=tz) if json_output else TimeZoneFormatter(fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s', tz=tz)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    listener = None
+    if queued:
+        records = queue.SimpleQueue()
+        handler = _LocalQueueHandler(records)
+        listener = QueueListener(records, stream_handler)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        handler = stream_handler
+    handler.addFilter(UpdateContextFilter())
+    root_logger.addHandler(handler)
+    return listener
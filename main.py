@@ -1,45 +1,129 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, CallbackContext
 from datetime import datetime, timedelta
-import traceback
-import sqlite3
+import tempfile
+import io
 import logging
 import time
-import pytz
 import os
 import config
+from db import execute_db_query, get_connection, transaction, close_all_connections, add_query_observer
+from bookings import BookingOutcome, book_table, delete_booking, book_series, delete_series, join_waitlist, create_holders_view, delete_user, ARCHIVE_COLUMNS
+from stats import SCHEMA as STATS_SCHEMA, rebuild_stats, occupancy_report
+from user_cache import UserCache
+from webhook import check_secret_token, start_webhook
+from user_io import parse_users_file, import_users as import_user_rows, export_users as export_user_rows
+from booking_io import export_bookings as export_booking_rows, export_calendar
+from pager import KeysetPager, CALLBACK_PREFIX, pager_name
+from metrics import HandlerMetrics, TimedRequest, instrument_dispatcher, start_metrics_server, start_metrics_dump
+from jobs import BackgroundJobs
+from outbox import Outbox
+from keyboards import bookable_days, bookable_dates, display_date
+import callbacks
+from offices import load_offices
+from images import FloorPlanImages
+from logs import configure_logging
+from persistence import SQLitePersistence
+from backup import Backups, BackupError
+from clock import Clock
 
 # Use the configurations
 admin_user_id = config.ADMIN_USER_ID
 admin_username = config.ADMIN_USERNAME
-bookings_db_path = config.BOOKINGS_DB_PATH
-users_db_path = config.USERS_DB_PATH
-total_tables = config.TOTAL_TABLES
+# With DATABASE_PATH, users and bookings share one database and bookings reference users by foreign key. An
+# existing pair of BOOKINGS_DB_PATH and USERS_DB_PATH files is merged into it on the first start
+database_path = getattr(config, 'DATABASE_PATH', None)
+bookings_db_path = database_path or config.BOOKINGS_DB_PATH
+users_db_path = database_path or config.USERS_DB_PATH
+total_tables = getattr(config, 'TOTAL_TABLES', None)
 log_timezone = config.LOG_TIMEZONE
+# Optional: reload the user cache after this many seconds, for when the users database is edited outside the bot
+user_cache_ttl = getattr(config, 'USER_CACHE_TTL', None)
+# Size of the dispatcher's worker pool. Every handler runs on it, so this is how many updates are processed at once
+workers = getattr(config, 'WORKERS', 32)
+# Webhook mode is used instead of long polling when WEBHOOK_URL (the public HTTPS URL Telegram posts to) is set
+webhook_url = getattr(config, 'WEBHOOK_URL', None)
+webhook_listen = getattr(config, 'WEBHOOK_LISTEN', '0.0.0.0')
+webhook_port = getattr(config, 'WEBHOOK_PORT', 8443)
+webhook_path = getattr(config, 'WEBHOOK_PATH', 'telegram')
+webhook_secret_token = getattr(config, 'WEBHOOK_SECRET_TOKEN', None)
+webhook_max_connections = getattr(config, 'WEBHOOK_MAX_CONNECTIONS', 40)
+# Handler metrics: served for Prometheus on METRICS_PORT and/or written to METRICS_FILE every METRICS_DUMP_INTERVAL seconds
+metrics_port = getattr(config, 'METRICS_PORT', None)
+metrics_file = getattr(config, 'METRICS_FILE', None)
+metrics_dump_interval = getattr(config, 'METRICS_DUMP_INTERVAL', 60)
+# Updates slower than this many seconds are logged with their timing breakdown, and with sampled stacks if profiling is on
+slow_update_threshold = getattr(config, 'SLOW_UPDATE_THRESHOLD', None)
+profile_slow_updates = getattr(config, 'PROFILE_SLOW_UPDATES', False)
+# Background jobs: daily reminder time (HH:MM in TIMEZONE, None to disable) and age after which bookings are archived
+timezone = getattr(config, 'TIMEZONE', log_timezone)
+reminder_time = getattr(config, 'REMINDER_TIME', '08:30')
+archive_after_days = getattr(config, 'ARCHIVE_AFTER_DAYS', 365)
+# Send rates for queued notifications and broadcasts, in messages per second overall and per chat
+outbox_global_rate = getattr(config, 'OUTBOX_GLOBAL_RATE', 25)
+outbox_chat_rate = getattr(config, 'OUTBOX_CHAT_RATE', 1)
+# Layout of the table picker: buttons per row, and tables per page for large offices
+table_grid_columns = getattr(config, 'TABLE_GRID_COLUMNS', 3)
+table_grid_page_size = getattr(config, 'TABLE_GRID_PAGE_SIZE', 60)
+# Sites with their floors and desks, see load_offices. Without it there is a single office of TOTAL_TABLES desks
+offices_config = getattr(config, 'OFFICES', None)
+# Floor plan of the single office when OFFICES isn't set: {'image': path, 'positions': {table_id: (x, y)}}
+floor_plan = getattr(config, 'FLOOR_PLAN', None)
+# Keep context.user_data in the users database across restarts, written in batches every USER_STATE_FLUSH_INTERVAL seconds
+user_state_persistence = getattr(config, 'USER_STATE_PERSISTENCE', False)
+user_state_flush_interval = getattr(config, 'USER_STATE_FLUSH_INTERVAL', 5)
+# Online backups: snapshot directory, runs kept, and daily time (HH:MM in TIMEZONE, None for /backup only)
+backup_dir = getattr(config, 'BACKUP_DIR', os.path.join(os.path.dirname(os.path.abspath(bookings_db_path)), 'backups'))
+backup_keep = getattr(config, 'BACKUP_KEEP', 7)
+backup_time = getattr(config, 'BACKUP_TIME', '03:00')
+
+# Logging: written by a background thread unless LOG_QUEUE is off, optionally as JSON lines carrying the user,
+# command and duration of the update being handled, and with one line per handled update if LOG_UPDATES is on
+log_queue = getattr(config, 'LOG_QUEUE', True)
+log_json = getattr(config, 'LOG_JSON', False)
+log_updates = getattr(config, 'LOG_UPDATES', False)
+
+# Enable logging. The handler sits on the root logger so the helper modules (db, ...) log through it as well.
+# Timestamps are in LOG_TIMEZONE
+configure_logging(log_timezone, json_output=log_json, queued=log_queue)
+# The job queue's scheduler logs every job run at INFO
+logging.getLogger('apscheduler').setLevel(logging.WARNING)
 
-# Configure Time Zone for logging. This allows you change the logging time zone by updating the LOG_TIMEZONE variable in your config.py file
-class ConfigurableTimeZoneFormatter(logging.Formatter):
-    def __init__(self, fmt=None, datefmt=None, style='%', tz=log_timezone):
-        super().__init__(fmt, datefmt, style)
-        self.tz = pytz.timezone(tz)
+logger = logging.getLogger(__name__)
 
-    def converter(self, timestamp):
-        return datetime.fromtimestamp(timestamp, self.tz)
+# Today and now in TIMEZONE, for the handlers, the pickers and the background jobs alike
+clock = Clock(timezone)
 
-    def formatTime(self, record, datefmt=None):
-        dt = self.converter(record.created)
-        if datefmt:
-            return dt.strftime(datefmt)
-        return dt.isoformat()
+# Registration, admin and blacklist flags for every user, kept in memory for the authorization decorators
+user_cache = UserCache(users_db_path, ttl=user_cache_ttl)
 
-# Enable logging
-formatter = ConfigurableTimeZoneFormatter(fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler = logging.StreamHandler()
-handler.setFormatter(formatter)
+# Wall, database and Telegram API time per handler
+metrics = HandlerMetrics(slow_update_threshold=slow_update_threshold, profile_slow_updates=profile_slow_updates, log_updates=log_updates)
+add_query_observer(metrics.add_db_time)
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-logger.addHandler(handler)
+# Every office keeps in memory which of its tables are taken on each bookable day, so the table picker and booking
+# checks don't hit the database, and caches its date and table pickers until the day or the day's bookings change.
+# Users without a default office of their own book in the first one
+offices = load_offices(offices_config, total_tables, bookings_db_path, table_grid_columns, table_grid_page_size, floor_plan,
+                       today=clock.today)
+default_office = next(iter(offices.values()))
+
+# Floor plans are uploaded to Telegram once and resent by file_id
+floor_plans = FloorPlanImages(bookings_db_path)
+
+# Rate-limited queue for messages sent outside a reply: reminders, waitlist notifications and broadcasts
+outbox = Outbox(global_rate=outbox_global_rate, chat_rate=outbox_chat_rate)
+metrics.add_collector(outbox.render)
+
+# Compressed snapshots of the databases, taken without stopping the bot
+backups = Backups({'database': database_path} if database_path else {'bookings': bookings_db_path, 'users': users_db_path},
+                  backup_dir, keep=backup_keep)
+metrics.add_collector(backups.render)
+
+# Reminders, waitlist promotion, archiving and backups, run on the Updater's job queue
+background_jobs = BackgroundJobs(bookings_db_path, offices, outbox, lambda: [to_iso_date(date) for date in generate_dates()],
+                                 clock, reminder_time=reminder_time, archive_after_days=archive_after_days,
+                                 backups=backups, backup_time=backup_time, users=user_cache)
 
 # Ensure the 'data' directory for databases exists
 os.makedirs(os.path.dirname(bookings_db_path), exist_ok=True)
@@ -47,56 +131,261 @@ os.makedirs(os.path.dirname(users_db_path), exist_ok=True)
 
 # Function to initialize databases
 def initialize_databases():
+    migrate_single_database()
 # Initialize the bookings database
-    with sqlite3.connect(bookings_db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS bookings
+    execute_db_query(bookings_db_path, '''CREATE TABLE IF NOT EXISTS bookings
                            (id INTEGER PRIMARY KEY AUTOINCREMENT, 
                             user_id TEXT, username TEXT, 
-                            booking_date TEXT, table_id INTEGER)''')
-        conn.commit()
+                            booking_date TEXT, table_id INTEGER,
+                            booking_day DATE, office_id TEXT)''')
+    migrate_booking_day()
+    migrate_background_jobs()
+    migrate_stats()
 
 # Initialize the users database
-    with sqlite3.connect(users_db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
+    execute_db_query(users_db_path, '''
     CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT, 
         user_id TEXT UNIQUE, 
         username TEXT, 
         is_admin INTEGER DEFAULT 0, 
-        is_blacklisted INTEGER DEFAULT 0
+        is_blacklisted INTEGER DEFAULT 0,
+        office_id TEXT
     )
 ''')
-        # Insert admin record if not exists
-        cursor.execute('''
+    columns = [row[1] for row in execute_db_query(users_db_path, "PRAGMA table_info(users)", fetch_all=True)]
+    if 'office_id' not in columns:
+        execute_db_query(users_db_path, "ALTER TABLE users ADD COLUMN office_id TEXT")
+    # Per-user state for SQLitePersistence
+    execute_db_query(users_db_path, "CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+    # Insert admin record if not exists
+    execute_db_query(users_db_path, '''
     INSERT INTO users (user_id, username, is_admin, is_blacklisted)
     VALUES (?, ?, 1, 0)
     ON CONFLICT(user_id) DO NOTHING
 ''', (admin_user_id, admin_username))
+    if database_path:
+        migrate_foreign_keys()
+    create_holders_view(bookings_db_path, join_users=bool(database_path))
+
+# Number of rows updated per transaction while backfilling, so the migration never holds the write lock for long
+MIGRATION_BATCH_SIZE = 5000
+# booking_date values migrate_booking_day can convert: dd.mm.YYYY, followed by the weekday as in '16.10.2026 (Fri)'
+BOOKING_DATE_GLOB = '[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]*'
+
+def migrate_booking_day():
+    """Add and backfill the ISO booking_day column (YYYY-MM-DD) derived from the display booking_date, then index it.
+    Safe to run on every start: each step is a no-op once it has been applied."""
+    columns = [row[1] for row in execute_db_query(bookings_db_path, "PRAGMA table_info(bookings)", fetch_all=True)]
+    if 'booking_day' not in columns:
+        logger.info("Adding booking_day column to the bookings table")
+        execute_db_query(bookings_db_path, "ALTER TABLE bookings ADD COLUMN booking_day DATE")
+
+    # Only rows whose booking_date has the dd.mm.YYYY shape are converted. Every converted row leaves the
+    # booking_day IS NULL set, so the loop ends; rows that can't be converted are left NULL and stop
+    # migrate_unique_bookings
+    conn = get_connection(bookings_db_path)
+    backfilled = 0
+    while True:
+        cursor = conn.execute("""
+            UPDATE bookings
+            SET booking_day = SUBSTR(booking_date, 7, 4) || '-' || SUBSTR(booking_date, 4, 2) || '-' || SUBSTR(booking_date, 1, 2)
+            WHERE id IN (SELECT id FROM bookings WHERE booking_day IS NULL AND booking_date GLOB ? LIMIT ?)
+        """, (BOOKING_DATE_GLOB, MIGRATION_BATCH_SIZE))
         conn.commit()
-
-def execute_db_query(database_path, query, parameters=(), fetch_one=False, fetch_all=False):
-    try:
-        with sqlite3.connect(database_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, parameters)
-            conn.commit()
-
-            if fetch_one:
-                return cursor.fetchone()
-            if fetch_all:
-                return cursor.fetchall()
-    except sqlite3.Error as e:
-        logger.error(f"Database error: {e}")
-        raise
-
-def is_admin(user_id, users_db_path):
+        if cursor.rowcount <= 0:
+            break
+        backfilled += cursor.rowcount
+    if backfilled:
+        logger.info(f"Backfilled booking_day for {backfilled} bookings")
+
+    add_office_column('bookings')
+    migrate_unique_bookings()
+    migrate_booking_series()
+
+def add_office_column(table):
+    """Add office_id to a table of the bookings database and assign rows without one to the default office,
+    a range of MIGRATION_BATCH_SIZE ids per transaction."""
+    columns = [row[1] for row in execute_db_query(bookings_db_path, f"PRAGMA table_info({table})", fetch_all=True)]
+    if 'office_id' not in columns:
+        logger.info(f"Adding office_id column to the {table} table")
+        execute_db_query(bookings_db_path, f"ALTER TABLE {table} ADD COLUMN office_id TEXT")
+
+    first, last = execute_db_query(bookings_db_path, f"SELECT MIN(id), MAX(id) FROM {table} WHERE office_id IS NULL", fetch_one=True)
+    if first is None:
+        return
+    conn = get_connection(bookings_db_path)
+    for start in range(first, last + 1, MIGRATION_BATCH_SIZE):
+        conn.execute(f"UPDATE {table} SET office_id = ? WHERE id BETWEEN ? AND ? AND office_id IS NULL",
+                     (default_office.key, start, start + MIGRATION_BATCH_SIZE - 1))
+        conn.commit()
+    logger.info(f"Assigned existing rows of {table} to office {default_office.key}")
+
+def migrate_booking_series():
+    """Create the table for recurring bookings and link bookings to the series they were created by."""
+    execute_db_query(bookings_db_path, '''CREATE TABLE IF NOT EXISTS booking_series
+                           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            user_id TEXT, username TEXT, table_id INTEGER,
+                            weekdays TEXT, first_day DATE, last_day DATE, office_id TEXT)''')
+    add_office_column('booking_series')
+    execute_db_query(bookings_db_path, "CREATE INDEX IF NOT EXISTS idx_booking_series_user ON booking_series (user_id, last_day)")
+    columns = [row[1] for row in execute_db_query(bookings_db_path, "PRAGMA table_info(bookings)", fetch_all=True)]
+    if 'series_id' not in columns:
+        execute_db_query(bookings_db_path, "ALTER TABLE bookings ADD COLUMN series_id INTEGER")
+    execute_db_query(bookings_db_path, "CREATE INDEX IF NOT EXISTS idx_bookings_series ON bookings (series_id, booking_day) WHERE series_id IS NOT NULL")
+
+def migrate_background_jobs():
+    """Create the waitlist, the archive that old bookings are moved to by the cleanup job, and the store of
+    uploaded file_ids."""
+    execute_db_query(bookings_db_path, '''CREATE TABLE IF NOT EXISTS waitlist
+                           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            user_id TEXT, username TEXT,
+                            booking_date TEXT, booking_day DATE, office_id TEXT,
+                            UNIQUE (user_id, booking_day))''')
+    add_office_column('waitlist')
+    execute_db_query(bookings_db_path, "DROP INDEX IF EXISTS idx_waitlist_day")
+    execute_db_query(bookings_db_path, "CREATE INDEX IF NOT EXISTS idx_waitlist_office_day ON waitlist (office_id, booking_day, id)")
+    execute_db_query(bookings_db_path, '''CREATE TABLE IF NOT EXISTS bookings_archive
+                           (id INTEGER PRIMARY KEY,
+                            user_id TEXT, username TEXT,
+                            booking_date TEXT, table_id INTEGER,
+                            booking_day DATE, series_id INTEGER, office_id TEXT)''')
+    add_office_column('bookings_archive')
+    # Exports read the archive by office and day, and by user, alongside the matching unique indexes of bookings
+    execute_db_query(bookings_db_path, "CREATE INDEX IF NOT EXISTS idx_archive_office_day ON bookings_archive (office_id, booking_day, table_id)")
+    execute_db_query(bookings_db_path, "CREATE INDEX IF NOT EXISTS idx_archive_user_day ON bookings_archive (user_id, booking_day)")
+    # file_ids of images uploaded to Telegram, see FloorPlanImages
+    execute_db_query(bookings_db_path, "CREATE TABLE IF NOT EXISTS telegram_files (key TEXT PRIMARY KEY, file_id TEXT NOT NULL)")
+
+def migrate_single_database():
+    """Copy the tables of the two-file layout into DATABASE_PATH, once: a source is skipped when the database already
+    has any of its tables, including when DATABASE_PATH is the old bookings file itself. The old files are left in
+    place for the admin to remove."""
+    if not database_path:
+        return
+    conn = get_connection(database_path)
+    for source_path in (getattr(config, 'BOOKINGS_DB_PATH', None), getattr(config, 'USERS_DB_PATH', None)):
+        if not source_path or not os.path.exists(source_path) or os.path.abspath(source_path) == os.path.abspath(database_path):
+            continue
+        conn.execute("ATTACH DATABASE ? AS source", (source_path,))
+        try:
+            schema = conn.execute("""
+                SELECT type, name, sql FROM source.sqlite_master
+                WHERE type IN ('table', 'index') AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+            """).fetchall()
+            tables = [name for kind, name, _ in schema if kind == 'table']
+            placeholders = ', '.join('?' * len(tables))
+            if not tables or conn.execute(f"SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name IN ({placeholders})", tables).fetchone():
+                continue
+            logger.info(f"Merging {', '.join(tables)} from {source_path} into {database_path}")
+            with transaction(database_path):
+                for kind, name, sql in schema:
+                    if kind == 'table':
+                        conn.execute(sql)
+                        conn.execute(f"INSERT INTO main.{name} SELECT * FROM source.{name}")
+                # Indexes are built after the rows are in, and AUTOINCREMENT counters carry over so ids of removed
+                # and archived rows aren't handed out again
+                for kind, name, sql in schema:
+                    if kind == 'index':
+                        conn.execute(sql)
+                if conn.execute("SELECT 1 FROM source.sqlite_master WHERE name = 'sqlite_sequence'").fetchone():
+                    for name, seq in conn.execute("SELECT name, seq FROM source.sqlite_sequence").fetchall():
+                        conn.execute("DELETE FROM main.sqlite_sequence WHERE name = ?", (name,))
+                        conn.execute("INSERT INTO main.sqlite_sequence (name, seq) VALUES (?, ?)", (name, seq))
+        finally:
+            conn.execute("DETACH DATABASE source")
+
+# Tables of the single database whose user_id references users, with the definition they are rebuilt to
+FOREIGN_KEY_TABLES = {
+    'booking_series': """(id INTEGER PRIMARY KEY AUTOINCREMENT,
+                          user_id TEXT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE, username TEXT, table_id INTEGER,
+                          weekdays TEXT, first_day DATE, last_day DATE, office_id TEXT)""",
+    'bookings': """(id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL REFERENCES users (user_id), username TEXT,
+                    booking_date TEXT, table_id INTEGER,
+                    booking_day DATE, office_id TEXT,
+                    series_id INTEGER REFERENCES booking_series (id) ON DELETE SET NULL)""",
+    'waitlist': """(id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE, username TEXT,
+                    booking_date TEXT, booking_day DATE, office_id TEXT,
+                    UNIQUE (user_id, booking_day))""",
+}
+
+def migrate_foreign_keys():
+    """Rebuild the tables in FOREIGN_KEY_TABLES with their foreign keys, which SQLite can't add to an existing
+    table, in one transaction. Rows of users that no longer exist can't be kept: their bookings are moved to
+    bookings_archive, which has no foreign keys, and their series and waitlist entries are dropped. A no-op once
+    bookings has its foreign keys."""
+    conn = get_connection(database_path)
+    if conn.execute("PRAGMA foreign_key_list(bookings)").fetchall():
+        return
+    columns = ', '.join(ARCHIVE_COLUMNS)
+    orphaned = "user_id IS NULL OR user_id NOT IN (SELECT user_id FROM users)"
+    with transaction(database_path):
+        # The view over bookings would block the rename; initialize_databases creates it again afterwards
+        conn.execute("DROP VIEW IF EXISTS booking_holders")
+        archived = conn.execute(f"INSERT OR REPLACE INTO bookings_archive ({columns}) SELECT {columns} FROM bookings WHERE {orphaned}").rowcount
+        if archived:
+            logger.warning(f"Archiving {archived} bookings of users who are no longer registered")
+        conn.execute(f"DELETE FROM bookings WHERE {orphaned}")
+        conn.execute(f"DELETE FROM waitlist WHERE {orphaned}")
+        conn.execute(f"DELETE FROM booking_series WHERE {orphaned}")
+        conn.execute("UPDATE bookings SET series_id = NULL WHERE series_id NOT IN (SELECT id FROM booking_series)")
+        for table, definition in FOREIGN_KEY_TABLES.items():
+            indexes = [sql for (sql,) in conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+            sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+            table_columns = ', '.join(row[1] for row in conn.execute(f"PRAGMA table_info({table})"))
+            conn.execute(f"CREATE TABLE {table}_rebuilt {definition}")
+            conn.execute(f"INSERT INTO {table}_rebuilt ({table_columns}) SELECT {table_columns} FROM {table}")
+            conn.execute(f"DROP TABLE {table}")
+            conn.execute(f"ALTER TABLE {table}_rebuilt RENAME TO {table}")
+            for sql in indexes:
+                conn.execute(sql)
+            if sequence:
+                conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, sequence[0]))
+    logger.info("Added foreign keys from bookings, booking_series and waitlist to users")
+
+def migrate_stats():
+    """Create the summary tables behind /stats, and fill them from the existing bookings when they are new."""
+    existing = execute_db_query(bookings_db_path, "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_daily'", fetch_one=True)
+    for statement in STATS_SCHEMA:
+        execute_db_query(bookings_db_path, statement)
+    if not existing:
+        for office in offices.values():
+            counted = rebuild_stats(bookings_db_path, office.key)
+            if counted:
+                logger.info(f"Backfilled booking statistics of {office.key} from {counted} bookings")
+
+def migrate_unique_bookings():
+    """Enforce one booking per table per office and day, and one booking per user per day, with unique indexes.
+    Duplicates left behind by the old check-then-insert race are resolved in favour of the earliest booking.
+    The table index leads with office_id, so one office's bookings are looked up without touching another's.
+    Unique indexes never compare NULLs, so duplicates without a booking_day would slip past them: the bot refuses
+    to start until every booking has one."""
+    missing = execute_db_query(bookings_db_path, "SELECT COUNT(*) FROM bookings WHERE booking_day IS NULL", fetch_one=True)[0]
+    if missing:
+        raise RuntimeError(f"{missing} bookings have a booking_date that isn't dd.mm.YYYY, so no booking_day could be derived; "
+                           f"correct or delete them in {bookings_db_path} before starting the bot")
+    for columns in ("office_id, booking_day, table_id", "booking_day, user_id"):
+        removed = execute_db_query(bookings_db_path, f"""
+            SELECT COUNT(*) FROM bookings WHERE id NOT IN (SELECT MIN(id) FROM bookings GROUP BY {columns})
+        """, fetch_one=True)[0]
+        if removed:
+            logger.warning(f"Removing {removed} duplicate bookings on ({columns}) before adding the unique index")
+            execute_db_query(bookings_db_path, f"DELETE FROM bookings WHERE id NOT IN (SELECT MIN(id) FROM bookings GROUP BY {columns})")
+
+    # The unique indexes replace the plain ones with the same leading columns
+    execute_db_query(bookings_db_path, "DROP INDEX IF EXISTS idx_bookings_day_table")
+    execute_db_query(bookings_db_path, "DROP INDEX IF EXISTS idx_bookings_user_day")
+    execute_db_query(bookings_db_path, "DROP INDEX IF EXISTS uq_bookings_day_table")
+    execute_db_query(bookings_db_path, "CREATE UNIQUE INDEX IF NOT EXISTS uq_bookings_office_day_table ON bookings (office_id, booking_day, table_id)")
+    execute_db_query(bookings_db_path, "CREATE UNIQUE INDEX IF NOT EXISTS uq_bookings_user_day ON bookings (user_id, booking_day)")
+
+def is_admin(user_id):
     """Check if the user is an admin."""
-    query = "SELECT is_admin FROM users WHERE user_id = ?"
     try:
-        result = execute_db_query(users_db_path, query, (user_id,), fetch_one=True)
-        return result and result[0]
+        return user_cache.is_admin(user_id)
     except Exception as e:
         logger.error(f"Error checking admin status for user {user_id}: {e}")
         return False  # Default to non-admin in case of an error
@@ -104,8 +393,8 @@ def is_admin(user_id, users_db_path):
 def admin_required(func):
     def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
         user_id = str(update.effective_user.id)
-        logger.info(f"Admin command '{func.__name__}' invoked by {user_id}")
-        if not is_admin(user_id, users_db_path):
+        logger.info("Admin command '%s' invoked by %s", func.__name__, user_id)
+        if not is_admin(user_id):
             update.message.reply_text("You are not authorized to use this command.")
             return
         return func(update, context, *args, **kwargs)
@@ -114,16 +403,37 @@ def admin_required(func):
 def user_required(func):
     def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
         user_id = str(update.effective_user.id)
-        with sqlite3.connect(users_db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM users WHERE user_id = ?", (user_id,))
-            if not cursor.fetchone():
-                logger.info(f"Unregistered user with ID {user_id} invoked command '{func.__name__}'")
-                update.message.reply_text(f"You need to be registered to use this command. Please contact an admin: @{admin_username}.")
-                return
+        user = user_cache.get(user_id)
+        if not user:
+            logger.info("Unregistered user with ID %s invoked command '%s'", user_id, func.__name__)
+            update.message.reply_text(f"You need to be registered to use this command. Please contact an admin: @{admin_username}.")
+            return
+        if user.is_blacklisted:
+            logger.info("Blacklisted user with ID %s invoked command '%s'", user_id, func.__name__)
+            update.message.reply_text("You are blacklisted and cannot use this bot.")
+            return
         return func(update, context, *args, **kwargs)
     return wrapper
 
+def office_of(user_id):
+    """The user's default office."""
+    user = user_cache.get(user_id)
+    return offices.get(user.office_id if user else None, default_office)
+
+def office_label(office_id):
+    """' at <office name>' to tell offices apart in listings, or nothing when there is only one office."""
+    if len(offices) == 1:
+        return ""
+    office = offices.get(office_id)
+    return f" at {office.name if office else office_id}"
+
+def table_released(job_queue, cancelled):
+    """Update the office's availability after a CancelledBooking and offer the table to the office's waitlist."""
+    office = offices.get(cancelled.office_id)
+    if office:
+        office.availability.mark_cancelled(cancelled.booking_day, cancelled.table_id, cancelled.user_id)
+    background_jobs.queue_promotion(job_queue, cancelled.office_id, cancelled.booking_day, cancelled.table_id)
+
 @admin_required
 def manage_users(update: Update, context: CallbackContext) -> None:
     # User is an admin
@@ -134,7 +444,14 @@ def manage_users(update: Update, context: CallbackContext) -> None:
     message_text += "/remove_user [user_id] - Remove a user\n"
     message_text += "/revoke_admin [user_id] - Revoke admin status\n"
     message_text += "/view_users - View all users and their status\n"
+    message_text += "/import_users - Add or update users from an attached CSV/JSON file\n"
+    message_text += "/export_users [csv|json] - Download all users as a file\n"
     message_text += "/history - View all booking history for the past 2 weeks\n"
+    message_text += "/stats [months] - Occupancy by weekday and the busiest tables and users\n"
+    message_text += "/rebuild_stats - Recompute the statistics from all bookings\n"
+    message_text += "/export_bookings [from] [to] - Download the bookings of a date range as CSV\n"
+    message_text += "/backup - Back up the databases now\n"
+    message_text += "/restore [backup] - Restore the databases from a backup\n"
     message_text += "/cancel_booking - Cancel a booking by its id"
     
     update.message.reply_text(message_text)
@@ -150,6 +467,7 @@ def add_user(update: Update, context: CallbackContext) -> None:
     query = "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)"
     try:
         execute_db_query(users_db_path, query, (new_user_id, username))
+        user_cache.refresh_user(new_user_id)
         update.message.reply_text(f"User {username} added successfully.")
         logger.info(f"User added: {username} (ID: {new_user_id}) by Admin {update.effective_user.id}")
     except Exception as e:
@@ -166,7 +484,13 @@ def remove_user(update: Update, context: CallbackContext) -> None:
     remove_user_id = context.args[0]
     query = "DELETE FROM users WHERE user_id = ?"
     try:
-        execute_db_query(users_db_path, query, (remove_user_id,))
+        if database_path:
+            # Bookings reference the user: upcoming ones are cancelled, freeing the tables, and past ones archived
+            for cancelled in delete_user(database_path, remove_user_id, clock.today_iso()) or []:
+                table_released(context.job_queue, cancelled)
+        else:
+            execute_db_query(users_db_path, query, (remove_user_id,))
+        user_cache.refresh_user(remove_user_id)
         update.message.reply_text(f"User with ID {remove_user_id} removed successfully.")
         logger.info(f"User with ID {remove_user_id} removed successfully by Admin {update.effective_user.id}")
     except Exception as e:
@@ -184,6 +508,7 @@ def make_admin(update: Update, context: CallbackContext) -> None:
     query = "UPDATE users SET is_admin = 1 WHERE user_id = ?"
     try:
         execute_db_query(users_db_path, query, (user_id_to_admin,))
+        user_cache.refresh_user(user_id_to_admin)
         update.message.reply_text("User updated to admin successfully.")
         logger.info(f"User with ID {user_id_to_admin} made an admin successfully by Admin {update.effective_user.id}")
     except Exception as e:
@@ -201,6 +526,7 @@ def revoke_admin(update: Update, context: CallbackContext) -> None:
     query = "UPDATE users SET is_admin = 0 WHERE user_id = ?"
     try:
         execute_db_query(users_db_path, query, (user_id_to_revoke,))
+        user_cache.refresh_user(user_id_to_revoke)
         update.message.reply_text("Admin privileges revoked successfully.")
         logger.info(f"Admin privileges revoked from user with ID {user_id_to_revoke} by Admin {update.effective_user.id}")
     except Exception as e:
@@ -218,30 +544,197 @@ def blacklist_user(update: Update, context: CallbackContext) -> None:
     query = "UPDATE users SET is_blacklisted = 1 WHERE user_id = ?"
     try:
         execute_db_query(users_db_path, query, (user_id_to_blacklist,))
+        user_cache.refresh_user(user_id_to_blacklist)
         update.message.reply_text("User blacklisted successfully.")
         logger.info(f"User with ID {user_id_to_blacklist} blacklisted successfully by Admin {update.effective_user.id}")
     except Exception as e:
         logger.error(f"Error blacklisting user with ID {user_id_to_blacklist}: {e}")
         update.message.reply_text("Failed to blacklist user. Please try again later.")
 
+def format_users_page(users):
+    lines = []
+    for user in users:
+        status = "Admin" if user[3] else ("Blacklisted" if user[4] else "User")
+        username_display = f"@{user[2]}" if user[2] else "N/A"
+        lines.append(f"ID: {user[0]}, User ID: {user[1]}, Username: {username_display}, Status: {status}")
+    return "\n".join(lines)
+
+users_pager = KeysetPager(
+    'users', users_db_path,
+    "SELECT id, user_id, username, is_admin, is_blacklisted FROM users WHERE 1", lambda: (),
+    key_columns=('id',), key_types=(int,), format_page=format_users_page,
+    title="List of all users:\n\n", empty_text="No users found.")
+
 @admin_required
 def view_users(update: Update, context: CallbackContext) -> None:
-    query = "SELECT id, user_id, username, is_admin, is_blacklisted FROM users"
     try:
-        users = execute_db_query(users_db_path, query, fetch_all=True)
-
-        message_text = "List of all users:\n\n"
-        for user in users:
-            status = "Admin" if user[3] else ("Blacklisted" if user[4] else "User")
-            username_display = f"@{user[2]}" if user[2] else "N/A"
-            message_text += f"ID: {user[0]}, User ID: {user[1]}, Username: {username_display}, Status: {status}\n"
-
-        update.message.reply_text(message_text)
+        message_text, reply_markup = users_pager.render()
+        update.message.reply_text(message_text, reply_markup=reply_markup)
         logger.info(f"Admin {update.effective_user.id} viewed user list.")
     except Exception as e:
         logger.error(f"Error viewing users by Admin {update.effective_user.id}: {e}")
         update.message.reply_text("Failed to retrieve the user list. Please try again later.")
 
+# Largest user list accepted by /import_users
+MAX_IMPORT_FILE_SIZE = 5 * 1024 * 1024
+# Rejected rows listed in the /import_users report; the rest are only counted
+MAX_REPORTED_IMPORT_ERRORS = 20
+
+@admin_required
+def import_users(update: Update, context: CallbackContext) -> None:
+    # The file is either attached with /import_users as its caption, or the command replies to a message with the file
+    message = update.message
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if document is None:
+        message.reply_text("Usage: send a CSV or JSON file with the caption /import_users, or reply to one with /import_users.\n"
+                           "Columns: user_id (required), username, is_admin, is_blacklisted.")
+        return
+    if document.file_size and document.file_size > MAX_IMPORT_FILE_SIZE:
+        message.reply_text("The file is too large to import.")
+        return
+
+    try:
+        content = io.BytesIO()
+        context.bot.get_file(document.file_id).download(out=content)
+    except Exception as e:
+        logger.error(f"Error downloading user import from Admin {update.effective_user.id}: {e}")
+        message.reply_text("Failed to download the file. Please try again later.")
+        return
+
+    try:
+        columns, rows, errors = parse_users_file(content.getvalue(), document.file_name or '', protected_user_id=str(admin_user_id))
+    except ValueError as e:
+        message.reply_text(f"Could not read the file: {e}")
+        return
+
+    try:
+        imported = import_user_rows(users_db_path, columns, rows)
+        user_cache.load()
+    except Exception as e:
+        logger.error(f"Error importing users by Admin {update.effective_user.id}: {e}")
+        message.reply_text("Failed to import users. No changes were made.")
+        return
+
+    report = f"Imported {imported} users."
+    if errors:
+        report += f" {len(errors)} rows were skipped:\n" + "\n".join(errors[:MAX_REPORTED_IMPORT_ERRORS])
+        if len(errors) > MAX_REPORTED_IMPORT_ERRORS:
+            report += f"\n... and {len(errors) - MAX_REPORTED_IMPORT_ERRORS} more"
+    message.reply_text(report)
+    logger.info(f"Admin {update.effective_user.id} imported {imported} users ({len(errors)} rows skipped)")
+
+@admin_required
+def export_users(update: Update, context: CallbackContext) -> None:
+    file_format = context.args[0].lower() if context.args else 'csv'
+    if file_format not in ('csv', 'json'):
+        update.message.reply_text("Usage: /export_users [csv|json]")
+        return
+
+    try:
+        # Rows are streamed into a temporary file rather than built up as one string
+        with tempfile.TemporaryFile() as out:
+            count = export_user_rows(users_db_path, out, file_format)
+            out.seek(0)
+            update.message.reply_document(out, filename=f"users.{file_format}", caption=f"{count} users")
+        logger.info(f"Admin {update.effective_user.id} exported {count} users")
+    except Exception as e:
+        logger.error(f"Error exporting users by Admin {update.effective_user.id}: {e}")
+        update.message.reply_text("Failed to export users. Please try again later.")
+
+@admin_required
+def export_bookings(update: Update, context: CallbackContext) -> None:
+    """Send the bookings of the admin's office from [from] to [to] (YYYY-MM-DD, inclusive) as CSV, archived ones
+    included. By default the last 30 days and everything booked ahead."""
+    usage = "Usage: /export_bookings [from YYYY-MM-DD] [to YYYY-MM-DD]"
+    if len(context.args) > 2:
+        update.message.reply_text(usage)
+        return
+    try:
+        days = [datetime.strptime(arg, '%Y-%m-%d').strftime('%Y-%m-%d') for arg in context.args]
+    except ValueError:
+        update.message.reply_text(usage)
+        return
+    first_day = days[0] if days else (clock.today() - timedelta(days=30)).isoformat()
+    last_day = days[1] if len(days) > 1 else '9999-12-31'
+    office = office_of(update.effective_user.id)
+
+    try:
+        # Rows are streamed from the database into a temporary file rather than collected in memory
+        with tempfile.TemporaryFile() as out:
+            count = export_booking_rows(bookings_db_path, out, office.key, first_day, last_day)
+            out.seek(0)
+            update.message.reply_document(out, filename=f"bookings-{office.key}-{first_day}.csv",
+                                          caption=f"{count} bookings{office_label(office.key)} from {first_day}" +
+                                                  (f" to {last_day}" if len(days) > 1 else ""))
+        logger.info(f"Admin {update.effective_user.id} exported {count} bookings of {office.key} from {first_day} to {last_day}")
+    except Exception as e:
+        logger.error(f"Error exporting bookings by Admin {update.effective_user.id}: {e}")
+        update.message.reply_text("Failed to export bookings. Please try again later.")
+
+@admin_required
+def back_up(update: Update, context: CallbackContext) -> None:
+    """Take a backup of both databases now and report how long it took and how long it held the databases."""
+    try:
+        update.message.reply_text("Backing up...")
+        report = backups.run()
+        lines = [f"Backup {report.stamp} finished in {report.seconds:.2f} s:"]
+        for snapshot in report.snapshots:
+            lines.append(f"{snapshot.database}: {snapshot.size / 1024:.0f} KB compressed, {snapshot.pages} pages in {snapshot.steps} steps, "
+                         f"{snapshot.lock_seconds * 1000:.1f} ms locked, longest step {snapshot.longest_step * 1000:.1f} ms"
+                         + (f", restarted {snapshot.restarts} times by writes" if snapshot.restarts else ""))
+        update.message.reply_text('\n'.join(lines))
+        logger.info(f"Admin {update.effective_user.id} took backup {report.stamp}")
+    except Exception as e:
+        logger.error(f"Error taking a backup by Admin {update.effective_user.id}: {e}")
+        update.message.reply_text(f"Backup failed: {e}")
+
+@admin_required
+def restore_backup(update: Update, context: CallbackContext) -> None:
+    """List the backups, or restore both databases from /restore [stamp] and reload everything cached from them."""
+    stamps = backups.snapshots()
+    if len(context.args) != 1:
+        listing = '\n'.join(stamps) if stamps else "No backups yet."
+        update.message.reply_text(f"Usage: /restore [backup]\n\nBackups in {backup_dir}, newest first:\n{listing}")
+        return
+
+    try:
+        safety = backups.restore(context.args[0])
+        user_cache.load()
+        days = [to_iso_date(date) for date in generate_dates()]
+        for office in offices.values():
+            # Reloaded days get new versions, which also invalidates keyboards cached from them
+            for day in days:
+                office.availability.reload(day)
+            office.availability.warm(days)
+        update.message.reply_text(f"Restored backup {context.args[0]} after verifying it. The state before the restore was saved as backup {safety}.")
+        logger.warning(f"Admin {update.effective_user.id} restored backup {context.args[0]}")
+    except BackupError as e:
+        update.message.reply_text(f"Restore failed: {e}")
+    except Exception as e:
+        logger.error(f"Error restoring backup {context.args[0]} by Admin {update.effective_user.id}: {e}")
+        update.message.reply_text("Restore failed. Please check the logs.")
+
+@admin_required
+def broadcast(update: Update, context: CallbackContext) -> None:
+    # Take the text as typed, line breaks included, rather than the whitespace-split args
+    parts = (update.message.text or '').split(None, 1)
+    if len(parts) < 2:
+        update.message.reply_text("Usage: /broadcast [message]")
+        return
+
+    sender_id = str(update.effective_user.id)
+    try:
+        recipients = [user_id for user_id in user_cache.active_user_ids() if user_id != sender_id]
+        if not recipients:
+            update.message.reply_text("There are no other users to send the message to.")
+            return
+        report = update.message.reply_text(f"Broadcasting to {len(recipients)} users ({outbox.depth()} messages already queued)...")
+        outbox.broadcast(recipients, parts[1], report_chat_id=report.chat_id, report_message_id=report.message_id)
+        logger.info(f"Admin {sender_id} queued a broadcast to {len(recipients)} users")
+    except Exception as e:
+        logger.error(f"Error queueing a broadcast by Admin {sender_id}: {e}")
+        update.message.reply_text("Failed to send the broadcast. Please try again later.")
+
 @admin_required
 def cancel_booking_by_id(update: Update, context: CallbackContext) -> None:
     if len(context.args) != 1 or not context.args[0].isdigit():
@@ -249,155 +742,261 @@ def cancel_booking_by_id(update: Update, context: CallbackContext) -> None:
         logger.info(f"Invalid cancel_booking command usage by Admin {update.effective_user.id}")
         return
 
-    booking_id = context.args[0]
-    query = "DELETE FROM bookings WHERE id = ?"
+    booking_id = int(context.args[0])
     try:
-        execute_db_query(bookings_db_path, query, (booking_id,))
+        cancelled = delete_booking(bookings_db_path, booking_id)
+        if cancelled is None:
+            update.message.reply_text(f"No booking with ID {booking_id} found.")
+            return
+        table_released(context.job_queue, cancelled)
         update.message.reply_text(f"Booking with ID {booking_id} cancelled successfully.")
         logger.info(f"Booking with ID {booking_id} cancelled successfully by Admin {update.effective_user.id}")
     except Exception as e:
         logger.error(f"Error cancelling booking with ID {booking_id} by Admin {update.effective_user.id}: {e}")
         update.message.reply_text("Failed to cancel the booking. Please try again later.")
 
+def to_iso_date(display_date):
+    """Convert a display date such as '16.10.2026 (Fri)' into the ISO form stored in booking_day."""
+    return datetime.strptime(display_date[:10], '%d.%m.%Y').strftime('%Y-%m-%d')
+
 def generate_dates():
+    # Computed once per calendar day
+    return bookable_dates(clock.today())
+
+def page_callback(update: Update, context: CallbackContext) -> None:
+    """Show the previous/next page of a paginated listing."""
+    query = update.callback_query
+    pager = pagers.get(pager_name(query.data))
+    user = user_cache.get(update.effective_user.id)
+    if pager is None or not user or user.is_blacklisted or (pager.name in admin_pagers and not user.is_admin):
+        query.answer("You are not authorized to view this list.")
+        return
+    query.answer()
+
+    try:
+        message_text, reply_markup = pager.render_callback(query.data)
+        query.edit_message_text(message_text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error paging {pager.name} for user {update.effective_user.id}: {e}")
+        query.edit_message_text("An error occurred while retrieving the list. Please try again later.")
+
+WEEKDAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri')
+# Longest recurring booking accepted by /book_recurring
+MAX_RECURRING_WEEKS = 26
+
+def recurring_dates(weekdays, weeks):
+    """Display and ISO dates for the given weekdays (0 = Monday) over the next `weeks` weeks, starting today."""
     dates = []
-    current_date = datetime.now()
-    while len(dates) < 5:  # to get next 5 working days
-        if current_date.weekday() < 5:  # 0-4 corresponds to Monday-Friday
-            formatted_date = current_date.strftime('%d.%m.%Y (%a)')
-            dates.append(formatted_date)
+    current_date = clock.today()
+    for _ in range(weeks * 7):
+        if current_date.weekday() in weekdays:
+            dates.append((current_date.strftime('%d.%m.%Y (%a)'), current_date.strftime('%Y-%m-%d')))
         current_date += timedelta(days=1)
     return dates
 
+@user_required
+def book_recurring(update: Update, context: CallbackContext) -> None:
+    usage = (f"Usage: /book_recurring [table] [weekdays] [weeks]\n"
+             f"Example: /book_recurring 5 tue,thu 8 books Table 5 every Tuesday and Thursday for 8 weeks.")
+    if len(context.args) != 3 or not context.args[0].isdigit() or not context.args[2].isdigit():
+        update.message.reply_text(usage)
+        return
+    table_id, weeks = int(context.args[0]), int(context.args[2])
+    day_names = [name.strip().lower()[:3] for name in context.args[1].split(',')]
+    office = office_of(update.effective_user.id)
+    if not office.has_table(table_id) or not 1 <= weeks <= MAX_RECURRING_WEEKS or not day_names or any(name not in WEEKDAY_NAMES for name in day_names):
+        update.message.reply_text(usage + f"\nTables: 1-{office.total_tables}. Weekdays: {','.join(WEEKDAY_NAMES)}. Weeks: 1-{MAX_RECURRING_WEEKS}.")
+        return
+
+    user_id = update.effective_user.id
+    username = "@" + update.effective_user.username if update.effective_user.username else "Unknown"
+    weekdays = sorted({WEEKDAY_NAMES.index(name) for name in day_names})
+    try:
+        dates = recurring_dates(weekdays, weeks)
+        result = book_series(bookings_db_path, office.key, user_id, username, table_id, ','.join(WEEKDAY_NAMES[day] for day in weekdays), dates)
+        for booking_date in result.booked:
+            office.availability.mark_booked(to_iso_date(booking_date), table_id, user_id, username)
+
+        if result.booked:
+            response_text = f"Booked Table {table_id}{office_label(office.key)} on {len(result.booked)} of {len(dates)} dates: {', '.join(result.booked)}."
+        else:
+            response_text = f"Could not book Table {table_id} on any of the {len(dates)} dates."
+        if result.conflicts:
+            response_text += "\n\nNot booked:\n" + "\n".join(f"{booking_date}: {reason}" for booking_date, reason in result.conflicts)
+        update.message.reply_text(response_text)
+        logger.info(f"User {user_id} booked a series of Table {table_id}: {len(result.booked)} booked, {len(result.conflicts)} conflicts")
+    except Exception as e:
+        logger.error(f"Error in book_recurring: {e}")
+        update.message.reply_text("An error occurred while processing your recurring booking. Please try again later.")
+
 def button(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     query.answer()
 
     if query.data == 'book_table':
-        dates = generate_dates()
-        keyboard = [[InlineKeyboardButton(date, callback_data=f'date_{date}')] for date in dates]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text(text="Select a date:", reply_markup=reply_markup)
-    elif query.data.startswith('date_'):
-        selected_date = query.data.split('_')[1]
-        context.user_data['selected_date'] = selected_date
-        book_time(update, context)
-    elif query.data.startswith('table_'):
-        table_id = int(query.data.split('_')[1])
-        process_booking(update, context, table_id)
+        office = office_of(update.effective_user.id)
+        query.edit_message_text(text=f"Select a date{office_label(office.key)}:", reply_markup=office.keyboards.date_picker())
     # Add handling for other callback_data options
 
+def booking_callback(update: Update, context: CallbackContext) -> None:
+    """Route a tap in the date or table picker. Its callback_data names the office, the day and the table or page,
+    so no state is kept between taps: the flow survives restarts and any bot process can serve the next tap."""
+    query = update.callback_query
+    user = user_cache.get(update.effective_user.id)
+    if not user or user.is_blacklisted:
+        query.answer("You are not authorized to use this bot.")
+        return
+    query.answer()
+    payload = callbacks.decode(query.data)
+    office = offices.get(payload.office_id) if payload else None
+    if office is None or payload.day not in bookable_days(clock.today()):
+        # An office removed from the configuration, or a picker left open until its day passed
+        query.edit_message_text("This menu has expired. Please use /book again.")
+        return
+
+    booking_date = display_date(payload.day)
+    if payload.action in (callbacks.DATE, callbacks.PAGE):
+        book_time(update, context, office, booking_date, page=payload.number or 0)
+    elif payload.action == callbacks.TABLE:
+        process_booking(update, context, office, booking_date, payload.number)
+    elif payload.action == callbacks.PLAN:
+        show_floor_plan(update, context, office, booking_date, payload.number)
+    elif payload.action == callbacks.WAITLIST:
+        join_waitlist_for_date(update, context, office, booking_date)
+
+def expired_button(update: Update, context: CallbackContext) -> None:
+    """Answer a booking flow button sent before an upgrade changed the callback_data layout."""
+    update.callback_query.answer()
+    update.callback_query.edit_message_text("This menu has expired. Please use /book again.")
+
 @user_required
 def start_booking_process(update: Update, context: CallbackContext) -> None:
-    user_id = str(update.effective_user.id)
+    # Registration and blacklist status are already checked by user_required
+    office = office_of(update.effective_user.id)
+    update.message.reply_text(f"Select a date to book{office_label(office.key)}:", reply_markup=office.keyboards.date_picker())
+
+def book_time(update: Update, context: CallbackContext, office, booking_date, page=0) -> None:
+    user_id = update.effective_user.id
+    query = update.callback_query
 
-    # Check if the user is blacklisted
     try:
-        with sqlite3.connect(users_db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT is_blacklisted FROM users WHERE user_id = ?", (user_id,))
-            is_blacklisted = cursor.fetchone()[0]
+        booking_day = to_iso_date(booking_date)
 
-        if is_blacklisted:
-            update.message.reply_text("You are blacklisted and cannot use this bot.")
+        if office.availability.confirmed_user_table(booking_day, user_id) is not None:
+            query.edit_message_text(f"You have already booked a table for {booking_date}. Please choose another date or cancel your existing booking.")
             return
 
-        # Generate booking dates and create keyboard markup
-        dates = generate_dates()
-        keyboard = [[InlineKeyboardButton(date, callback_data=f'date_{date}')] for date in dates]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        update.message.reply_text("Select a date to book:", reply_markup=reply_markup)
-    
-    except sqlite3.Error as e:
-        logging.error(f"Database error in start_booking_process: {e}")
-        update.message.reply_text("An error occurred. Please try again later.")
+        # Buttons for all tables, marking availability; cached until a booking on this day changes
+        keyboards = office.keyboards
+        page = min(max(page, 0), keyboards.pages - 1)
+        reply_markup = keyboards.table_grid(booking_day, page)
+        floor = keyboards.floor(page).name
+        message_text = f"Select a table{office_label(office.key)} for {booking_date}" + (f" on {floor}" if floor else "")
+        if keyboards.pages > 1:
+            message_text += f" (page {page + 1} of {keyboards.pages})"
+        message_text += ":"
+        query.edit_message_text(message_text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error in book_time: {e}")
+        query.edit_message_text("An error occurred while processing your booking request. Please try again later.")
 
-def book_time(update: Update, context: CallbackContext) -> None:
-    if 'selected_date' in context.user_data:
-        booking_date = context.user_data['selected_date']
-        user_id = update.effective_user.id
+def process_booking(update: Update, context: CallbackContext, office, booking_date, table_id: int) -> None:
+    user_id = update.effective_user.id
+    username = "@" + update.effective_user.username if update.effective_user.username else "Unknown"
+    availability = office.availability
 
-        try:
-            query = """
-                SELECT table_id, (user_id = ?) as user_booked
-                FROM bookings
-                WHERE booking_date = ?
-            """
-            results = execute_db_query(bookings_db_path, query, (user_id, booking_date), fetch_all=True)
-
-            booked_tables = []
-            already_booked = False
-            for table_id, user_booked in results:
-                if user_booked:
-                    already_booked = True
-                    break
-                booked_tables.append(table_id)
-
-            if already_booked:
-                response_text = f"You have already booked a table for {booking_date}. Please choose another date or cancel your existing booking."
-                if update.callback_query:
-                    update.callback_query.edit_message_text(response_text)
-                else:
-                    update.message.reply_text(response_text)
-                return
+    try:
+        booking_day = to_iso_date(booking_date)
+
+        # A free table in memory goes straight to the database; a conflict in memory is confirmed against the
+        # database first, since the booking may have been cancelled by another process
+        if not office.has_table(table_id):
+            # A picker shown before the office's desks were reconfigured
+            response_text = f"{office.name} has no Table {table_id}. Please use /book again."
+        elif availability.confirmed_user_table(booking_day, user_id) is not None:
+            response_text = "You have already booked a table for this date. Please choose another date or cancel your existing booking."
+        elif availability.confirmed_table_holder(booking_day, table_id) is not None:
+            response_text = f"This table is already booked for the selected day by {availability.table_holder(booking_day, table_id)}. Please choose another table."
+        else:
+            result = book_table(bookings_db_path, office.key, user_id, username, booking_date, booking_day, table_id)
 
-            # Generate buttons for all tables, marking availability
-            keyboard = [[]]
-            for i in range(1, config.TOTAL_TABLES + 1):
-                button_text = f"Table {i}"
-                if i in booked_tables:
-                    button_text = "🚫 " + button_text
+            if result.outcome is BookingOutcome.BOOKED:
+                availability.mark_booked(booking_day, table_id, user_id, username)
+                floor = office.floor_of(table_id)
+                response_text = f"Successfully booked Table {table_id}{f' ({floor})' if floor else ''}{office_label(office.key)} for {booking_date}."
+            else:
+                # The index was behind the database (e.g. another bot process booked first), so resync this day
+                availability.reload(booking_day)
+                if result.outcome is BookingOutcome.USER_ALREADY_BOOKED:
+                    response_text = "You have already booked a table for this date. Please choose another date or cancel your existing booking."
                 else:
-                    button_text = "✅ " + button_text
+                    response_text = f"This table is already booked for the selected day by {result.holder}. Please choose another table."
 
-                button = InlineKeyboardButton(button_text, callback_data=f'table_{i}')
-                if len(keyboard[-1]) < 3:
-                    keyboard[-1].append(button)
-                else:
-                    keyboard.append([button])
+        update.callback_query.edit_message_text(response_text)
+    except Exception as e:
+        logger.error(f"Error in process_booking: {e}")
+        update.callback_query.edit_message_text("An error occurred while processing your booking. Please try again later.")
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            if update.callback_query:
-                update.callback_query.edit_message_text(f"Select a table for {booking_date}:", reply_markup=reply_markup)
-            else:
-                update.message.reply_text(f"Select a table for {booking_date}:", reply_markup=reply_markup)
-        except Exception as e:
-            logger.error(f"Error in book_time: {e}")
-            update.message.reply_text("An error occurred while processing your booking request. Please try again later.")
+def show_floor_plan(update: Update, context: CallbackContext, office, booking_date, page) -> None:
+    """Send the plan of the floor on a table picker page, marking the tables booked on booking_date."""
+    chat_id = update.callback_query.message.chat_id
 
-def process_booking(update: Update, context: CallbackContext, table_id: int) -> None:
-    booking_date = context.user_data['selected_date']
+    try:
+        floor = office.keyboards.floor(page)
+        if not floor.plan:
+            return
+        title = f"{office.name}, {floor.name}" if floor.name else office.name
+        booked_tables = office.availability.booked_tables(to_iso_date(booking_date))
+        floor_plans.send_availability(context.bot, chat_id, floor.plan, booked_tables, f"{title}, {booking_date}: 🟢 free, 🔴 booked")
+    except Exception as e:
+        logger.error(f"Error in show_floor_plan: {e}")
+        context.bot.send_message(chat_id, "The floor plan could not be shown. Please try again later.")
+
+def join_waitlist_for_date(update: Update, context: CallbackContext, office, booking_date) -> None:
+    """Queue the user for the first table freed in office on booking_date; background_jobs assigns it."""
+    query = update.callback_query
     user_id = update.effective_user.id
     username = "@" + update.effective_user.username if update.effective_user.username else "Unknown"
 
     try:
-        # Check if the user already has a booking on the selected date
-        check_query = "SELECT * FROM bookings WHERE booking_date = ? AND user_id = ?"
-        existing_booking = execute_db_query(bookings_db_path, check_query, (booking_date, user_id), fetch_one=True)
-        
-        if existing_booking:
-            response_text = "You have already booked a table for this date. Please choose another date or cancel your existing booking."
-        else:
-            # Check if the selected table is available
-            availability_query = "SELECT username FROM bookings WHERE booking_date = ? AND table_id = ?"
-            existing_table_booking = execute_db_query(bookings_db_path, availability_query, (booking_date, table_id), fetch_one=True)
-
-            if existing_table_booking is None:
-                insert_query = "INSERT INTO bookings (user_id, username, booking_date, table_id) VALUES (?, ?, ?, ?)"
-                execute_db_query(bookings_db_path, insert_query, (user_id, username, booking_date, table_id))
-                response_text = f"Successfully booked Table {table_id} for {booking_date}."
-            else:
-                existing_username = existing_table_booking[0]
-                response_text = f"This table is already booked for the selected day by {existing_username}. Please choose another table."
+        booking_day = to_iso_date(booking_date)
+        if office.availability.confirmed_user_table(booking_day, user_id) is not None:
+            query.edit_message_text(f"You have already booked a table for {booking_date}.")
+            return
+        if not office.availability.confirmed_fully_booked(booking_day):
+            # A table was freed since the picker was shown, so it can be booked directly
+            book_time(update, context, office, booking_date)
+            return
+        position = join_waitlist(bookings_db_path, office.key, user_id, username, booking_date, booking_day)
+        query.edit_message_text(f"You are number {position} on the waitlist{office_label(office.key)} for {booking_date}. "
+                                f"You will be booked and notified as soon as a table is freed.")
+        logger.info(f"User {user_id} joined the waitlist of {office.key} for {booking_day} at position {position}")
+    except Exception as e:
+        logger.error(f"Error in join_waitlist_for_date: {e}")
+        query.edit_message_text("An error occurred while joining the waitlist. Please try again later.")
 
-        # Respond according to the type of update
-        if update.callback_query:
-            update.callback_query.edit_message_text(response_text)
-        else:
-            update.message.reply_text(response_text)
+@user_required
+def export_ics(update: Update, context: CallbackContext) -> None:
+    """Send the user's bookings as an iCalendar file, to import into or subscribe to from a calendar app."""
+    user_id = update.effective_user.id
+
+    def describe(office_id, table_id):
+        office = offices.get(office_id)
+        floor = office.floor_of(table_id) if office else None
+        return f"Desk: Table {table_id}{f' ({floor})' if floor else ''}{office_label(office_id)}"
+
+    try:
+        with tempfile.TemporaryFile() as out:
+            count = export_calendar(bookings_db_path, out, user_id, describe)
+            if not count:
+                update.message.reply_text("You have no bookings to export.")
+                return
+            out.seek(0)
+            update.message.reply_document(out, filename="desk-bookings.ics", caption=f"{count} bookings")
+        logger.info(f"User {user_id} exported {count} bookings as iCalendar")
     except Exception as e:
-        logger.error(f"Error in process_booking: {e}")
-        update.message.reply_text("An error occurred while processing your booking. Please try again later.")
+        logger.error(f"Error exporting the calendar of user {user_id}: {e}")
+        update.message.reply_text("Failed to export your bookings. Please try again later.")
 
 @user_required
 def display_bookings_for_cancellation(update: Update, context: CallbackContext) -> None:
@@ -405,25 +1004,23 @@ def display_bookings_for_cancellation(update: Update, context: CallbackContext)
 
     try:
         # Get today's date in YYYY-MM-DD format for comparison
-        today = datetime.now().strftime('%Y-%m-%d')
+        today = clock.today_iso()
 
         # Modify the query to select only today's and future bookings
         query = """
-            SELECT id, booking_date, table_id 
+            SELECT id, booking_date, table_id, office_id 
             FROM bookings 
-            WHERE user_id = ? AND
-                SUBSTR(booking_date, 7, 4) || '-' || 
-                SUBSTR(booking_date, 4, 2) || '-' || 
-                SUBSTR(booking_date, 1, 2) >= ?
-            ORDER BY 
-                SUBSTR(booking_date, 7, 4) || '-' || 
-                SUBSTR(booking_date, 4, 2) || '-' || 
-                SUBSTR(booking_date, 1, 2)
+            WHERE user_id = ? AND booking_day >= ?
+            ORDER BY booking_day
         """
         bookings = execute_db_query(bookings_db_path, query, (user_id, today), fetch_all=True)
+        series = execute_db_query(bookings_db_path, "SELECT id, table_id, weekdays, office_id FROM booking_series WHERE user_id = ? AND last_day >= ?",
+                                  (user_id, today), fetch_all=True)
 
         if bookings:
-            keyboard = [[InlineKeyboardButton(f"Cancel Table {table_id} on {booking_date}", callback_data=f'cancel_{booking_id}')] for booking_id, booking_date, table_id in bookings]
+            # Recurring bookings can be cancelled as a whole, or date by date below
+            keyboard = [[InlineKeyboardButton(f"Cancel series: Table {table_id}{office_label(office_id)} every {weekdays}", callback_data=f'series_cancel_{series_id}')] for series_id, table_id, weekdays, office_id in series]
+            keyboard += [[InlineKeyboardButton(f"Cancel Table {table_id}{office_label(office_id)} on {booking_date}", callback_data=f'cancel_{booking_id}')] for booking_id, booking_date, table_id, office_id in bookings]
             reply_markup = InlineKeyboardMarkup(keyboard)
             # Check if the function is triggered by a callback query or a regular command
             if update.callback_query:
@@ -442,9 +1039,9 @@ def cancel_booking(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
 
     try:
-        # Execute the delete query using the centralized database function
-        delete_query = "DELETE FROM bookings WHERE id = ? AND user_id = ?"
-        execute_db_query(bookings_db_path, delete_query, (booking_id, user_id))
+        cancelled = delete_booking(bookings_db_path, booking_id, user_id)
+        if cancelled:
+            table_released(context.job_queue, cancelled)
 
         # Inform the user about the successful cancellation
         query.edit_message_text(f"Booking cancelled successfully.")
@@ -452,64 +1049,87 @@ def cancel_booking(update: Update, context: CallbackContext) -> None:
         logger.error(f"Error in cancel_booking: {e}")
         query.edit_message_text("Failed to cancel the booking. Please try again later.")
 
+def format_bookings_page(bookings, with_ids=False):
+    # Rows are (booking_day, table_id, id, booking_date, holder), grouped under their date
+    bookings_by_date = {}
+    for _, table_id, booking_id, booking_date, holder in bookings:
+        line = f"Table: {table_id}, User: {holder}" + (f", ID: {booking_id}" if with_ids else "")
+        bookings_by_date.setdefault(booking_date, []).append(line)
+    return "\n\n".join(f"{date}\n" + "\n".join(bookings_list) for date, bookings_list in bookings_by_date.items())
+
+# Booking listings are per office, each a range scan of the office-leading unique index
+all_bookings_pagers = {office.key: KeysetPager(
+    f'all-{office.key}', bookings_db_path,
+    "SELECT booking_day, table_id, id, booking_date, holder FROM booking_holders WHERE office_id = ? AND booking_day BETWEEN ? AND ?",
+    lambda office_id=office.key: (office_id, clock.today_iso(), (clock.today() + timedelta(days=7)).isoformat()),
+    key_columns=('booking_day', 'table_id'), key_types=(str, int), format_page=format_bookings_page,
+    title=f"All Bookings{office_label(office.key)}:\n\n", empty_text="No bookings found.") for office in offices.values()}
+
+history_pagers = {office.key: KeysetPager(
+    f'history-{office.key}', bookings_db_path,
+    "SELECT booking_day, table_id, id, booking_date, holder FROM booking_holders WHERE office_id = ? AND booking_day >= ?",
+    lambda office_id=office.key: (office_id, (clock.today() - timedelta(days=14)).isoformat()),
+    key_columns=('booking_day', 'table_id'), key_types=(str, int),
+    format_page=lambda bookings: format_bookings_page(bookings, with_ids=True),
+    title=f"Booking history{office_label(office.key)} for the past two weeks:\n\n", empty_text="No bookings in the past two weeks.") for office in offices.values()}
+
+# Listings served by page_callback; admin_pagers are only shown to admins
+pagers = {pager.name: pager for pager in (users_pager, *all_bookings_pagers.values(), *history_pagers.values())}
+admin_pagers = {users_pager.name} | {pager.name for pager in history_pagers.values()}
+
+def cancel_series(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    series_id = int(query.data.split('_')[2])
+    user_id = update.effective_user.id
+
+    try:
+        cancelled = delete_series(bookings_db_path, series_id, user_id, clock.today_iso())
+        if cancelled is None:
+            query.edit_message_text("This recurring booking no longer exists.")
+            return
+        for booking in cancelled:
+            table_released(context.job_queue, booking)
+        query.edit_message_text(f"Recurring booking cancelled: {len(cancelled)} upcoming bookings removed.")
+    except Exception as e:
+        logger.error(f"Error in cancel_series: {e}")
+        query.edit_message_text("Failed to cancel the recurring booking. Please try again later.")
+
 @user_required
 def view_bookings(update: Update, context: CallbackContext, personal_only=False) -> None:
     user_id = str(update.effective_user.id)
 
     try:
+        if not personal_only:
+            # All bookings can run past one message, so they are paged
+            message_text, reply_markup = all_bookings_pagers[office_of(user_id).key].render()
+            update.message.reply_text(message_text, reply_markup=reply_markup)
+            return
+
         # Define the time range
-        today = datetime.now().strftime('%Y-%m-%d')
-        next_four_workdays = (datetime.now() + timedelta(days=7)).strftime('%Y-%m-%d')
-
-        # Adjust the query based on whether to show personal or all bookings
-        if personal_only:
-            sql_query = """
-                SELECT booking_date, table_id 
-                FROM bookings 
-                WHERE user_id = ? AND
-                      SUBSTR(booking_date, 7, 4) || '-' || 
-                      SUBSTR(booking_date, 4, 2) || '-' || 
-                      SUBSTR(booking_date, 1, 2) BETWEEN ? AND ?
-                ORDER BY SUBSTR(booking_date, 7, 4) || '-' || 
-                         SUBSTR(booking_date, 4, 2) || '-' || 
-                         SUBSTR(booking_date, 1, 2), table_id
-            """
-            parameters = (user_id, today, next_four_workdays)
-        else:
-            sql_query = """
-                SELECT booking_date, table_id, username
-                FROM bookings 
-                WHERE 
-                    SUBSTR(booking_date, 7, 4) || '-' || 
-                    SUBSTR(booking_date, 4, 2) || '-' || 
-                    SUBSTR(booking_date, 1, 2) BETWEEN ? AND ?
-                ORDER BY SUBSTR(booking_date, 7, 4) || '-' || 
-                         SUBSTR(booking_date, 4, 2) || '-' || 
-                         SUBSTR(booking_date, 1, 2), table_id
-            """
-            parameters = (today, next_four_workdays)
-
-        bookings = execute_db_query(bookings_db_path, sql_query, parameters, fetch_all=True)
+        today = clock.today_iso()
+        next_four_workdays = (clock.today() + timedelta(days=7)).isoformat()
+
+        sql_query = """
+            SELECT booking_date, table_id, office_id 
+            FROM bookings 
+            WHERE user_id = ? AND booking_day BETWEEN ? AND ?
+            ORDER BY booking_day, table_id
+        """
+        bookings = execute_db_query(bookings_db_path, sql_query, (user_id, today, next_four_workdays), fetch_all=True)
 
         # Group bookings by date
         bookings_by_date = {}
-        for booking in bookings:
-            booking_date = booking[0]
-            table_id = booking[1]
-            username = booking[2] if not personal_only else "You"
+        for booking_date, table_id, office_id in bookings:
             if booking_date not in bookings_by_date:
                 bookings_by_date[booking_date] = []
-            bookings_by_date[booking_date].append(f"Table: {table_id}" if personal_only else f"Table: {table_id}, User: {username}")
+            bookings_by_date[booking_date].append(f"Table: {table_id}{office_label(office_id)}")
 
         # Format and send the response
         if bookings:
-            message_text = "Your Bookings:\n\n" if personal_only else "All Bookings:\n\n"
+            message_text = "Your Bookings:\n\n"
             for date, bookings_list in bookings_by_date.items():
-                if personal_only:
-                    bookings_str = ', '.join(bookings_list)  # Concatenate all bookings for the same date
-                    message_text += f"{date}, {bookings_str}\n"  # Display date and bookings on the same line
-                else:
-                    message_text += f"{date}\n" + "\n".join(bookings_list) + "\n\n"
+                bookings_str = ', '.join(bookings_list)  # Concatenate all bookings for the same date
+                message_text += f"{date}, {bookings_str}\n"  # Display date and bookings on the same line
         else:
             message_text = "No bookings found."
 
@@ -521,77 +1141,177 @@ def view_bookings(update: Update, context: CallbackContext, personal_only=False)
         logger.error(f"Error in view_bookings: {e}")
         update.message.reply_text("An error occurred while retrieving the bookings. Please try again later.")
 
+# Longest period /stats reports on, in months
+MAX_STATS_MONTHS = 120
+
 @admin_required
-def view_booking_history(update: Update, context: CallbackContext) -> None:
-    two_weeks_ago = (datetime.now() - timedelta(days=14)).strftime('%Y-%m-%d')
+def view_stats(update: Update, context: CallbackContext) -> None:
+    """Occupancy of the admin's office over the last [months] months (default 3), read from the summary tables."""
+    if len(context.args) > 1 or (context.args and not (context.args[0].isdigit() and 1 <= int(context.args[0]) <= MAX_STATS_MONTHS)):
+        update.message.reply_text(f"Usage: /stats [months], with months from 1 to {MAX_STATS_MONTHS}")
+        return
+    months = int(context.args[0]) if context.args else 3
+    office = office_of(update.effective_user.id)
 
     try:
-        sql_query = """
-            SELECT id, booking_date, table_id, username
-            FROM bookings 
-            WHERE 
-                SUBSTR(booking_date, 7, 4) || '-' || 
-                SUBSTR(booking_date, 4, 2) || '-' || 
-                SUBSTR(booking_date, 1, 2) >= ?
-            ORDER BY 
-                SUBSTR(booking_date, 7, 4) || '-' || 
-                SUBSTR(booking_date, 4, 2) || '-' || 
-                SUBSTR(booking_date, 1, 2), table_id
-        """
-        bookings = execute_db_query(bookings_db_path, sql_query, (two_weeks_ago,), fetch_all=True)
-
-        if bookings:
-            bookings_by_date = {}
-            for booking_id, booking_date, table_id, username in bookings:
-                if booking_date not in bookings_by_date:
-                    bookings_by_date[booking_date] = []
-                bookings_by_date[booking_date].append(f"Table: {table_id}, User: {username}, ID: {booking_id}")
+        report = occupancy_report(bookings_db_path, office.key, months, today=clock.today())
+        lines = [f"Statistics{office_label(office.key)} from {report.first_day.strftime('%d.%m.%Y')} to {report.last_day.strftime('%d.%m.%Y')}:",
+                 f"{report.bookings} bookings over {report.working_days} working days, "
+                 f"{report.bookings / (report.working_days * office.total_tables):.0%} of {office.total_tables} tables booked on average."
+                 if report.working_days else f"{report.bookings} bookings.",
+                 "", "Average occupancy by weekday:"]
+        lines += [f"{weekday}: {average:.1f} tables ({average / office.total_tables:.0%})" for weekday, average in report.weekdays]
+        if report.tables:
+            lines += ["", "Busiest tables:"] + [f"Table {table_id}: {bookings}" for table_id, bookings in report.tables]
+        if report.users:
+            lines += ["", "Most bookings:"]
+            for user_id, bookings in report.users:
+                user = user_cache.get(user_id)
+                lines.append(f"{user.username if user else user_id}: {bookings}")
+        update.message.reply_text('\n'.join(lines))
+        logger.info(f"Admin {update.effective_user.id} viewed statistics of {office.key} for {months} months")
+    except Exception as e:
+        logger.error(f"Error viewing statistics by Admin {update.effective_user.id}: {e}")
+        update.message.reply_text("An error occurred while retrieving the statistics.")
 
-            message_text = "Booking history for the past two weeks:\n\n"
-            for date, bookings_list in bookings_by_date.items():
-                message_text += f"{date}\n" + "\n".join(bookings_list) + "\n\n"
-        else:
-            message_text = "No bookings in the past two weeks."
+@admin_required
+def rebuild_statistics(update: Update, context: CallbackContext) -> None:
+    """Recompute the summary tables of every office from the bookings and the archive, e.g. after an import."""
+    try:
+        started = time.perf_counter()
+        counted = {office.key: rebuild_stats(bookings_db_path, office.key) for office in offices.values()}
+        elapsed = time.perf_counter() - started
+        update.message.reply_text(f"Statistics rebuilt from {sum(counted.values())} bookings in {elapsed:.1f} s.")
+        logger.info(f"Admin {update.effective_user.id} rebuilt the statistics: {counted} in {elapsed:.1f} s")
+    except Exception as e:
+        logger.error(f"Error rebuilding statistics by Admin {update.effective_user.id}: {e}")
+        update.message.reply_text("Failed to rebuild the statistics.")
 
-        update.message.reply_text(message_text)
+@admin_required
+def view_booking_history(update: Update, context: CallbackContext) -> None:
+    try:
+        message_text, reply_markup = history_pagers[office_of(update.effective_user.id).key].render()
+        update.message.reply_text(message_text, reply_markup=reply_markup)
         logger.info(f"Admin {update.effective_user.id} viewed booking history.")
     except Exception as e:
         logger.error(f"Error viewing booking history by Admin {update.effective_user.id}: {e}")
         update.message.reply_text("An error occurred while retrieving the booking history.")
 
+@user_required
+def choose_office(update: Update, context: CallbackContext) -> None:
+    """Show the offices to pick the default one from, or set it directly with /office [key]."""
+    user_id = str(update.effective_user.id)
+    if context.args:
+        set_default_office(update, user_id, context.args[0].lower())
+        return
+    current = office_of(user_id)
+    keyboard = [[InlineKeyboardButton(("✅ " if office is current else "") + f"{office.name} ({office.total_tables} tables)",
+                                      callback_data=f'office_{office.key}')] for office in offices.values()]
+    update.message.reply_text(f"Your office is {current.name}. Select the office to book in:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+def office_selected(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    user = user_cache.get(update.effective_user.id)
+    if not user or user.is_blacklisted:
+        query.answer("You are not authorized to use this bot.")
+        return
+    query.answer()
+    set_default_office(update, user.user_id, query.data.split('_', 1)[1])
+
+def set_default_office(update: Update, user_id, office_id) -> None:
+    reply = update.callback_query.edit_message_text if update.callback_query else update.message.reply_text
+    office = offices.get(office_id)
+    if office is None:
+        reply(f"Unknown office. Choose one of: {', '.join(offices)}.")
+        return
+    try:
+        execute_db_query(users_db_path, "UPDATE users SET office_id = ? WHERE user_id = ?", (office.key, user_id))
+        user_cache.refresh_user(user_id)
+        reply(f"Your office is now {office.name}. /book shows its tables.")
+        logger.info(f"User {user_id} switched to office {office.key}")
+    except Exception as e:
+        logger.error(f"Error setting the office of user {user_id}: {e}")
+        reply("Failed to change your office. Please try again later.")
+
+def register_handlers(dispatcher, run_async=True) -> None:
+    # With run_async every update is handled on the worker pool instead of one at a time on the dispatcher thread,
+    # so a slow database write or Telegram call for one user no longer holds up everyone else. Each handler still
+    # occupies a worker thread until it returns, so at most WORKERS updates are in flight
+    # Register command handlers for various functionalities
+    dispatcher.add_handler(CommandHandler("book", start_booking_process, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("cancel", display_bookings_for_cancellation, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("book_recurring", book_recurring, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("my_bookings", lambda update, context: view_bookings(update, context, personal_only=True), run_async=run_async))
+    dispatcher.add_handler(CommandHandler("all_bookings", view_bookings, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("history", view_booking_history, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("stats", view_stats, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("rebuild_stats", rebuild_statistics, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("add_user", add_user, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("remove_user", remove_user, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("make_admin", make_admin, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("revoke_admin", revoke_admin, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("blacklist_user", blacklist_user, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("view_users", view_users, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("import_users", import_users, run_async=run_async))
+    dispatcher.add_handler(MessageHandler(Filters.document & Filters.caption_regex(r'^/import_users(@\w+)?(\s|$)'), import_users, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("export_users", export_users, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("export_bookings", export_bookings, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("export_ics", export_ics, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("cancel_booking", cancel_booking_by_id, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("broadcast", broadcast, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("backup", back_up, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("restore", restore_backup, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("office", choose_office, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("admin", manage_users, run_async=run_async))
+
+    # Register CallbackQueryHandler for handling callback queries from inline keyboards
+    dispatcher.add_handler(CallbackQueryHandler(button, pattern='^book_table$', run_async=run_async))
+    dispatcher.add_handler(CallbackQueryHandler(booking_callback, pattern=callbacks.PATTERN, run_async=run_async))
+    dispatcher.add_handler(CallbackQueryHandler(expired_button, pattern=callbacks.LEGACY_PATTERN, run_async=run_async))
+    dispatcher.add_handler(CallbackQueryHandler(cancel_booking, pattern='^cancel_', run_async=run_async))
+    dispatcher.add_handler(CallbackQueryHandler(cancel_series, pattern='^series_cancel_', run_async=run_async))
+    dispatcher.add_handler(CallbackQueryHandler(office_selected, pattern='^office_', run_async=run_async))
+    dispatcher.add_handler(CallbackQueryHandler(display_bookings_for_cancellation, pattern='^cancel_booking$', run_async=run_async))
+    dispatcher.add_handler(CallbackQueryHandler(page_callback, pattern=f'^{CALLBACK_PREFIX}', run_async=run_async))
+
 def main() -> None:
+    # Refuse to serve an unauthenticated webhook before touching anything
+    if webhook_url:
+        check_secret_token(webhook_secret_token)
+
     # Initialize databases
     initialize_databases()
+    user_cache.load()
+    days = [to_iso_date(date) for date in generate_dates()]
+    for office in offices.values():
+        office.availability.warm(days)
 
-    # Create Updater object and pass the bot's token
-    updater = Updater(config.BOT_TOKEN, use_context=True)
+    # Create Updater object and pass the bot's token. The request object times every Bot API call for the metrics
+    bot = Bot(config.BOT_TOKEN, request=TimedRequest(metrics, con_pool_size=workers + 4))
+    persistence = SQLitePersistence(users_db_path, flush_interval=user_state_flush_interval) if user_state_persistence else None
+    updater = Updater(bot=bot, use_context=True, workers=workers, persistence=persistence)
+    outbox.start(bot)
 
     # Get the dispatcher to register handlers
-    dispatcher = updater.dispatcher
-
-    # Register command handlers for various functionalities
-    dispatcher.add_handler(CommandHandler("book", start_booking_process)) 
-    dispatcher.add_handler(CommandHandler("cancel", display_bookings_for_cancellation))
-    dispatcher.add_handler(CommandHandler("my_bookings", lambda update, context: view_bookings(update, context, personal_only=True)))
-    dispatcher.add_handler(CommandHandler("all_bookings", view_bookings))
-    dispatcher.add_handler(CommandHandler("history", view_booking_history))
-    dispatcher.add_handler(CommandHandler("add_user", add_user))
-    dispatcher.add_handler(CommandHandler("remove_user", remove_user))
-    dispatcher.add_handler(CommandHandler("make_admin", make_admin))
-    dispatcher.add_handler(CommandHandler("revoke_admin", revoke_admin))
-    dispatcher.add_handler(CommandHandler("blacklist_user", blacklist_user))
-    dispatcher.add_handler(CommandHandler("view_users", view_users))
-    dispatcher.add_handler(CommandHandler("cancel_booking", cancel_booking_by_id))
-    dispatcher.add_handler(CommandHandler("admin", manage_users))
-    
-    # Register CallbackQueryHandler for handling callback queries from inline keyboards
-    dispatcher.add_handler(CallbackQueryHandler(button, pattern='^(book_table|date_|table_)'))
-    dispatcher.add_handler(CallbackQueryHandler(cancel_booking, pattern='^cancel_'))
-    dispatcher.add_handler(CallbackQueryHandler(display_bookings_for_cancellation, pattern='^cancel_booking$'))
+    register_handlers(updater.dispatcher)
+    background_jobs.schedule(updater.job_queue)
+    instrument_dispatcher(updater.dispatcher, metrics)
+    if metrics_port:
+        start_metrics_server(metrics, metrics_port)
+    if metrics_file:
+        start_metrics_dump(metrics, metrics_file, metrics_dump_interval)
 
     # Start the Bot
-    updater.start_polling()
+    if webhook_url:
+        start_webhook(updater, webhook_url, listen=webhook_listen, port=webhook_port, url_path=webhook_path,
+                      secret_token=webhook_secret_token, max_connections=webhook_max_connections)
+    else:
+        updater.start_polling()
     updater.idle()
+    outbox.stop()
+
+    # Release the per-thread database connections once the bot has stopped
+    close_all_connections()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
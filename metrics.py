@@ -0,0 +1,273 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram.ext import CallbackQueryHandler, CommandHandler
+from telegram.utils.request import Request
+from logs import bind_update, unbind_update
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def render_series(series):
+    """Unlabelled (name, type, description, value) series in the Prometheus text exposition format, for the
+    collectors added with HandlerMetrics.add_collector."""
+    lines = []
+    for name, kind, description, value in series:
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return '\n'.join(lines) + '\n'
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+class HandlerMetrics:
+    """Per-handler histograms of wall time, database time and Telegram API time, plus error counts.
+
+    Handlers are labelled by command ("/book") or callback pattern ("^cancel_"). Database and API time are
+    attributed to the handler running on the current thread, which is how the dispatcher's workers execute them.
+    While a handler runs, its label and the user are bound to the thread's log records; with log_updates every
+    update is also logged with its duration."""
+
+    SERIES = (
+        ('deskbooker_handler_seconds', 'Wall time spent handling an update.'),
+        ('deskbooker_handler_db_seconds', 'Time spent in database queries while handling an update.'),
+        ('deskbooker_handler_api_seconds', 'Time spent in Telegram Bot API calls while handling an update.'),
+    )
+
+    def __init__(self, slow_update_threshold=None, profile_slow_updates=False, profile_interval=0.005, log_updates=False):
+        self.slow_update_threshold = slow_update_threshold
+        self.log_updates = log_updates
+        self._histograms = {name: defaultdict(Histogram) for name, _ in self.SERIES}
+        self._errors = Counter()
+        self._lock = threading.Lock()
+        self._current = threading.local()
+        self._profiler = SlowUpdateProfiler(slow_update_threshold, profile_interval) if profile_slow_updates and slow_update_threshold else None
+        self._collectors = []
+
+    def add_collector(self, render):
+        """Append the output of render(), more series in the exposition format, to every render()."""
+        self._collectors.append(render)
+
+    # Hooks fed by the database layer and the instrumented Request
+    def add_db_time(self, seconds):
+        timing = getattr(self._current, 'timing', None)
+        if timing is not None:
+            timing[0] += seconds
+
+    def add_api_time(self, seconds):
+        timing = getattr(self._current, 'timing', None)
+        if timing is not None:
+            timing[1] += seconds
+
+    def count_error(self):
+        """Mark the update running on this thread as failed; it is counted once however many errors it logs."""
+        if getattr(self._current, 'timing', None) is not None:
+            self._current.failed = True
+
+    def wrap(self, label, callback):
+        """Return callback instrumented under label."""
+        def instrumented(update, context, *args, **kwargs):
+            self._current.timing = timing = [0.0, 0.0]
+            self._current.failed = False
+            user = getattr(update, 'effective_user', None)
+            bind_update(user.id if user else None, label)
+            if self._profiler:
+                self._profiler.begin()
+            started = time.perf_counter()
+            try:
+                return callback(update, context, *args, **kwargs)
+            except Exception:
+                self.count_error()
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                self._current.timing = None
+                self._record(label, elapsed, timing[0], timing[1], self._current.failed)
+                stacks = self._profiler.end() if self._profiler else None
+                duration_ms = round(elapsed * 1000, 1)
+                if self.slow_update_threshold and elapsed >= self.slow_update_threshold:
+                    logger.warning("Slow update in %s: %.1f ms total, %.1f ms database, %.1f ms Telegram API",
+                                   label, elapsed * 1000, timing[0] * 1000, timing[1] * 1000, extra={'duration_ms': duration_ms})
+                    if stacks:
+                        logger.warning("Sampled stacks for slow update in %s:\n%s", label, stacks)
+                elif self.log_updates:
+                    logger.info("Handled %s in %.1f ms", label, elapsed * 1000, extra={'duration_ms': duration_ms})
+                unbind_update()
+        instrumented.__name__ = getattr(callback, '__name__', label)
+        return instrumented
+
+    def _record(self, label, elapsed, db_time, api_time, failed):
+        with self._lock:
+            for (name, _), value in zip(self.SERIES, (elapsed, db_time, api_time)):
+                self._histograms[name][label].observe(value)
+            if failed:
+                self._errors[label] += 1
+
+    def render(self):
+        """Render all series in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, description in self.SERIES:
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} histogram")
+                for label, histogram in sorted(self._histograms[name].items()):
+                    handler_label = 'handler="' + label.replace('\\', '\\\\').replace('"', '\\"') + '"'
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram.bucket_counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{handler_label},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{handler_label},le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{{handler_label}}} {histogram.sum:.6f}')
+                    lines.append(f'{name}_count{{{handler_label}}} {histogram.count}')
+            lines.append("# HELP deskbooker_handler_errors_total Updates whose handler raised or logged an error.")
+            lines.append("# TYPE deskbooker_handler_errors_total counter")
+            for label, count in sorted(self._errors.items()):
+                handler_label = 'handler="' + label.replace('\\', '\\\\').replace('"', '\\"') + '"'
+                lines.append(f'deskbooker_handler_errors_total{{{handler_label}}} {count}')
+        return '\n'.join(lines) + '\n' + ''.join(render() for render in self._collectors)
+
+class _ErrorLogCounter(logging.Handler):
+    """Counts ERROR records logged while a handler runs; most handlers catch and log their own failures."""
+
+    def __init__(self, metrics):
+        super().__init__(logging.ERROR)
+        self.metrics = metrics
+
+    def emit(self, record):
+        self.metrics.count_error()
+
+class TimedRequest(Request):
+    """Request that reports the duration of every Bot API call to HandlerMetrics."""
+
+    def __init__(self, metrics, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+
+    def post(self, url, data, timeout=None):
+        started = time.perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        finally:
+            self.metrics.add_api_time(time.perf_counter() - started)
+
+    def retrieve(self, url, timeout=None):
+        started = time.perf_counter()
+        try:
+            return super().retrieve(url, timeout=timeout)
+        finally:
+            self.metrics.add_api_time(time.perf_counter() - started)
+
+class SlowUpdateProfiler:
+    """Samples the stack of every update that has been running for longer than threshold seconds.
+
+    One background thread wakes up every interval seconds while updates are in flight; the samples for an update
+    are summarised when it finishes, so fast updates never pay for more than a dict insert and delete."""
+
+    def __init__(self, threshold, interval):
+        self.threshold = threshold
+        self.interval = interval
+        self._inflight = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name='slow-update-profiler', daemon=True).start()
+
+    def begin(self):
+        with self._lock:
+            self._inflight[threading.get_ident()] = (time.perf_counter(), Counter())
+
+    def end(self, top=5):
+        with self._lock:
+            _, samples = self._inflight.pop(threading.get_ident(), (None, None))
+        if not samples:
+            return None
+        total = sum(samples.values())
+        return '\n'.join(f"  {count / total:5.1%} {stack}" for stack, count in samples.most_common(top))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self._lock:
+                slow = [(thread_id, samples) for thread_id, (started, samples) in self._inflight.items() if now - started >= self.threshold]
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            for thread_id, samples in slow:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[self._summarize(frame)] += 1
+
+    @staticmethod
+    def _summarize(frame, depth=6):
+        parts = []
+        while frame is not None and len(parts) < depth:
+            code = frame.f_code
+            parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ' <- '.join(parts)
+
+def handler_label(handler):
+    if isinstance(handler, CommandHandler):
+        return '/' + handler.command[0]
+    if isinstance(handler, CallbackQueryHandler) and handler.pattern is not None:
+        return getattr(handler.pattern, 'pattern', str(handler.pattern))
+    return getattr(handler.callback, '__name__', type(handler).__name__)
+
+def instrument_dispatcher(dispatcher, metrics):
+    """Wrap the callback of every handler registered on dispatcher and start counting logged errors."""
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handler.callback = metrics.wrap(handler_label(handler), handler.callback)
+    logging.getLogger().addHandler(_ErrorLogCounter(metrics))
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(metrics, port, listen='127.0.0.1'):
+    """Expose the metrics for Prometheus at http://listen:port/metrics."""
+    server = ThreadingHTTPServer((listen, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Serving metrics on http://{listen}:{port}/metrics")
+    return server
+
+def start_metrics_dump(metrics, path, interval=60):
+    """Write the metrics to path every interval seconds, replacing the file atomically."""
+    def dump():
+        while True:
+            time.sleep(interval)
+            try:
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    f.write(metrics.render())
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                logger.error(f"Failed to write metrics to {path}: {e}")
+    threading.Thread(target=dump, name='metrics-dump', daemon=True).start()
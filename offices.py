@@ -0,0 +1,68 @@
+import re
+from collections import namedtuple
+from datetime import date
+from availability import AvailabilityIndex
+from images import FloorPlan
+from keyboards import KeyboardCache
+
+# Tables are numbered 1..N across an office; each floor holds a consecutive range of them and may have a FloorPlan
+Floor = namedtuple('Floor', ['name', 'first_table', 'last_table', 'plan'])
+
+# Office keys travel in callback_data and pager names, so they are kept short and free of separators
+OFFICE_KEY = re.compile(r'^[a-z0-9-]{1,16}$')
+DEFAULT_OFFICE_KEY = 'main'
+
+class Office:
+    """One site with its own desk inventory. Bookings of all offices share the bookings database, where every
+    query and unique index leads with office_id, and each office has its own availability index and pickers."""
+
+    def __init__(self, key, name, floors, database_path, grid_columns, grid_page_size, today=date.today):
+        self.key = key
+        self.name = name
+        self.floors = floors
+        self.total_tables = floors[-1].last_table
+        self.availability = AvailabilityIndex(database_path, self.total_tables, key)
+        self.keyboards = KeyboardCache(self.availability, floors, columns=grid_columns, page_size=grid_page_size, today=today)
+
+    def has_table(self, table_id):
+        return 1 <= table_id <= self.total_tables
+
+    def floor_of(self, table_id):
+        for floor in self.floors:
+            if floor.first_table <= table_id <= floor.last_table:
+                return floor.name
+        return None
+
+def _floor_plan(settings, first_table, last_table, office_key):
+    """Build a FloorPlan from {'image': path, 'positions': {table_id: (x, y), ...}}, or None."""
+    if not settings:
+        return None
+    positions = {int(table_id): tuple(position) for table_id, position in (settings.get('positions') or {}).items()}
+    outside = [table_id for table_id in positions if not first_table <= table_id <= last_table]
+    if outside:
+        raise ValueError(f"Floor plan {settings['image']} of office {office_key!r} positions tables {outside} that aren't on its floor")
+    return FloorPlan(settings['image'], positions)
+
+def load_offices(offices_config, total_tables, database_path, grid_columns, grid_page_size, floor_plan=None, today=date.today):
+    """Build the offices from the OFFICES setting, or a single office of total_tables desks with the optional
+    floor_plan when it isn't set.
+
+    OFFICES maps an office key to {'name': ..., 'tables': N, 'plan': plan} or {'name': ..., 'floors': [(floor name,
+    N, plan), ...]}, where plans are optional dicts {'image': path, 'positions': {table_id: (x, y)}}.
+    today returns today's date for the date pickers. Returns the offices by key, in configuration order; the
+    first one is the default."""
+    if not offices_config:
+        offices_config = {DEFAULT_OFFICE_KEY: {'name': 'Office', 'tables': total_tables, 'plan': floor_plan}}
+    offices = {}
+    for key, settings in offices_config.items():
+        if not OFFICE_KEY.match(key):
+            raise ValueError(f"Invalid office key {key!r}: use up to 16 lowercase letters, digits and dashes")
+        floors, first_table = [], 1
+        for floor_name, tables, *plan in settings.get('floors') or [(None, settings.get('tables', 0), settings.get('plan'))]:
+            if tables < 1:
+                raise ValueError(f"Office {key!r} needs at least one table per floor")
+            last_table = first_table + tables - 1
+            floors.append(Floor(floor_name, first_table, last_table, _floor_plan(plan[0] if plan else None, first_table, last_table, key)))
+            first_table += tables
+        offices[key] = Office(key, settings.get('name', key), floors, database_path, grid_columns, grid_page_size, today)
+    return offices
@@ -0,0 +1,277 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from metrics import render_series
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages a second overall and about one a second per chat; the global default leaves
+# headroom for the handlers' direct replies
+GLOBAL_RATE = 25
+CHAT_RATE = 1
+CHAT_BURST = 3
+# Attempts for a message that fails with a network error before it is counted as failed
+MAX_ATTEMPTS = 3
+REPORT_INTERVAL = 60
+
+class TokenBucket:
+    """Allows rate events a second on average and up to capacity at once."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available; 0 if one is available now."""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class _Item:
+    __slots__ = ('method', 'chat_id', 'kwargs', 'callbacks', 'attempts')
+
+    def __init__(self, method, chat_id, kwargs, on_done):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.callbacks = [on_done] if on_done else []
+        self.attempts = 0
+
+class Outbox:
+    """Queue for messages that are not a direct reply to the update being handled: reminders, waitlist
+    notifications and broadcasts.
+
+    Messages are sent by a small pool of threads in the order they were queued per chat, and chats take turns.
+    A global token bucket and one per chat keep the bot under Telegram's flood limits; a RetryAfter pauses all
+    sending for the time Telegram asks and then retries the message. A queued edit of a message that already has an
+    edit waiting replaces that edit, so only the latest text is sent. on_done callbacks get True if the message was
+    delivered and False if it was dropped."""
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, workers=4):
+        self.bot = None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        # Queued messages per chat, and the chats that have queued messages and nothing in flight, in turn order
+        self._queues = {}
+        self._ready = deque()
+        self._in_flight = set()
+        # (chat_id, message_id) -> queued edit of that message
+        self._edits = {}
+        self._depth = 0
+        self._paused_until = 0
+        self._cond = threading.Condition()
+        self._running = False
+        self._executor = None
+        self.sent = self.failed = self.retry_after = self.coalesced = 0
+
+    def start(self, bot):
+        self.bot = bot
+        self._running = True
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='outbox')
+        threading.Thread(target=self._run, name='outbox', daemon=True).start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        if self._depth:
+            logger.warning(f"Outbox stopped with {self._depth} messages unsent")
+
+    def depth(self):
+        return self._depth
+
+    def send_message(self, chat_id, text, on_done=None, **kwargs):
+        self._put(_Item('send_message', chat_id, dict(kwargs, chat_id=chat_id, text=text), on_done))
+
+    def edit_message_text(self, chat_id, message_id, text, on_done=None, **kwargs):
+        key = (chat_id, message_id)
+        with self._cond:
+            queued = self._edits.get(key)
+            if queued is not None:
+                queued.kwargs = dict(kwargs, chat_id=chat_id, message_id=message_id, text=text)
+                if on_done:
+                    queued.callbacks.append(on_done)
+                self.coalesced += 1
+                return
+            item = _Item('edit_message_text', chat_id, dict(kwargs, chat_id=chat_id, message_id=message_id, text=text), on_done)
+            self._edits[key] = item
+            self._enqueue(item)
+
+    def broadcast(self, chat_ids, text, report_chat_id=None, report_message_id=None):
+        """Send text to every chat in chat_ids. If a report message is given, it is edited with the progress."""
+        total = len(chat_ids)
+        counts = [0, 0]
+        lock = threading.Lock()
+
+        def done(ok):
+            with lock:
+                counts[0 if ok else 1] += 1
+                delivered, failed = counts
+            if report_message_id is None:
+                return
+            if delivered + failed < total:
+                report = f"Broadcasting to {total} users: {delivered} delivered, {failed} failed so far."
+            else:
+                report = f"Broadcast finished: {delivered} of {total} users reached, {failed} failed."
+                logger.info(report)
+            self.edit_message_text(report_chat_id, report_message_id, report)
+
+        for chat_id in chat_ids:
+            self.send_message(chat_id, text, on_done=done)
+
+    def _put(self, item):
+        with self._cond:
+            self._enqueue(item)
+
+    def _enqueue(self, item):
+        queue = self._queues.get(item.chat_id)
+        if queue is None:
+            queue = self._queues[item.chat_id] = deque()
+        if not queue and item.chat_id not in self._in_flight:
+            self._ready.append(item.chat_id)
+        queue.append(item)
+        self._depth += 1
+        self._cond.notify()
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next_item(self, now):
+        """Take the first message whose chat has a token, or return the seconds until one will."""
+        wait = None
+        for _ in range(len(self._ready)):
+            chat_id = self._ready.popleft()
+            bucket = self._bucket(chat_id)
+            chat_wait = bucket.wait_time(now)
+            if chat_wait:
+                self._ready.append(chat_id)
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            bucket.take()
+            item = self._queues[chat_id].popleft()
+            if not self._queues[chat_id]:
+                del self._queues[chat_id]
+            if item.method == 'edit_message_text':
+                del self._edits[(chat_id, item.kwargs['message_id'])]
+            self._in_flight.add(chat_id)
+            self._depth -= 1
+            return item, None
+        return None, wait
+
+    def _run(self):
+        last_report, sent_at_report = time.monotonic(), 0
+        with self._cond:
+            while self._running:
+                now = time.monotonic()
+                if now - last_report >= REPORT_INTERVAL:
+                    if self.sent != sent_at_report or self._depth:
+                        logger.info(f"Outbox: {(self.sent - sent_at_report) / (now - last_report):.1f} messages/s, "
+                                    f"{self._depth} queued")
+                    last_report, sent_at_report = now, self.sent
+                    # Forget chats whose buckets have refilled, so one-off recipients don't accumulate
+                    self._buckets = {chat_id: bucket for chat_id, bucket in self._buckets.items()
+                                     if chat_id in self._queues or not bucket.is_full(now)}
+                wait = max(self._paused_until - now, self._global.wait_time(now))
+                if wait > 0:
+                    self._cond.wait(min(wait, REPORT_INTERVAL))
+                    continue
+                item, wait = self._next_item(now)
+                if item is None:
+                    self._cond.wait(min(wait, REPORT_INTERVAL) if wait is not None else REPORT_INTERVAL)
+                    continue
+                self._global.take()
+                self._executor.submit(self._deliver, item)
+
+    def _deliver(self, item):
+        item.attempts += 1
+        ok = None
+        try:
+            getattr(self.bot, item.method)(**item.kwargs)
+            ok = True
+        except RetryAfter as e:
+            logger.warning(f"Outbox throttled by Telegram for {e.retry_after} s")
+            with self._cond:
+                self.retry_after += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+        except BadRequest as e:
+            # Re-sending the text a message already shows is harmless
+            ok = 'message is not modified' in str(e).lower()
+            if not ok:
+                logger.warning(f"Outbox could not {item.method} to chat {item.chat_id}: {e}")
+        except NetworkError as e:
+            if item.attempts >= MAX_ATTEMPTS:
+                logger.warning(f"Outbox gave up on {item.method} to chat {item.chat_id}: {e}")
+                ok = False
+        except TelegramError as e:
+            # Typically a user who never started the bot or blocked it
+            logger.warning(f"Outbox could not {item.method} to chat {item.chat_id}: {e}")
+            ok = False
+        except Exception as e:
+            # Not a Telegram answer, e.g. arguments the Bot can't serialize: retrying won't help
+            logger.error(f"Outbox failed to {item.method} to chat {item.chat_id}: {e!r}")
+            ok = False
+        finally:
+            # Always release the chat, or its queue would never drain
+            with self._cond:
+                self._in_flight.discard(item.chat_id)
+                if ok is None:
+                    self._requeue(item)
+                elif ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                if item.chat_id in self._queues:
+                    self._ready.append(item.chat_id)
+                self._cond.notify()
+        if ok is not None:
+            for callback in item.callbacks:
+                try:
+                    callback(ok)
+                except Exception as e:
+                    logger.error(f"Error in outbox callback for chat {item.chat_id}: {e}")
+
+    def _requeue(self, item):
+        # Retried first in its chat, unless it is an edit that a newer queued edit already replaces
+        if item.method == 'edit_message_text':
+            key = (item.chat_id, item.kwargs['message_id'])
+            if key in self._edits:
+                self._edits[key].callbacks += item.callbacks
+                return
+            self._edits[key] = item
+        self._queues.setdefault(item.chat_id, deque()).appendleft(item)
+        self._depth += 1
+
+    def render(self):
+        """Queue depth and send counters in the Prometheus text exposition format."""
+        with self._cond:
+            series = (
+                ('deskbooker_outbox_queue_depth', 'gauge', 'Messages waiting in the outbound queue.', self._depth),
+                ('deskbooker_outbox_sent_total', 'counter', 'Messages sent from the outbound queue.', self.sent),
+                ('deskbooker_outbox_failed_total', 'counter', 'Queued messages dropped after an error.', self.failed),
+                ('deskbooker_outbox_retry_after_total', 'counter', 'Flood-control responses from Telegram.', self.retry_after),
+                ('deskbooker_outbox_coalesced_edits_total', 'counter', 'Queued edits replaced by a newer edit.', self.coalesced),
+            )
+        return render_series(series)
@@ -0,0 +1,92 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from db import execute_db_query
+
+# Telegram rejects message texts longer than this
+MAX_MESSAGE_LENGTH = 4096
+PAGE_SIZE = 40
+CALLBACK_PREFIX = 'pg:'
+
+class KeysetPager:
+    """Pages through a query one screen at a time, ordered by key_columns.
+
+    Each page is fetched with a keyset condition on the last (or first) row of the previous page, so a page costs
+    one index range scan regardless of how far in the listing it is, and nothing is kept in memory between taps:
+    the boundary key travels in the Prev/Next buttons' callback_data.
+
+    query is a SELECT ending in a WHERE clause; parameters is a callable returning its parameters, evaluated on every
+    page so date windows stay current. key_types convert the keys back from callback_data. format_page turns a list
+    of rows into the message body."""
+
+    def __init__(self, name, database_path, query, parameters, key_columns, key_types, format_page, title, empty_text,
+                 page_size=PAGE_SIZE):
+        self.name = name
+        self.database_path = database_path
+        self.query = query
+        self.parameters = parameters
+        self.key_columns = key_columns
+        self.key_types = key_types
+        self.format_page = format_page
+        self.title = title
+        self.empty_text = empty_text
+        self.page_size = page_size
+
+    def _key(self, row):
+        # Key columns are selected first
+        return tuple(row[:len(self.key_columns)])
+
+    def _fetch(self, after=None, before=None):
+        columns = ', '.join(self.key_columns)
+        placeholders = ', '.join('?' * len(self.key_columns))
+        query = self.query
+        parameters = tuple(self.parameters())
+        if after is not None:
+            query += f" AND ({columns}) > ({placeholders})"
+            parameters += tuple(after)
+        elif before is not None:
+            query += f" AND ({columns}) < ({placeholders})"
+            parameters += tuple(before)
+        direction = ' DESC' if before is not None else ''
+        query += " ORDER BY " + ', '.join(column + direction for column in self.key_columns) + " LIMIT ?"
+        rows = execute_db_query(self.database_path, query, parameters + (self.page_size + 1,), fetch_all=True)
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if before is not None:
+            rows.reverse()
+        return rows, has_more
+
+    def render(self, after=None, before=None):
+        """Return (text, reply_markup) for the page after/before the given key, or the first page."""
+        rows, has_more = self._fetch(after, before)
+        if not rows:
+            return self.empty_text, None
+        has_prev = has_more if before is not None else after is not None
+        has_next = has_more if before is None else True
+
+        text = self.title + self.format_page(rows)
+        # Keep the message under Telegram's limit; whatever is cut off starts the next page
+        while len(text) > MAX_MESSAGE_LENGTH and len(rows) > 1:
+            rows = rows[:-1]
+            has_next = True
+            text = self.title + self.format_page(rows)
+
+        buttons = []
+        if has_prev:
+            buttons.append(InlineKeyboardButton("« Prev", callback_data=self._callback_data('p', self._key(rows[0]))))
+        if has_next:
+            buttons.append(InlineKeyboardButton("Next »", callback_data=self._callback_data('n', self._key(rows[-1]))))
+        return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+    def _callback_data(self, direction, key):
+        return CALLBACK_PREFIX + ':'.join((self.name, direction) + tuple(str(value) for value in key))
+
+    def render_callback(self, data):
+        """Render the page requested by a Prev/Next button's callback_data."""
+        _, direction, *values = data[len(CALLBACK_PREFIX):].split(':')
+        key = tuple(key_type(value) for key_type, value in zip(self.key_types, values))
+        if direction == 'n':
+            return self.render(after=key)
+        return self.render(before=key)
+
+def pager_name(data):
+    """Return the pager name encoded in a Prev/Next callback_data."""
+    return data[len(CALLBACK_PREFIX):].split(':', 1)[0]
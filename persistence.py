@@ -0,0 +1,100 @@
+import json
+import logging
+import threading
+from collections import defaultdict
+from telegram.ext import BasePersistence
+from db import execute_db_query, transaction
+
+logger = logging.getLogger(__name__)
+
+# Seconds between writes of changed user_data
+FLUSH_INTERVAL = 5
+
+class SQLitePersistence(BasePersistence):
+    """Keeps context.user_data in the user_state table, one JSON object per user, so it survives restarts.
+
+    The dispatcher hands over a user's data after every update; only data that differs from what was last written
+    is queued, and a background thread writes everything queued in one transaction every flush_interval seconds,
+    so handlers never wait on the database for it. flush() writes the rest when the Updater stops. Values must be
+    JSON-serialisable. Processes sharing the database read each other's changes on their next start; state one tap
+    depends on travels in callback_data instead, see callbacks."""
+
+    def __init__(self, database_path, flush_interval=FLUSH_INTERVAL):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.database_path = database_path
+        self.flush_interval = flush_interval
+        # user_id -> JSON as last written or being written, and user_id -> JSON waiting to be written (None to delete the row)
+        self._saved = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def get_user_data(self):
+        user_data = defaultdict(dict)
+        for user_id, state in execute_db_query(self.database_path, "SELECT user_id, data FROM user_state", fetch_all=True):
+            user_data[user_id] = json.loads(state)
+            self._saved[user_id] = state
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='user-state', daemon=True)
+            self._thread.start()
+        return user_data
+
+    def update_user_data(self, user_id, data):
+        state = json.dumps(data, sort_keys=True) if data else None
+        with self._lock:
+            current = self._pending[user_id] if user_id in self._pending else self._saved.get(user_id)
+            if state == current:
+                return
+            self._pending[user_id] = state
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self._write()
+
+    def _write(self):
+        # One write at a time, so an older batch never lands after a newer one
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                # Counted as saved from here on, so a change back to the old data while this write runs is still queued
+                self._saved.update(pending)
+            if not pending:
+                return
+            try:
+                with transaction(self.database_path) as conn:
+                    conn.executemany("""
+                        INSERT INTO user_state (user_id, data) VALUES (?, ?)
+                        ON CONFLICT (user_id) DO UPDATE SET data = excluded.data
+                    """, [(user_id, state) for user_id, state in pending.items() if state is not None])
+                    conn.executemany("DELETE FROM user_state WHERE user_id = ?",
+                                     [(user_id,) for user_id, state in pending.items() if state is None])
+            except Exception as e:
+                logger.error(f"Error saving the state of {len(pending)} users, retrying on the next flush: {e}")
+                with self._lock:
+                    # Changes queued meanwhile are newer and win
+                    self._pending = {**pending, **self._pending}
+
+    def flush(self):
+        self._stopped.set()
+        self._write()
+
+    # Only user_data is stored
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return {}
+
+    def update_conversation(self, name, key, new_state):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
@@ -0,0 +1,71 @@
+"""Replay recorded Telegram Update payloads against a running webhook listener.
+
+Usage:
+    python scripts/replay_updates.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret-token TOKEN
+
+The input file holds one Update JSON object per line (or a single JSON array). Each update is POSTed the way
+Telegram delivers it, optionally several times and from several threads, and the response codes and latencies
+are summarised at the end.
+"""
+import argparse
+import json
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def post_update(url, secret_token, update):
+    headers = {'Content-Type': 'application/json'}
+    if secret_token:
+        headers[SECRET_TOKEN_HEADER] = secret_token
+    request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), headers=headers, method='POST')
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except urllib.error.URLError as e:
+        status = f"error: {e.reason}"
+    return status, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description="POST recorded Telegram updates to a webhook listener.")
+    parser.add_argument('updates', help="file with one Update JSON object per line, or a JSON array")
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    parser.add_argument('--secret-token', default=None)
+    parser.add_argument('--repeat', type=int, default=1, help="send the whole file this many times")
+    parser.add_argument('--concurrency', type=int, default=1, help="number of parallel senders")
+    args = parser.parse_args()
+
+    updates = load_updates(args.updates)
+    payloads = []
+    for round_number in range(args.repeat):
+        for update in updates:
+            # Telegram never repeats an update_id, so give every replayed copy a fresh one
+            payloads.append(dict(update, update_id=update.get('update_id', 0) + round_number * len(updates)))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda update: post_update(args.url, args.secret_token, update), payloads))
+    elapsed = time.perf_counter() - started
+
+    statuses = Counter(status for status, _ in results)
+    latencies = sorted(latency for _, latency in results)
+    print(f"Sent {len(results)} updates in {elapsed:.2f}s ({len(results) / elapsed:.1f} updates/s)")
+    print("Responses: " + ", ".join(f"{status}: {count}" for status, count in statuses.items()))
+    if latencies:
+        print(f"Latency p50: {latencies[len(latencies) // 2] * 1000:.1f} ms, max: {latencies[-1] * 1000:.1f} ms")
+
+if __name__ == '__main__':
+    main()
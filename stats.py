@@ -0,0 +1,95 @@
+from collections import Counter, namedtuple
+from datetime import date, timedelta
+from db import transaction, execute_db_query
+
+# Summary tables kept next to bookings. Every booking counts once in each: bookings per office and day, per table
+# and month, and per user and month. Archived bookings keep counting, so reports cover the whole history.
+SUMMARY_TABLES = {
+    'stats_daily': ('booking_day', ('booking_day',)),
+    'stats_table_monthly': ('substr(booking_day, 1, 7), table_id', ('month', 'table_id')),
+    'stats_user_monthly': ('substr(booking_day, 1, 7), user_id', ('month', 'user_id')),
+}
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS stats_daily
+       (office_id TEXT, booking_day DATE, bookings INTEGER NOT NULL,
+        PRIMARY KEY (office_id, booking_day)) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS stats_table_monthly
+       (office_id TEXT, month TEXT, table_id INTEGER, bookings INTEGER NOT NULL,
+        PRIMARY KEY (office_id, month, table_id)) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS stats_user_monthly
+       (office_id TEXT, month TEXT, user_id TEXT, bookings INTEGER NOT NULL,
+        PRIMARY KEY (office_id, month, user_id)) WITHOUT ROWID""",
+)
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri')
+TOP_COUNT = 5
+
+def count_bookings(conn, bookings, delta):
+    """Add delta (1 for new bookings, -1 for cancelled ones) to the summaries of every (office_id, user_id,
+    booking_day, table_id) in bookings. Called inside the transaction that writes the bookings themselves."""
+    daily, tables, users = Counter(), Counter(), Counter()
+    for office_id, user_id, booking_day, table_id in bookings:
+        month = booking_day[:7]
+        daily[(office_id, booking_day)] += delta
+        tables[(office_id, month, table_id)] += delta
+        users[(office_id, month, str(user_id))] += delta
+    for table, key_columns, counts in (('stats_daily', 'office_id, booking_day', daily),
+                                       ('stats_table_monthly', 'office_id, month, table_id', tables),
+                                       ('stats_user_monthly', 'office_id, month, user_id', users)):
+        if counts:
+            conn.executemany(f"""
+                INSERT INTO {table} ({key_columns}, bookings) VALUES ({', '.join('?' * (key_columns.count(',') + 2))})
+                ON CONFLICT ({key_columns}) DO UPDATE SET bookings = bookings + excluded.bookings
+            """, [key + (count,) for key, count in counts.items()])
+
+def rebuild_stats(database_path, office_id):
+    """Recompute office_id's summaries from its bookings and archived bookings, in one transaction.
+    Returns how many bookings were counted."""
+    with transaction(database_path) as conn:
+        for table, (expression, columns) in SUMMARY_TABLES.items():
+            conn.execute(f"DELETE FROM {table} WHERE office_id = ?", (office_id,))
+            conn.execute(f"""
+                INSERT INTO {table} (office_id, {', '.join(columns)}, bookings)
+                SELECT office_id, {expression}, COUNT(*) FROM (
+                    SELECT office_id, user_id, table_id, booking_day FROM bookings WHERE office_id = ? AND booking_day IS NOT NULL
+                    UNION ALL
+                    SELECT office_id, user_id, table_id, booking_day FROM bookings_archive WHERE office_id = ? AND booking_day IS NOT NULL
+                ) GROUP BY office_id, {expression}
+            """, (office_id, office_id))
+        return conn.execute("SELECT COALESCE(SUM(bookings), 0) FROM stats_daily WHERE office_id = ?", (office_id,)).fetchone()[0]
+
+# weekdays holds (weekday name, average bookings per day) for Monday to Friday; tables and users are the TOP_COUNT
+# busiest as (table_id or user_id, bookings)
+OccupancyReport = namedtuple('OccupancyReport', ['first_day', 'last_day', 'bookings', 'working_days', 'weekdays', 'tables', 'users'])
+
+def occupancy_report(database_path, office_id, months, today=None):
+    """Summarise office_id's bookings of the last `months` calendar months up to today, from the summary tables
+    only: the work depends on the number of days, tables and users in the period, not on the number of bookings."""
+    today = today or date.today()
+    year, month = divmod(today.year * 12 + today.month - 1 - (months - 1), 12)
+    first_day = date(year, month + 1, 1)
+    first_month = first_day.strftime('%Y-%m')
+    last_month = today.strftime('%Y-%m')
+
+    per_weekday = Counter()
+    for booking_day, bookings in execute_db_query(database_path, """
+            SELECT booking_day, bookings FROM stats_daily WHERE office_id = ? AND booking_day BETWEEN ? AND ?
+        """, (office_id, first_day.isoformat(), today.isoformat()), fetch_all=True):
+        per_weekday[date.fromisoformat(booking_day).weekday()] += bookings
+    # Averages are per working day in the period, so days nobody booked count as empty rather than being skipped
+    day_counts = Counter((first_day + timedelta(days=offset)).weekday() for offset in range((today - first_day).days + 1))
+    weekdays = [(WEEKDAYS[weekday], per_weekday[weekday] / day_counts[weekday] if day_counts[weekday] else 0)
+                for weekday in range(len(WEEKDAYS))]
+
+    top = {}
+    for table, column in (('stats_table_monthly', 'table_id'), ('stats_user_monthly', 'user_id')):
+        top[table] = execute_db_query(database_path, f"""
+            SELECT {column}, SUM(bookings) AS total FROM {table}
+            WHERE office_id = ? AND month BETWEEN ? AND ?
+            GROUP BY {column} HAVING total > 0 ORDER BY total DESC, {column} LIMIT ?
+        """, (office_id, first_month, last_month, TOP_COUNT), fetch_all=True)
+
+    return OccupancyReport(first_day, today, sum(per_weekday.values()),
+                           sum(day_counts[weekday] for weekday in range(len(WEEKDAYS))), weekdays,
+                           top['stats_table_monthly'], top['stats_user_monthly'])
@@ -0,0 +1,42 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_TEMPLATE = """BOT_TOKEN = 'unused'
+ADMIN_USER_ID = '1'
+ADMIN_USERNAME = 'admin'
+BOOKINGS_DB_PATH = {bookings_db_path!r}
+USERS_DB_PATH = {users_db_path!r}
+TOTAL_TABLES = 10
+LOG_TIMEZONE = 'UTC'
+LOG_QUEUE = False
+"""
+
+_main = None
+
+def load_main():
+    """Import main once against a throwaway config, as benchmarks/run_benchmarks.py does."""
+    global _main
+    if _main is None:
+        directory = tempfile.mkdtemp(prefix='deskbooker-tests-')
+        atexit.register(shutil.rmtree, directory, True)
+        with open(os.path.join(directory, 'config.py'), 'w') as f:
+            f.write(CONFIG_TEMPLATE.format(bookings_db_path=os.path.join(directory, 'bookings.db'),
+                                           users_db_path=os.path.join(directory, 'users.db')))
+        sys.path.insert(0, directory)
+        sys.path.insert(1, REPO_ROOT)
+        import main
+        _main = main
+    return _main
+
+def initialize_databases(database_path):
+    """Run main.initialize_databases with the bookings and users tables both in database_path, so a test gets
+    exactly the schema, indexes and migrations the bot starts with."""
+    main = load_main()
+    main.bookings_db_path = main.users_db_path = database_path
+    main.initialize_databases()
+    return main
@@ -0,0 +1,93 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from availability import AvailabilityIndex
+from bookings import book_table
+from db import close_all_connections, execute_db_query
+from test_booking_race import create_schema
+
+DAY, OTHER_DAY = '2031-10-20', '2031-10-21'
+
+class AvailabilityIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='deskbooker-availability-')
+        self.database_path = os.path.join(self.directory, 'bookings.db')
+        create_schema(self.database_path)
+        self.availability = AvailabilityIndex(self.database_path, 10, 'main')
+
+    def tearDown(self):
+        close_all_connections()
+        shutil.rmtree(self.directory)
+
+    def test_conflict_cancelled_elsewhere_is_not_reported(self):
+        book_table(self.database_path, 'main', '10000', '@a', '20.10.2031', DAY, 3)
+        self.assertEqual(self.availability.table_holder(DAY, 3), '@a')
+        # Cancelled by another process: memory still has the booking, the confirmed lookups don't
+        execute_db_query(self.database_path, "DELETE FROM bookings")
+        self.assertIsNone(self.availability.confirmed_table_holder(DAY, 3))
+        self.assertIsNone(self.availability.table_holder(DAY, 3))
+        self.assertFalse(self.availability.booked_tables(DAY)[3])
+
+    def test_confirmed_conflict_is_reported(self):
+        book_table(self.database_path, 'main', '10000', '@a', '20.10.2031', DAY, 3)
+        self.assertEqual(self.availability.confirmed_table_holder(DAY, 3), '@a')
+        self.assertEqual(self.availability.confirmed_user_table(DAY, '10000'), 3)
+        self.assertFalse(self.availability.confirmed_fully_booked(DAY))
+
+    def test_cold_day_does_not_block_other_days(self):
+        self.availability.warm([OTHER_DAY])
+        loading, release = threading.Event(), threading.Event()
+        load = self.availability._load
+
+        def slow_load(booking_day):
+            if booking_day == DAY:
+                loading.set()
+                release.wait(5)
+            return load(booking_day)
+
+        self.availability._load = slow_load
+        cold = threading.Thread(target=self.availability.booked_tables, args=(DAY,))
+        cold.start()
+        self.assertTrue(loading.wait(5))
+        finished = threading.Event()
+        reader = threading.Thread(target=lambda: (self.availability.table_holder(OTHER_DAY, 1), finished.set()))
+        reader.start()
+        self.assertTrue(finished.wait(1), "a read of a cached day waited for the load of another day")
+        release.set()
+        cold.join()
+        reader.join()
+
+    def test_load_overlapping_a_booking_is_repeated(self):
+        loading, release = threading.Event(), threading.Event()
+        load = self.availability._load
+        loads = []
+
+        def slow_load(booking_day):
+            state = load(booking_day)
+            loads.append(booking_day)
+            if len(loads) == 1:
+                loading.set()
+                release.wait(5)
+            return state
+
+        self.availability._load = slow_load
+        cold = threading.Thread(target=self.availability.booked_tables, args=(DAY,))
+        cold.start()
+        self.assertTrue(loading.wait(5))
+        # Booked after the first snapshot was read, before it is stored
+        book_table(self.database_path, 'main', '10000', '@a', '20.10.2031', DAY, 3)
+        self.availability.mark_booked(DAY, 3, '10000', '@a')
+        release.set()
+        cold.join()
+        self.assertEqual(len(loads), 2)
+        self.assertEqual(self.availability.table_holder(DAY, 3), '@a')
+
+if __name__ == '__main__':
+    unittest.main()
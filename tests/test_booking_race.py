@@ -0,0 +1,87 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bookings import BookingOutcome, book_table
+from db import close_all_connections, execute_db_query
+from support import initialize_databases
+
+# Threads released at once against one database
+THREADS = 300
+BOOKING_DATE, BOOKING_DAY = '20.10.2031', '2031-10-20'
+
+def create_schema(database_path):
+    """The schema the bot runs with, including the unique indexes that decide booking races, built by the real
+    migrations."""
+    initialize_databases(database_path)
+
+class BookingRaceTest(unittest.TestCase):
+    """Hundreds of threads calling book_table at the same moment, straight against the database: no in-memory
+    availability check in front, so every call reaches the unique indexes."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='deskbooker-race-')
+        self.database_path = os.path.join(self.directory, 'bookings.db')
+        create_schema(self.database_path)
+
+    def tearDown(self):
+        close_all_connections()
+        shutil.rmtree(self.directory)
+
+    def race(self, taps):
+        """Run book_table for every (user_id, table_id) in taps on its own thread, all released together."""
+        barrier = threading.Barrier(len(taps))
+        outcomes = [None] * len(taps)
+        errors = []
+
+        def tap(index, user_id, table_id):
+            try:
+                barrier.wait()
+                outcomes[index] = book_table(self.database_path, 'main', user_id, f'@user{user_id}',
+                                             BOOKING_DATE, BOOKING_DAY, table_id).outcome
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=tap, args=(index, user_id, table_id)) for index, (user_id, table_id) in enumerate(taps)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return outcomes
+
+    def bookings(self):
+        return execute_db_query(self.database_path, "SELECT user_id, table_id FROM bookings WHERE office_id = 'main' AND booking_day = ?",
+                                (BOOKING_DAY,), fetch_all=True)
+
+    def test_everyone_taps_the_same_table(self):
+        outcomes = self.race([(str(10000 + user), 1) for user in range(THREADS)])
+        self.assertEqual(Counter(outcomes), Counter({BookingOutcome.BOOKED: 1, BookingOutcome.TABLE_TAKEN: THREADS - 1}))
+        self.assertEqual(len(self.bookings()), 1)
+
+    def test_one_user_taps_several_tables(self):
+        outcomes = self.race([('10000', table_id) for table_id in range(1, 21)])
+        self.assertEqual(Counter(outcomes), Counter({BookingOutcome.BOOKED: 1, BookingOutcome.USER_ALREADY_BOOKED: 19}))
+        self.assertEqual(len(self.bookings()), 1)
+
+    def test_many_users_tap_many_tables(self):
+        rng = random.Random(1)
+        # Every user taps a few tables at once, so both unique indexes are contended
+        taps = [(str(10000 + user), rng.randint(1, 10)) for user in range(60) for _ in range(5)]
+        outcomes = self.race(taps)
+        bookings = self.bookings()
+        self.assertEqual(len(bookings), outcomes.count(BookingOutcome.BOOKED))
+        self.assertEqual(max(Counter(table_id for _, table_id in bookings).values()), 1)
+        self.assertEqual(max(Counter(user_id for user_id, _ in bookings).values()), 1)
+        # A tapped table is never left free while someone was turned away from it as taken
+        self.assertEqual({table_id for _, table_id in bookings}, {table_id for _, table_id in taps})
+
+if __name__ == '__main__':
+    unittest.main()
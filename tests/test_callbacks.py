@@ -0,0 +1,29 @@
+import os
+import sys
+import unittest
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import callbacks
+
+DAY = date(2031, 10, 20)
+
+class DecodeTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for action, number in ((callbacks.DATE, None), (callbacks.TABLE, 12), (callbacks.PAGE, 0),
+                               (callbacks.PLAN, 1), (callbacks.WAITLIST, None)):
+            self.assertEqual(callbacks.decode(callbacks.encode(action, 'main', DAY, number)),
+                             callbacks.BookingCallback(action, 'main', DAY, number))
+
+    def test_malformed_payloads_are_rejected(self):
+        ordinal = DAY.toordinal()
+        for data in (f'1t:main:{ordinal}', f'1m:main:{ordinal}', f'1p:main:{ordinal}',  # number missing
+                     f'1d:main:{ordinal}:3', f'1w:main:{ordinal}:3',  # number where none belongs
+                     f'1x:main:{ordinal}:3', f'1t:main:{ordinal}:x', '1t:main:0:3',
+                     '1t:main:99999999999999999999:3'):  # OverflowError from date.fromordinal
+            self.assertIsNone(callbacks.decode(data), data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import close_all_connections, execute_db_query
+from support import REPO_ROOT, initialize_databases
+
+# The bookings table as the first releases created it: display dates only, no booking_day or office_id
+OLD_BOOKINGS_TABLE = '''CREATE TABLE bookings
+                           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            user_id TEXT, username TEXT,
+                            booking_date TEXT, table_id INTEGER)'''
+
+class MigrationTest(unittest.TestCase):
+    """initialize_databases run on databases left behind by older versions of the bot."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='deskbooker-migrations-')
+        self.database_path = os.path.join(self.directory, 'bookings.db')
+
+    def tearDown(self):
+        close_all_connections()
+        shutil.rmtree(self.directory)
+
+    def create_old_bookings(self, rows):
+        execute_db_query(self.database_path, OLD_BOOKINGS_TABLE)
+        for row in rows:
+            execute_db_query(self.database_path, "INSERT INTO bookings (user_id, username, booking_date, table_id) VALUES (?, ?, ?, ?)", row)
+
+    def test_display_dates_are_backfilled(self):
+        self.create_old_bookings([('10000', '@a', '10.01.2024 (Wed)', 1),
+                                  ('10001', '@b', '10.01.2024 (Wed)', 2),
+                                  ('10000', '@a', '11.01.2024 (Thu)', 1)])
+        initialize_databases(self.database_path)
+        self.assertEqual(execute_db_query(self.database_path, "SELECT booking_day, table_id, office_id FROM bookings ORDER BY id", fetch_all=True),
+                         [('2024-01-10', 1, 'main'), ('2024-01-10', 2, 'main'), ('2024-01-11', 1, 'main')])
+        # Listings and availability read the bookings through the holders view
+        self.assertEqual(execute_db_query(self.database_path, "SELECT holder FROM booking_holders WHERE booking_day = '2024-01-10' ORDER BY table_id", fetch_all=True),
+                         [('@a',), ('@b',)])
+
+    def test_shipped_database(self):
+        shutil.copy(os.path.join(REPO_ROOT, 'data', 'bookings.db'), self.database_path)
+        count = execute_db_query(self.database_path, "SELECT COUNT(*) FROM bookings", fetch_one=True)[0]
+        initialize_databases(self.database_path)
+        self.assertEqual(execute_db_query(self.database_path, "SELECT COUNT(*) FROM bookings WHERE booking_day IS NOT NULL", fetch_one=True)[0], count)
+
+    def test_old_duplicates_are_removed(self):
+        # Left behind by the check-then-insert race: the same table twice, and one user on two tables, on a day
+        self.create_old_bookings([('10000', '@a', '10.01.2024 (Wed)', 1),
+                                  ('10001', '@b', '10.01.2024 (Wed)', 1),
+                                  ('10002', '@c', '10.01.2024 (Wed)', 2),
+                                  ('10002', '@c', '10.01.2024 (Wed)', 3)])
+        initialize_databases(self.database_path)
+        # The earliest booking wins
+        self.assertEqual(execute_db_query(self.database_path, "SELECT user_id, table_id FROM bookings ORDER BY id", fetch_all=True),
+                         [('10000', 1), ('10002', 2)])
+        indexes = {name for (name,) in execute_db_query(self.database_path, "SELECT name FROM sqlite_master WHERE type = 'index'", fetch_all=True)}
+        self.assertLessEqual({'uq_bookings_office_day_table', 'uq_bookings_user_day'}, indexes)
+
+    def test_unconvertible_dates_stop_the_migration(self):
+        self.create_old_bookings([('10000', '@a', '10.01.2024 (Wed)', 1),
+                                  ('10001', '@b', '2024/01/10', 1),
+                                  ('10001', '@b', '2024/01/10', 1)])
+        with self.assertRaisesRegex(RuntimeError, "2 bookings"):
+            initialize_databases(self.database_path)
+        # Nothing was deduplicated on a guess, and the rows are still there to be corrected
+        self.assertEqual(execute_db_query(self.database_path, "SELECT COUNT(*) FROM bookings", fetch_one=True)[0], 3)
+        execute_db_query(self.database_path, "UPDATE bookings SET booking_date = '11.01.2024 (Thu)' WHERE booking_day IS NULL")
+        initialize_databases(self.database_path)
+        self.assertEqual(execute_db_query(self.database_path, "SELECT user_id, booking_day FROM bookings ORDER BY id", fetch_all=True),
+                         [('10000', '2024-01-10'), ('10001', '2024-01-11')])
+
+    def test_migrations_run_again_on_every_start(self):
+        self.create_old_bookings([('10000', '@a', '10.01.2024 (Wed)', 1)])
+        initialize_databases(self.database_path)
+        initialize_databases(self.database_path)
+        self.assertEqual(execute_db_query(self.database_path, "SELECT booking_day FROM bookings", fetch_all=True), [('2024-01-10',)])
+
+if __name__ == '__main__':
+    unittest.main()
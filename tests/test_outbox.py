@@ -0,0 +1,46 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from outbox import Outbox
+
+class Bot:
+    """Fails with a non-Telegram error on the texts in broken, and records the rest."""
+
+    def __init__(self, broken):
+        self.broken = broken
+        self.sent = []
+
+    def send_message(self, chat_id, text):
+        if text in self.broken:
+            raise TypeError(f"can't serialize {text!r}")
+        self.sent.append((chat_id, text))
+
+class OutboxTest(unittest.TestCase):
+
+    def test_unexpected_error_releases_the_chat(self):
+        bot = Bot(broken={'first'})
+        outbox = Outbox(global_rate=1000, chat_rate=1000)
+        outbox.start(bot)
+        results, done = [], threading.Event()
+
+        def on_done(ok):
+            results.append(ok)
+            if len(results) == 2:
+                done.set()
+
+        try:
+            outbox.send_message(10000, 'first', on_done=on_done)
+            outbox.send_message(10000, 'second', on_done=on_done)
+            self.assertTrue(done.wait(5))
+        finally:
+            outbox.stop()
+        self.assertEqual(results, [False, True])
+        self.assertEqual(bot.sent, [(10000, 'second')])
+        self.assertEqual((outbox.depth(), outbox.sent, outbox.failed), (0, 1, 1))
+
+if __name__ == '__main__':
+    unittest.main()
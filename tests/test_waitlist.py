@@ -0,0 +1,63 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bookings import join_waitlist
+from clock import Clock
+from db import close_all_connections, execute_db_query
+from jobs import BackgroundJobs
+from offices import load_offices
+from user_cache import CachedUser
+from test_booking_race import create_schema
+
+BOOKING_DATE, BOOKING_DAY = '20.10.2031', '2031-10-20'
+
+class Outbox:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text):
+        self.sent.append(chat_id)
+
+class Users:
+    """Stands in for UserCache: registered users by id."""
+
+    def __init__(self, users):
+        self.users = {user.user_id: user for user in users}
+
+    def get(self, user_id):
+        return self.users.get(str(user_id))
+
+class WaitlistPromotionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='deskbooker-waitlist-')
+        self.database_path = os.path.join(self.directory, 'bookings.db')
+        create_schema(self.database_path)
+        self.offices = load_offices(None, 10, self.database_path, 3, 60)
+        self.outbox = Outbox()
+
+    def tearDown(self):
+        close_all_connections()
+        shutil.rmtree(self.directory)
+
+    def promote(self, users):
+        jobs = BackgroundJobs(self.database_path, self.offices, self.outbox, lambda: [], Clock('UTC'), users=Users(users))
+        jobs.promote_waitlist(SimpleNamespace(job=SimpleNamespace(context=(self.offices['main'], BOOKING_DAY, 4)), job_queue=None))
+
+    def test_removed_and_blacklisted_waiters_are_dropped(self):
+        for user_id in ('10000', '10001', '10002'):
+            join_waitlist(self.database_path, 'main', user_id, f'@user{user_id}', BOOKING_DATE, BOOKING_DAY)
+        # 10000 was removed, 10001 blacklisted; 10002 is next in line
+        self.promote([CachedUser('10001', 'user10001', False, True, None), CachedUser('10002', 'user10002', False, False, None)])
+        self.assertEqual(execute_db_query(self.database_path, "SELECT user_id, table_id FROM bookings", fetch_all=True), [('10002', 4)])
+        self.assertEqual(execute_db_query(self.database_path, "SELECT COUNT(*) FROM waitlist", fetch_one=True)[0], 0)
+        self.assertEqual(self.outbox.sent, ['10002'])
+
+if __name__ == '__main__':
+    unittest.main()
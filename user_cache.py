@@ -0,0 +1,58 @@
+import threading
+import time
+from collections import namedtuple
+from db import execute_db_query
+
+CachedUser = namedtuple('CachedUser', ['user_id', 'username', 'is_admin', 'is_blacklisted', 'office_id'])
+
+class UserCache:
+    """Process-wide copy of the users table used for authorization checks.
+
+    Admin commands that change a user call refresh_user() right after their write, so the cache stays exact
+    without any I/O on the read path. If ttl (seconds) is set, the whole table is also reloaded once it is
+    older than that, which picks up edits made to the database outside the bot."""
+
+    def __init__(self, database_path, ttl=None):
+        self.database_path = database_path
+        self.ttl = ttl
+        self._users = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        rows = execute_db_query(self.database_path, "SELECT user_id, username, is_admin, is_blacklisted, office_id FROM users", fetch_all=True)
+        users = {str(row[0]): CachedUser(str(row[0]), row[1], bool(row[2]), bool(row[3]), row[4]) for row in rows}
+        with self._lock:
+            self._users = users
+            self._loaded_at = time.monotonic()
+
+    def _is_stale(self):
+        if self._loaded_at is None:
+            return True
+        return bool(self.ttl) and time.monotonic() - self._loaded_at > self.ttl
+
+    def get(self, user_id):
+        """Return the CachedUser for user_id, or None if the user is not registered."""
+        if self._is_stale():
+            self.load()
+        return self._users.get(str(user_id))
+
+    def active_user_ids(self):
+        """user_id of every registered user who is not blacklisted."""
+        if self._is_stale():
+            self.load()
+        return [user.user_id for user in self._users.values() if not user.is_blacklisted]
+
+    def is_admin(self, user_id):
+        user = self.get(user_id)
+        return bool(user and user.is_admin)
+
+    def refresh_user(self, user_id):
+        """Re-read a single user after a write to the users table."""
+        user_id = str(user_id)
+        row = execute_db_query(self.database_path, "SELECT user_id, username, is_admin, is_blacklisted, office_id FROM users WHERE user_id = ?", (user_id,), fetch_one=True)
+        with self._lock:
+            if row:
+                self._users[user_id] = CachedUser(user_id, row[1], bool(row[2]), bool(row[3]), row[4])
+            else:
+                self._users.pop(user_id, None)
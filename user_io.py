@@ -0,0 +1,116 @@
+import csv
+import io
+import json
+from db import get_connection, transaction
+
+# Columns an import file may carry besides the required user_id; only the columns present are written
+IMPORT_COLUMNS = ('username', 'is_admin', 'is_blacklisted')
+FLAG_COLUMNS = ('is_admin', 'is_blacklisted')
+FLAG_VALUES = {'': 0, '0': 0, '1': 1, 'false': 0, 'true': 1, 'no': 0, 'yes': 1}
+EXPORT_COLUMNS = ('user_id', 'username', 'is_admin', 'is_blacklisted')
+EXPORT_BATCH_SIZE = 1000
+
+def parse_users_file(content, file_name, protected_user_id=None):
+    """Parse an uploaded CSV or JSON user list.
+
+    CSV files need a header row; JSON files hold a list of objects. Both use the keys user_id, username, is_admin
+    and is_blacklisted, of which only user_id is required. Returns (columns, rows, errors): the optional columns
+    present, one tuple per valid row in (user_id, *columns) order, and a "Row N: reason" message per rejected row.
+    protected_user_id (the bot owner) can't lose admin rights or be blacklisted through an import. A file that can't
+    be parsed at all raises ValueError with a "Line N: reason" message."""
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError as e:
+        line = content[:e.start].count(b'\n') + 1
+        raise ValueError(f"Line {line}: not UTF-8 text") from e
+    if file_name.lower().endswith('.json') or text.lstrip().startswith('['):
+        try:
+            records = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {e.lineno}: invalid JSON ({e.msg})") from e
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            raise ValueError("JSON imports must be a list of objects")
+        present = set().union(*records) if records else set()
+        first_row = 1
+    else:
+        reader = csv.DictReader(io.StringIO(text))
+        try:
+            records = list(reader)
+        except csv.Error as e:
+            # DictReader.line_num only advances after a row parsed, the underlying reader's counts the failing line
+            raise ValueError(f"Line {reader.reader.line_num}: invalid CSV ({e})") from e
+        present = set(reader.fieldnames or ())
+        # Row numbers refer to file lines, after the header
+        first_row = 2
+    if 'user_id' not in present:
+        raise ValueError("The file must have a user_id column")
+    columns = tuple(column for column in IMPORT_COLUMNS if column in present)
+
+    rows, errors, seen = [], [], set()
+    for number, record in enumerate(records, start=first_row):
+        user_id = str(record.get('user_id') or '').strip()
+        if not user_id.isdigit():
+            errors.append(f"Row {number}: invalid user_id {user_id!r}")
+            continue
+        if user_id in seen:
+            errors.append(f"Row {number}: duplicate user_id {user_id}")
+            continue
+        values = [user_id]
+        for column in columns:
+            value = record.get(column)
+            if column in FLAG_COLUMNS:
+                flag = FLAG_VALUES.get(str(value if value is not None else '').strip().lower())
+                if flag is None:
+                    errors.append(f"Row {number}: invalid {column} {value!r}")
+                    break
+                values.append(flag)
+            else:
+                username = str(value).strip().lstrip('@') if value is not None else ''
+                values.append(username or None)
+        else:
+            row = dict(zip(('user_id',) + columns, values))
+            if user_id == protected_user_id and (row.get('is_admin') == 0 or row.get('is_blacklisted') == 1):
+                errors.append(f"Row {number}: the bot owner's admin and blacklist status can't be changed")
+                continue
+            seen.add(user_id)
+            rows.append(tuple(values))
+    return columns, rows, errors
+
+def import_users(database_path, columns, rows):
+    """Insert or update all rows in one transaction. Existing users only get the given columns overwritten."""
+    insert_columns = ('user_id',) + columns
+    query = f"INSERT INTO users ({', '.join(insert_columns)}) VALUES ({', '.join('?' * len(insert_columns))}) ON CONFLICT(user_id) "
+    if columns:
+        query += "DO UPDATE SET " + ', '.join(f"{column} = excluded.{column}" for column in columns)
+    else:
+        query += "DO NOTHING"
+    with transaction(database_path) as conn:
+        conn.executemany(query, rows)
+    return len(rows)
+
+def export_users(database_path, out, file_format='csv'):
+    """Write every user to the binary file object out as CSV or JSON, reading the table in batches."""
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='')
+    cursor = get_connection(database_path).execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM users ORDER BY id")
+    count = 0
+    if file_format == 'json':
+        text.write('[')
+    else:
+        writer = csv.writer(text)
+        writer.writerow(EXPORT_COLUMNS)
+    while True:
+        batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not batch:
+            break
+        for row in batch:
+            if file_format == 'json':
+                text.write((',\n' if count else '\n') + json.dumps(dict(zip(EXPORT_COLUMNS, row))))
+            else:
+                writer.writerow(row)
+            count += 1
+    if file_format == 'json':
+        text.write('\n]\n')
+    text.flush()
+    # Hand the binary file back to the caller instead of closing it with the wrapper
+    text.detach()
+    return count
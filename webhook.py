@@ -0,0 +1,100 @@
+import hmac
+import json
+import logging
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Characters and length Telegram accepts for setWebhook's secret_token
+SECRET_TOKEN_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,256}')
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'DeskBookerWebhook'
+
+    def do_POST(self):
+        server = self.server
+        if urlsplit(self.path).path.rstrip('/') != server.url_path:
+            self.send_error(404)
+            return
+        # Telegram echoes the secret_token given to setWebhook in this header on every delivery
+        if not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ''), server.secret_token):
+            logger.warning(f"Rejected webhook request from {self.client_address[0]}: bad secret token")
+            self.send_error(403)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            update = Update.de_json(json.loads(self.rfile.read(length)), server.bot)
+        except Exception as e:
+            logger.error(f"Invalid webhook payload: {e}")
+            self.send_error(400)
+            return
+
+        # Processing happens on the dispatcher's worker pool; Telegram only needs to know we accepted the update
+        server.update_queue.put(update)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(f"Webhook {self.client_address[0]}: {format % args}")
+
+class WebhookServer(ThreadingHTTPServer):
+    """HTTP listener that validates Telegram webhook deliveries and feeds them into the dispatcher's update queue.
+    At most max_connections requests are read at once; further connections wait in the listen backlog."""
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, listen, port, url_path, secret_token, bot, update_queue, max_connections=40):
+        super().__init__((listen, port), _WebhookRequestHandler)
+        self.url_path = '/' + url_path.strip('/')
+        self.secret_token = secret_token
+        self.bot = bot
+        self.update_queue = update_queue
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
+
+def check_secret_token(secret_token):
+    """Raise ValueError unless secret_token is set and in the format Telegram accepts."""
+    if not secret_token or not SECRET_TOKEN_PATTERN.fullmatch(secret_token):
+        raise ValueError("Webhook mode needs WEBHOOK_SECRET_TOKEN: 1-256 letters, digits, underscores or dashes")
+
+def start_webhook(updater, webhook_url, listen='0.0.0.0', port=8443, url_path='telegram', secret_token=None,
+                  max_connections=40, drop_pending_updates=False):
+    """Serve updates through a webhook instead of long polling.
+
+    Registers webhook_url with Telegram and starts the listener, the dispatcher and the job queue. The server is
+    attached to the updater, so updater.idle()/updater.stop() shut it down the same way as polling. secret_token is
+    required: without it anyone who finds the URL could post forged updates."""
+    check_secret_token(secret_token)
+    server = WebhookServer(listen, port, url_path, secret_token, updater.bot, updater.update_queue, max_connections)
+
+    updater.bot.set_webhook(url=webhook_url, max_connections=max_connections,
+                            drop_pending_updates=drop_pending_updates, api_kwargs={'secret_token': secret_token})
+
+    updater.job_queue.start()
+    threading.Thread(target=updater.dispatcher.start, name='dispatcher').start()
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+    updater.httpd = server
+    updater.running = True
+
+    logger.info(f"Webhook listening on {listen}:{port}{server.url_path} for {webhook_url}")
+    return server